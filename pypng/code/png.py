@@ -146,38 +146,51 @@ And now, my famous members
 
 __version__ = "0.0.18"
 
+# Every tool imports this module, so only modules that are cheap to
+# import (mostly built into the interpreter) are imported here.  Others
+# (``copy``, ``re``, ``warnings``, ``collections``, ``functools``, and
+# the Cython module ``cpngfilters``) are imported when first needed.
+import binascii
 import itertools
 import math
-import re
 # http://www.python.org/doc/2.4.4/lib/module-operator.html
 import operator
 import struct
 import sys
-# http://www.python.org/doc/2.4.4/lib/module-warnings.html
-import warnings
+import time
 import zlib
 
 from array import array
-from functools import reduce
 
-try:
-    # `cpngfilters` is a Cython module: it must be compiled by
-    # Cython for this import to work.
-    # If this import does work, then it overrides pure-python
-    # filtering functions defined later in this file (see `class
-    # pngfilters`).
-    import cpngfilters as pngfilters
-except ImportError:
-    pass
 
-
-__all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array']
+__all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array',
+           'analyse', 'CodecContext', 'aencode', 'IncrementalDecoder',
+           'StreamWriter', 'decode_many', 'Stats']
 
 
 # The PNG signature.
 # http://www.w3.org/TR/PNG/#5PNG-file-signature
 _signature = struct.pack('8B', 137, 80, 78, 71, 13, 10, 26, 10)
 
+# zlib compression strategies, by name.  Older versions of the zlib
+# module lack some of the constants; the values are zlib's.
+_strategies = dict(default=zlib.Z_DEFAULT_STRATEGY,
+                   filtered=zlib.Z_FILTERED,
+                   huffman=zlib.Z_HUFFMAN_ONLY,
+                   rle=getattr(zlib, 'Z_RLE', 3),
+                   fixed=getattr(zlib, 'Z_FIXED', 4))
+
+# Writer option presets, by name (see the `preset` argument of
+# :class:`Writer`).
+# 'fast' is for realtime encoding, where latency matters more than
+# size: the Sub filter removes most of the redundancy of photographic
+# rows cheaply, and run-length encoding is the quickest zlib strategy
+# that still compresses.
+_presets = dict(fast=dict(compression=1, strategy='rle', filter_type=1))
+
+# The clock used by :class:`Stats`.
+_clock = getattr(time, 'perf_counter', time.time)
+
 _adam7 = ((0, 0, 8, 8),
           (4, 0, 8, 8),
           (0, 4, 4, 8),
@@ -193,8 +206,44 @@ def group(s, n):
 def isarray(x):
     return isinstance(x, array)
 
-def tostring(row):
-    return row.tostring()
+# The unsigned array typecodes, in order of size.  Python 2 has no 'Q'.
+_typecodes = []
+for _t in 'BHILQ':
+    try:
+        array(_t)
+    except ValueError:
+        continue
+    _typecodes.append(_t)
+del _t
+
+if hasattr(array, 'tobytes'):
+    def tobytes(row):
+        """Return the bytes of the ``array`` `row`."""
+        return row.tobytes()
+else:
+    # Before Python 3.2.
+    def tobytes(row):
+        """Return the bytes of the ``array`` `row`."""
+        return row.tostring()
+tostring = tobytes
+
+def _warn(message, category=UserWarning):
+    """Issue a warning, as though from the caller."""
+
+    # http://www.python.org/doc/2.4.4/lib/module-warnings.html
+    import warnings
+    warnings.warn(message, category, stacklevel=2)
+
+try:
+    buffer
+except NameError:
+    def _view(s, start, stop):
+        """Return a view of the bytes of `s` from `start` to `stop`,
+        without copying them."""
+        return memoryview(s)[start:stop]
+else:
+    def _view(s, start, stop):
+        return buffer(s, start, stop-start)
 
 def interleave_planes(ipixels, apixels, ipsize, apsize):
     """
@@ -317,6 +366,176 @@ class ChunkError(FormatError):
     pass
 
 
+class CodecContext:
+    """
+    The zlib settings for encoding and decoding, which can be shared
+    by many :class:`Writer` and :class:`Reader` instances.
+    """
+
+    # The names of the settings, in order.
+    options = ('compression', 'strategy', 'window_bits', 'mem_level')
+
+    def __init__(self, compression=None, strategy=None, window_bits=None,
+                 mem_level=None):
+        """
+        Create a codec context.  The arguments are the same as the
+        corresponding arguments of :class:`Writer`; ``None`` means
+        zlib's default.
+
+        The zlib objects that :meth:`compressobj` and
+        :meth:`decompressobj` return are new objects each time.
+        (Copying a primed object, with its ``copy`` method, copies
+        the whole of zlib's compression state and turns out to take
+        several times as long as creating a fresh one.)
+        """
+
+        if compression is not None and compression not in range(-1, 10):
+            raise ValueError("compression (%r) must be from -1 to 9" %
+              compression)
+        strategy = _strategies.get(strategy, strategy)
+        if strategy is not None and strategy not in _strategies.values():
+            raise ValueError("strategy (%r) must be one of %s" %
+              (strategy, ', '.join(sorted(_strategies))))
+        if window_bits is not None and window_bits not in range(9, 16):
+            raise ValueError("window_bits (%r) must be from 9 to 15" %
+              window_bits)
+        if mem_level is not None and mem_level not in range(1, 10):
+            raise ValueError("mem_level (%r) must be from 1 to 9" %
+              mem_level)
+        self.compression = compression
+        self.strategy = strategy
+        self.window_bits = window_bits
+        self.mem_level = mem_level
+        if compression is None:
+            compression = zlib.Z_DEFAULT_COMPRESSION
+        self._compress_args = (compression, zlib.DEFLATED,
+                               window_bits or zlib.MAX_WBITS,
+                               mem_level or zlib.DEF_MEM_LEVEL,
+                               strategy or zlib.Z_DEFAULT_STRATEGY)
+
+    def compressobj(self):
+        """Return a new ``zlib`` compression object."""
+
+        return zlib.compressobj(*self._compress_args)
+
+    def decompressobj(self):
+        """Return a new ``zlib`` decompression object."""
+
+        return zlib.decompressobj()
+
+class Stats:
+    """
+    Where the time goes when encoding and decoding.  For each stage
+    of the work, a stats object records the number of calls, the
+    wall time, the bytes in and out, and the rows.
+
+    Give a stats object as the `stats` argument of :class:`Reader`
+    or :class:`Writer`, or use it in a ``with`` statement: every
+    reader and writer created in the block (that is not given one
+    explicitly) then records into it.  Readers and writers without
+    a stats object record nothing, and do no more than one test of
+    it for each chunk or row.
+
+    The stages when decoding are ``'chunks'`` (reading chunks,
+    without checking their checksums), ``'crc'`` (checking the
+    checksums), ``'inflate'``, ``'unfilter'`` (undoing the filters
+    of a straightlaced image), ``'deinterlace'`` (undoing the filters
+    and interlacing of an interlaced image), and ``'boxing'``
+    (converting rows of bytes to rows of values).  The stages when
+    encoding are ``'pack'`` (converting rows of values to bytes),
+    ``'filter'``, ``'deflate'``, and ``'write'`` (writing ``IDAT``
+    chunks, with their checksums).  The conversions done by
+    :meth:`Reader.asDirect` and friends are not timed.
+    """
+
+    def __init__(self):
+        # For each stage: [calls, seconds, bytes in, bytes out, rows].
+        self.stages = {}
+        # The stages, in the order they are first seen.
+        self.order = []
+
+    def __enter__(self):
+        _active_stats.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_stats.remove(self)
+
+    def add(self, stage, seconds, bytes_in=0, bytes_out=0, rows=0):
+        """Record one call of `stage`."""
+
+        s = self.stages.get(stage)
+        if s is None:
+            s = self.stages[stage] = [0, 0.0, 0, 0, 0]
+            self.order.append(stage)
+        s[0] += 1
+        s[1] += seconds
+        s[2] += bytes_in
+        s[3] += bytes_out
+        s[4] += rows
+
+    def timed(self, stage, f):
+        """Return a function that calls `f` with one row, and records
+        each call as one row of `stage`, with the lengths in bytes of
+        the row and of the result.
+        """
+
+        add = self.add
+        def timed(row):
+            t = _clock()
+            result = f(row)
+            add(stage, _clock() - t, len(row),
+                len(result) * getattr(result, 'itemsize', 1), 1)
+            return result
+        return timed
+
+    def summary(self):
+        """Return the figures as a dictionary that maps each stage
+        to a dictionary with the keys ``'calls'``, ``'seconds'``,
+        ``'bytes_in'``, ``'bytes_out'``, and ``'rows'``.
+        """
+
+        keys = ('calls', 'seconds', 'bytes_in', 'bytes_out', 'rows')
+        return dict((stage, dict(zip(keys, s)))
+                    for stage,s in self.stages.items())
+
+    def report(self, elapsed=None):
+        """Return the figures as a table, in a string.  When
+        `elapsed` (the total wall time, in seconds) is given, the time
+        not spent in any stage is shown as ``'other'``.
+        """
+
+        stages = [(stage, self.stages[stage]) for stage in self.order]
+        total = sum(s[1] for _,s in stages)
+        if elapsed is not None:
+            stages.append(('other', [0, max(0.0, elapsed - total),
+                                     0, 0, 0]))
+            total = max(total, elapsed)
+        lines = ['%-12s %7s %9s %6s %12s %12s %8s %8s' %
+                 ('stage', 'calls', 'seconds', '%', 'bytes in',
+                  'bytes out', 'rows', 'MB/s')]
+        for stage,(calls,seconds,bytes_in,bytes_out,rows) in stages:
+            rate = ''
+            if bytes_in and seconds:
+                rate = '%.1f' % (bytes_in / seconds / 1e6)
+            lines.append('%-12s %7d %9.4f %6.1f %12d %12d %8d %8s' %
+              (stage, calls, seconds, 100.0 * seconds / (total or 1),
+               bytes_in, bytes_out, rows, rate))
+        lines.append('%-12s %7s %9.4f' % ('total', '', total))
+        return '\n'.join(lines) + '\n'
+
+# The stats objects of the ``with`` statements being run, innermost
+# last.
+_active_stats = []
+
+def _current_stats():
+    """The :class:`Stats` object of the innermost ``with`` statement,
+    or ``None``."""
+
+    if _active_stats:
+        return _active_stats[-1]
+    return None
+
 class Writer:
     """
     PNG encoder in pure Python.
@@ -340,7 +559,16 @@ class Writer:
                  chunk_limit=2**20,
                  x_pixels_per_unit = None,
                  y_pixels_per_unit = None,
-                 unit_is_meter = False):
+                 unit_is_meter = False,
+                 optimize=False,
+                 strategy=None,
+                 window_bits=None,
+                 mem_level=None,
+                 filter_type=None,
+                 preset=None,
+                 context=None,
+                 idat_size=None,
+                 stats=None):
         """
         Create a PNG encoder object.
 
@@ -370,7 +598,7 @@ class Writer:
         interlace
           Create an interlaced image.
         chunk_limit
-          Write multiple ``IDAT`` chunks to save memory.
+          Size of the filtered data buffered before it is compressed.
         x_pixels_per_unit
           Number of pixels a unit along the x axis (write a
           `pHYs` chunk).
@@ -381,6 +609,26 @@ class Writer:
         unit_is_meter
           `True` to indicate that the unit (for the `pHYs`
           chunk) is metre.
+        optimize
+          Pick the smallest colour type and bit depth for the pixels.
+        strategy
+          zlib compression strategy: 'default', 'filtered',
+          'huffman', 'rle', or 'fixed' (or a ``zlib.Z_*`` constant).
+        window_bits
+          zlib window size, as a power of 2: 9 to 15 (the default).
+        mem_level
+          zlib memory level: 1 to 9; default 8.
+        filter_type
+          PNG filter type for every row: 0 (None, the default),
+          1 (Sub), 2 (Up), 3 (Average), or 4 (Paeth).
+        preset
+          Name of a set of defaults for the above options: 'fast'.
+        context
+          A :class:`CodecContext` that supplies the zlib settings.
+        idat_size
+          Size of the ``IDAT`` chunks written.
+        stats
+          A :class:`Stats` object that records where the time goes.
 
         The image size (in pixels) can be specified either by using the
         `width` and `height` arguments, or with the single `size`
@@ -468,8 +716,60 @@ class Writer:
           to be processed in working memory.
 
         `chunk_limit` is used to limit the amount of memory used whilst
-        compressing the image.  In order to avoid using large amounts of
-        memory, multiple ``IDAT`` chunks may be created.
+        compressing the image: the filtered rows are collected until
+        there are more than `chunk_limit` bytes, and then given to zlib.
+
+        `idat_size` is the size of the ``IDAT`` chunks.  The compressed
+        data is collected and written as chunks of exactly `idat_size`
+        bytes (except the last, which may be smaller).  When it is
+        ``None`` (the default) a chunk is written for whatever zlib
+        returns each time `chunk_limit` bytes are compressed.  Either
+        way, chunks are written from views of the compressed data,
+        without joining or copying it.
+
+        The `strategy`, `window_bits`, and `mem_level` arguments are
+        passed to ``zlib.compressobj`` and tune the compression.
+        `strategy` can be 'filtered' (for filtered data with small
+        values, which deflate then compresses with fewer string
+        matches), 'huffman' (no string matches at all), 'rle' (only
+        matches with the previous byte, which is very quick), or
+        'fixed' (no dynamic Huffman codes).  A smaller `window_bits`
+        or `mem_level` uses less memory, usually at some cost in
+        size.
+
+        `filter_type` selects the PNG filter applied to each row
+        before compression (see :func:`filter_scanline`).  Filtering
+        generally makes photographic images smaller; the Sub and Up
+        filters are much quicker than Average and Paeth.
+
+        `preset` names a set of defaults for `compression`,
+        `strategy`, `window_bits`, `mem_level`, and `filter_type`;
+        arguments that are given explicitly override them.  The
+        'fast' preset (zlib level 1, the 'rle' strategy, and the Sub
+        filter) is for realtime encoding, such as camera frames,
+        where speed matters more than size.
+
+        `context` is a :class:`CodecContext` that supplies the zlib
+        settings (it replaces the `compression`, `strategy`,
+        `window_bits`, and `mem_level` arguments, which must then not
+        be given).  Sharing one context between many writers (and
+        readers) saves checking the same settings for each image.
+
+        If `optimize` is true then the :meth:`write` and
+        :meth:`write_array` methods first examine the pixels (see
+        :meth:`optimized`) and write the image using the smallest PNG
+        colour type and bit depth that represents them exactly: a
+        colour image that uses at most 256 colours is written with a
+        palette, a colour image whose pixels are all grey is written
+        as greyscale, an alpha channel that is everywhere opaque is
+        dropped, and the bit depth is reduced when the values allow
+        it.  The other arguments describe the pixels as they are
+        supplied.
+
+        .. note ::
+
+          Enabling the `optimize` option requires the entire image
+          to be processed in working memory.
         """
 
         # At the moment the `planes` argument is ignored;
@@ -493,9 +793,33 @@ class Writer:
             raise ValueError(
                 "transparent colour not allowed with alpha channel")
 
+        if preset is not None:
+            if preset not in _presets:
+                raise ValueError("preset (%r) must be one of %s" %
+                  (preset, ', '.join(sorted(_presets))))
+            defaults = _presets[preset]
+            if filter_type is None:
+                filter_type = defaults.get('filter_type')
+        else:
+            defaults = {}
+        zlib_options = (compression, strategy, window_bits, mem_level)
+        if context is None:
+            zlib_options = [defaults.get(name) if v is None else v
+              for name,v in zip(CodecContext.options, zlib_options)]
+            if zlib_options == [None]*4:
+                context = _default_context
+            else:
+                context = CodecContext(*zlib_options)
+        elif zlib_options != (None,)*4:
+            raise ValueError("zlib options not allowed with context")
+        del zlib_options
+        if filter_type is not None and filter_type not in range(5):
+            raise ValueError("filter_type (%r) must be from 0 to 4" %
+              filter_type)
+
         if bytes_per_sample is not None:
-            warnings.warn('please use bitdepth instead of bytes_per_sample',
-                          DeprecationWarning)
+            _warn('please use bitdepth instead of bytes_per_sample',
+                  DeprecationWarning)
             if bytes_per_sample not in (0.125, 0.25, 0.5, 1, 2):
                 raise ValueError(
                     "bytes per sample must be .125, .25, .5, 1, or 2")
@@ -561,13 +885,25 @@ class Writer:
         self.alpha = bool(alpha)
         self.colormap = bool(palette)
         self.bitdepth = int(bitdepth)
-        self.compression = compression
+        self.context = context
+        self.stats = stats or _current_stats()
+        self.compression = context.compression
         self.chunk_limit = chunk_limit
+        if idat_size is not None and not (isinteger(idat_size) and
+          0 < idat_size < 2**31):
+            raise ValueError("idat_size (%r) must be from 1 to 2**31-1" %
+              idat_size)
+        self.idat_size = idat_size
         self.interlace = bool(interlace)
         self.palette = palette
         self.x_pixels_per_unit = x_pixels_per_unit
         self.y_pixels_per_unit = y_pixels_per_unit
         self.unit_is_meter = bool(unit_is_meter)
+        self.optimize = bool(optimize)
+        self.strategy = context.strategy
+        self.window_bits = context.window_bits
+        self.mem_level = context.mem_level
+        self.filter_type = filter_type or 0
 
         self.color_type = 4*self.alpha + 2*(not greyscale) + 1*self.colormap
         assert self.color_type in (0,2,3,4,6)
@@ -612,16 +948,126 @@ class Writer:
           memory.
         """
 
+        if self.optimize:
+            writer,rows = self.optimized(rows)
+            if writer is not self:
+                return writer.write(outfile, rows)
+
         if self.interlace:
             fmt = 'BH'[self.bitdepth > 8]
             a = array(fmt, itertools.chain(*rows))
             return self.write_array(outfile, a)
 
-        nrows = self.write_passes(outfile, rows)
-        if nrows != self.height:
-            raise ValueError(
-              "rows supplied (%d) does not match height (%d)" %
-              (nrows, self.height))
+        self.write_passes(outfile, rows)
+
+    def optimized(self, rows):
+        """Examine the pixels in `rows` and return a pair (*writer*,
+        *rows*): a :class:`Writer` that uses the smallest PNG colour
+        type and bit depth that represents the pixels exactly, and
+        the rows converted to suit it.  `rows` should be in boxed row
+        flat pixel format, as for :meth:`write`.  The other settings
+        (gamma, compression, interlacing, and so on) are copied from
+        this writer.  This is what :meth:`write` does when the
+        `optimize` option is set.
+
+        Colour mapped images and images that are rescaled (with an
+        ``sBIT`` chunk) are returned as they are.  The `transparent`
+        and `background` colours are kept, which prevents a palette
+        from being used and can prevent the other reductions.
+        """
+
+        rows = list(rows)
+        if self.palette or self.rescale:
+            return self, rows
+
+        planes = self.planes
+        typecode = 'BH'[self.bitdepth > 8]
+        a = analyse(rows, planes, self.bitdepth)
+        alpha = a['alpha']
+        colours = [c for c in (self.transparent, self.background)
+                   if c is not None]
+        greyscale = self.greyscale or (a['greyscale'] and
+          not [c for c in colours if not c[0] == c[1] == c[2]])
+        bitdepth = a['bitdepth']
+        if alpha or not greyscale:
+            bitdepth = (8,16)[bitdepth > 8]
+        divisor = (2**self.bitdepth-1) // (2**bitdepth-1)
+        if [v for c in colours for v in c if v % divisor]:
+            bitdepth,divisor = self.bitdepth,1
+
+        # The channels kept from the source pixels.
+        channels = list(range((3,1)[greyscale]))
+        if alpha:
+            channels.append(planes-1)
+
+        palette = None
+        if ((alpha or not greyscale) and bitdepth == 8 and
+          not colours and a['palette'] is not None):
+            # Palette entries are 8-bit RGB or RGBA; those with alpha
+            # must come first.
+            entries = []
+            for c in a['palette']:
+                entry = tuple(c[i] // divisor for i in channels)
+                if greyscale:
+                    entry = entry[:1]*3 + entry[1:]
+                if len(entry) == 4 and entry[3] == 255:
+                    entry = entry[:3]
+                entries.append((entry, c))
+            entries.sort(key=lambda e: len(e[0]), reverse=True)
+            palette = [e for e,_ in entries]
+            pack,_ = _colour_packer(planes, self.bitdepth)
+            index = dict((pack(array(typecode, c))[0], i)
+                         for i,(_,c) in enumerate(entries))
+            bitdepth = 8
+            for b in (1,2,4):
+                if len(palette) <= 2**b:
+                    bitdepth = b
+                    break
+
+        if palette:
+            def convert(row):
+                return array('B', map(index.__getitem__, pack(row)))
+        else:
+            n = len(channels)
+            table = [v // divisor for v in range(2**self.bitdepth)]
+            def convert(row):
+                if n < planes:
+                    out = array(typecode, [0]) * (len(row)//planes * n)
+                    for i,c in enumerate(channels):
+                        out[i::n] = row[c::planes]
+                    row = out
+                if divisor > 1:
+                    row = array('BH'[bitdepth > 8],
+                                map(table.__getitem__, row))
+                return row
+
+        def reduced(c):
+            if c is None:
+                return None
+            return tuple(v // divisor for v in c[:len(channels)])
+
+        writer = Writer(self.width, self.height,
+                        greyscale=greyscale and not palette,
+                        alpha=alpha and not palette,
+                        bitdepth=bitdepth,
+                        palette=palette,
+                        transparent=reduced(self.transparent),
+                        background=reduced(self.background),
+                        gamma=self.gamma,
+                        context=self.context,
+                        filter_type=self.filter_type,
+                        interlace=self.interlace,
+                        chunk_limit=self.chunk_limit,
+                        idat_size=self.idat_size,
+                        x_pixels_per_unit=self.x_pixels_per_unit,
+                        y_pixels_per_unit=self.y_pixels_per_unit,
+                        unit_is_meter=self.unit_is_meter,
+                        stats=self.stats)
+        for i,row in enumerate(rows):
+            if not (isarray(row) and row.typecode == typecode):
+                row = array(typecode, map(int, row))
+            rows[i] = convert(row)
+        return writer, rows
 
     def write_passes(self, outfile, rows, packed=False):
         """
@@ -642,159 +1088,38 @@ class Writer:
         sequence of bytes.
         """
 
-        # http://www.w3.org/TR/PNG/#5PNG-file-signature
-        outfile.write(_signature)
-
-        # http://www.w3.org/TR/PNG/#11IHDR
-        write_chunk(outfile, b'IHDR',
-                    struct.pack("!2I5B", self.width, self.height,
-                                self.bitdepth, self.color_type,
-                                0, 0, self.interlace))
-
-        # See :chunk:order
-        # http://www.w3.org/TR/PNG/#11gAMA
-        if self.gamma is not None:
-            write_chunk(outfile, b'gAMA',
-                        struct.pack("!L", int(round(self.gamma*1e5))))
-
-        # See :chunk:order
-        # http://www.w3.org/TR/PNG/#11sBIT
-        if self.rescale:
-            write_chunk(outfile, b'sBIT',
-                struct.pack('%dB' % self.planes,
-                            *[self.rescale[0]]*self.planes))
-        
-        # :chunk:order: Without a palette (PLTE chunk), ordering is
-        # relatively relaxed.  With one, gAMA chunk must precede PLTE
-        # chunk which must precede tRNS and bKGD.
-        # See http://www.w3.org/TR/PNG/#5ChunkOrdering
-        if self.palette:
-            p,t = self.make_palette()
-            write_chunk(outfile, b'PLTE', p)
-            if t:
-                # tRNS chunk is optional. Only needed if palette entries
-                # have alpha.
-                write_chunk(outfile, b'tRNS', t)
-
-        # http://www.w3.org/TR/PNG/#11tRNS
-        if self.transparent is not None:
-            if self.greyscale:
-                write_chunk(outfile, b'tRNS',
-                            struct.pack("!1H", *self.transparent))
-            else:
-                write_chunk(outfile, b'tRNS',
-                            struct.pack("!3H", *self.transparent))
-
-        # http://www.w3.org/TR/PNG/#11bKGD
-        if self.background is not None:
-            if self.greyscale:
-                write_chunk(outfile, b'bKGD',
-                            struct.pack("!1H", *self.background))
-            else:
-                write_chunk(outfile, b'bKGD',
-                            struct.pack("!3H", *self.background))
-
-        # http://www.w3.org/TR/PNG/#11pHYs
-        if self.x_pixels_per_unit is not None and self.y_pixels_per_unit is not None:
-            tup = (self.x_pixels_per_unit, self.y_pixels_per_unit, int(self.unit_is_meter))
-            write_chunk(outfile, b'pHYs', struct.pack("!LLB",*tup))
+        stream = StreamWriter(self, outfile, packed)
+        stream.open()
+        write_row = stream.write_row
+        for row in rows:
+            write_row(row)
+        return stream.close()
+
+    def compressobj(self):
+        """Return a ``zlib`` compression object for the ``IDAT``
+        data, set up with the writer's `compression`, `strategy`,
+        `window_bits`, and `mem_level` options (see
+        :meth:`CodecContext.compressobj`).
+        """
 
-        # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
-            compressor = zlib.compressobj(self.compression)
-        else:
-            compressor = zlib.compressobj()
+        return self.context.compressobj()
 
-        # Choose an extend function based on the bitdepth.  The extend
-        # function packs/decomposes the pixel values into bytes and
-        # stuffs them onto the data array.
-        data = array('B')
-        if self.bitdepth == 8 or packed:
-            extend = data.extend
-        elif self.bitdepth == 16:
-            # Decompose into bytes
-            def extend(sl):
-                fmt = '!%dH' % len(sl)
-                data.extend(array('B', struct.pack(fmt, *sl)))
-        else:
-            # Pack into bytes
-            assert self.bitdepth < 8
-            # samples per byte
-            spb = int(8/self.bitdepth)
-            def extend(sl):
-                a = array('B', sl)
-                # Adding padding bytes so we can group into a whole
-                # number of spb-tuples.
-                l = float(len(a))
-                extra = math.ceil(l / float(spb))*spb - l
-                a.extend([0]*int(extra))
-                # Pack into bytes
-                l = group(a, spb)
-                l = [reduce(lambda x,y:
-                                           (x << self.bitdepth) + y, e) for e in l]
-                data.extend(l)
-        if self.rescale:
-            oldextend = extend
-            factor = \
-              float(2**self.rescale[1]-1) / float(2**self.rescale[0]-1)
-            def extend(sl):
-                oldextend([int(round(factor*x)) for x in sl])
-
-        # Build the first row, testing mostly to see if we need to
-        # changed the extend function to cope with NumPy integer types
-        # (they cause our ordinary definition of extend to fail, so we
-        # wrap it).  See
-        # http://code.google.com/p/pypng/issues/detail?id=44
-        enumrows = enumerate(rows)
-        del rows
+    def pass_starts(self):
+        """Return the indexes of the rows, in the order they appear in
+        the file, that start each reduced image of an interlaced image.
+        For a straightlaced image, this is just ``[0]``.
+        """
 
-        # First row's filter type.
-        data.append(0)
-        # :todo: Certain exceptions in the call to ``.next()`` or the
-        # following try would indicate no row data supplied.
-        # Should catch.
-        i,row = next(enumrows)
-        try:
-            # If this fails...
-            extend(row)
-        except:
-            # ... try a version that converts the values to int first.
-            # Not only does this work for the (slightly broken) NumPy
-            # types, there are probably lots of other, unknown, "nearly"
-            # int types it works for.
-            def wrapmapint(f):
-                return lambda sl: f([int(x) for x in sl])
-            extend = wrapmapint(extend)
-            del wrapmapint
-            extend(row)
-
-        for i,row in enumrows:
-            # Add "None" filter type.  Currently, it's essential that
-            # this filter type be used for every scanline as we do not
-            # mark the first row of a reduced pass image; that means we
-            # could accidentally compute the wrong filtered scanline if
-            # we used "up", "average", or "paeth" on such a line.
-            data.append(0)
-            extend(row)
-            if len(data) > self.chunk_limit:
-                compressed = compressor.compress(tostring(data))
-                if len(compressed):
-                    write_chunk(outfile, b'IDAT', compressed)
-                # Because of our very witty definition of ``extend``,
-                # above, we must re-use the same ``data`` object.  Hence
-                # we use ``del`` to empty this one, rather than create a
-                # fresh one (which would be my natural FP instinct).
-                del data[:]
-        if len(data):
-            compressed = compressor.compress(tostring(data))
-        else:
-            compressed = b''
-        flushed = compressor.flush()
-        if len(compressed) or len(flushed):
-            write_chunk(outfile, b'IDAT', compressed + flushed)
-        # http://www.w3.org/TR/PNG/#11IEND
-        write_chunk(outfile, b'IEND')
-        return i+1
+        if not self.interlace:
+            return [0]
+        starts = []
+        row = 0
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width or ystart >= self.height:
+                continue
+            starts.append(row)
+            row += int(math.ceil((self.height-ystart)/float(ystep)))
+        return starts
 
     def write_array(self, outfile, pixels):
         """
@@ -802,11 +1127,171 @@ class Writer:
         the output file.  See also :meth:`write` method.
         """
 
+        if self.optimize:
+            return self.write(outfile, self.array_scanlines(pixels))
         if self.interlace:
             self.write_passes(outfile, self.array_scanlines_interlace(pixels))
         else:
             self.write_passes(outfile, self.array_scanlines(pixels))
 
+    def write_animation(self, outfile, frames, num_frames=None,
+                        delay=(1, 30), num_plays=0, delta=True):
+        """
+        Write an animated PNG (APNG) file to the output file.
+        `frames` is an iterable that yields each frame of the
+        animation.  Each frame is either an iterable that yields each
+        row in boxed row flat pixel format (as for :meth:`write`) or,
+        for bit depths of 8 or less, a string of bytes (``bytes`` or
+        ``bytearray``) that holds the whole frame in flat row flat
+        pixel format (such as an image from a camera).  When `frames`
+        has no length, `num_frames` must be given.
+
+        Each frame is shown for `delay` seconds, given as a
+        (*numerator*, *denominator*) pair, and the animation is
+        played `num_plays` times (0 means forever).
+
+        When `delta` is true, each frame after the first is compared
+        with the frame before it, and only the smallest rectangle that
+        holds all the pixels that changed is written.  For a mostly
+        still scene, this is much faster and makes a much smaller file.
+
+        The first frame is also the image that decoders that do not
+        support APNG show.  The `optimize` option is ignored.  Returns
+        the number of frames written.
+
+        See https://wiki.mozilla.org/APNG_Specification
+        """
+
+        if num_frames is None:
+            num_frames = len(frames)
+        sequence = itertools.count()
+        stream = StreamWriter(self, outfile)
+        stream._header()
+        write_chunk(outfile, b'acTL',
+                    struct.pack('!2I', num_frames, num_plays))
+        previous = None
+        count = 0
+        for frame in frames:
+            if count >= num_frames:
+                raise ValueError(
+                  "frames supplied (%d) does not match num_frames (%d)" %
+                  (count+1, num_frames))
+            frame = self._frame_rows(frame)
+            x,y,width,height = 0,0,self.width,self.height
+            rows = frame
+            if previous is not None:
+                rect = self._delta(previous, frame)
+                if rect is None:
+                    # Nothing changed: write one pixel, since a frame
+                    # cannot be empty.
+                    rect = 0,0,1,1
+                x,y,width,height = rect
+                rows = [row[x*self.planes:(x+width)*self.planes]
+                        for row in frame[y:y+height]]
+            # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
+            # Dispose op "none" and blend op "source": the rectangle
+            # replaces that part of the previous frame.
+            write_chunk(outfile, b'fcTL',
+                        struct.pack('!5I2H2B', next(sequence),
+                                    width, height, x, y,
+                                    delay[0], delay[1], 0, 0))
+            if count:
+                import copy
+                writer = copy.copy(self)
+                writer.width = width
+                writer.height = height
+                stream = StreamWriter(writer, outfile)
+                stream._begin(_IDATWriter(outfile, self.idat_size,
+                                          sequence))
+            else:
+                writer = self
+                stream._begin(_IDATWriter(outfile, self.idat_size))
+            if self.interlace:
+                a = array('BH'[self.bitdepth > 8], itertools.chain(*rows))
+                rows = writer.array_scanlines_interlace(a)
+            for row in rows:
+                stream.write_row(row)
+            stream._end()
+            if delta:
+                previous = frame
+            count += 1
+        if count != num_frames:
+            raise ValueError(
+              "frames supplied (%d) does not match num_frames (%d)" %
+              (count, num_frames))
+        # http://www.w3.org/TR/PNG/#11IEND
+        write_chunk(outfile, b'IEND')
+        return count
+
+    def _frame_rows(self, frame):
+        """Return the frame `frame` of an animation (see
+        :meth:`write_animation`) as a list of rows, each an array.
+        """
+
+        typecode = 'BH'[self.bitdepth > 8]
+        vpr = self.width * self.planes
+        if isinstance(frame, (bytes, bytearray)):
+            if self.bitdepth > 8:
+                raise ValueError(
+                  "frames must be rows, not bytes, for bit depth %d" %
+                  self.bitdepth)
+            a = array('B', frame)
+            if len(a) != vpr * self.height:
+                raise ValueError(
+                  "frame length (%d) does not match size (%d)" %
+                  (len(a), vpr * self.height))
+            rows = [a[i:i+vpr] for i in range(0, len(a), vpr)]
+        else:
+            rows = [row if isarray(row) and row.typecode == typecode
+                    else array(typecode, map(int, row))
+                    for row in frame]
+            if len(rows) != self.height:
+                raise ValueError(
+                  "rows supplied (%d) does not match height (%d)" %
+                  (len(rows), self.height))
+        return rows
+
+    def _delta(self, previous, rows):
+        """Compare two frames, each a list of arrays, and return the
+        smallest rectangle that holds all the pixels that differ, as
+        (*x*, *y*, *width*, *height*), or ``None`` when the frames are
+        the same.
+        """
+
+        changed = [i for i,(a,b) in enumerate(zip(previous, rows))
+                   if a != b]
+        if not changed:
+            return None
+        vpr = self.width * self.planes
+        # The changed values are in the columns from left to right
+        # (excluding right).  Each bound is found by a binary search,
+        # comparing slices (which is much faster than comparing
+        # values one at a time).
+        left,right = vpr,0
+        for i in changed:
+            a,b = previous[i],rows[i]
+            if a[:left] != b[:left]:
+                lo,hi = 0,left-1
+                while lo < hi:
+                    mid = (lo+hi) // 2
+                    if a[:mid+1] != b[:mid+1]:
+                        hi = mid
+                    else:
+                        lo = mid+1
+                left = lo
+            if a[right:] != b[right:]:
+                lo,hi = right,vpr-1
+                while lo < hi:
+                    mid = (lo+hi+1) // 2
+                    if a[mid:] != b[mid:]:
+                        lo = mid
+                    else:
+                        hi = mid-1
+                right = lo+1
+        x = left // self.planes
+        width = (right-1) // self.planes + 1 - x
+        return x, changed[0], width, changed[-1] + 1 - changed[0]
+
     def write_packed(self, outfile, rows):
         """
         Write PNG file to `outfile`.  The pixel data comes from `rows`
@@ -834,6 +1319,8 @@ class Writer:
         (binary) PGM, PPM, and PAM formats.
         """
 
+        if self.optimize:
+            return self.write(outfile, self.file_scanlines(infile))
         if self.interlace:
             pixels = array('B')
             pixels.fromfile(infile,
@@ -859,6 +1346,8 @@ class Writer:
         pixels = interleave_planes(pixels, apixels,
                                    (self.bitdepth/8) * self.color_planes,
                                    (self.bitdepth/8))
+        if self.optimize:
+            return self.write_array(outfile, pixels)
         if self.interlace:
             self.write_passes(outfile, self.array_scanlines_interlace(pixels))
         else:
@@ -943,17 +1432,30 @@ class Writer:
 def write_chunk(outfile, tag, data=b''):
     """
     Write a PNG chunk to the output file, including length and
-    checksum.
+    checksum.  `data` is a string of bytes (or an object, such as a
+    ``memoryview``, that supports the buffer interface with 1 byte
+    items), or a list of them that make up the chunk data.  They are
+    written one after another, with the ``writelines`` method of the
+    output file when it has one, and are never joined together.
     """
 
     # http://www.w3.org/TR/PNG/#5Chunk-layout
-    outfile.write(struct.pack("!I", len(data)))
-    outfile.write(tag)
-    outfile.write(data)
+    if not isinstance(data, list):
+        data = [data]
     checksum = zlib.crc32(tag)
-    checksum = zlib.crc32(data, checksum)
+    length = 0
+    for part in data:
+        checksum = zlib.crc32(part, checksum)
+        length += len(part)
     checksum &= 2**32-1
-    outfile.write(struct.pack("!I", checksum))
+    parts = ([struct.pack("!I", length) + tag] + data +
+             [struct.pack("!I", checksum)])
+    writelines = getattr(outfile, 'writelines', None)
+    if writelines:
+        writelines(parts)
+    else:
+        for part in parts:
+            outfile.write(part)
 
 def write_chunks(out, chunks):
     """Create a PNG file by writing out the chunks."""
@@ -962,6 +1464,429 @@ def write_chunks(out, chunks):
     for chunk in chunks:
         write_chunk(out, *chunk)
 
+def aencode(writer, stream, rows, executor=None, buffers=8):
+    """Return a coroutine that writes a PNG image to the
+    :class:`asyncio.StreamWriter` `stream`, using the :class:`Writer`
+    `writer` and the pixels `rows` (as for :meth:`Writer.write`).  The
+    filtering and compression are done in `executor` (by default, the
+    event loop's default executor), and the chunks are written to the
+    stream as they are produced.  Cancelling the coroutine stops the
+    encoder.  At most `buffers` pieces of output are held waiting
+    for the stream.  See :mod:`pngasync`.  Requires Python 3.5 or
+    later.
+    """
+
+    import pngasync
+    return pngasync.aencode(writer, stream, rows, executor, buffers)
+
+def decode_many(paths, workers=None, as_ndarray=True, ordered=True,
+                method='asDirect'):
+    """Decode the PNG files named in `paths` using a pool of
+    `workers` processes (default: one per CPU).  Returns an iterator
+    that yields (*path*, *width*, *height*, *pixels*, *metadata*) for
+    each file, in the order of `paths` when `ordered` is true, and
+    otherwise as each file is decoded.  Each file is decoded with the
+    :class:`Reader` method named by `method`.  When `as_ndarray` is
+    true (NumPy is then required), *pixels* is a NumPy array with the
+    shape (*height*, *width*, *planes*); otherwise it is a list of
+    rows.  The pixels are passed back from the workers in shared
+    memory, where Python supports it.  See :mod:`pngpool`.
+    """
+
+    import pngpool
+    return pngpool.decode_many(paths, workers, as_ndarray, ordered, method)
+
+class _IDATWriter:
+    """
+    Write compressed image data to a file as ``IDAT`` chunks.  When
+    `size` is ``None`` each call to :meth:`write` writes one chunk;
+    otherwise the data is collected and written in chunks of exactly
+    `size` bytes, each made of views of the collected strings (so the
+    data is neither joined nor copied).  :meth:`close` writes whatever
+    is left.
+
+    When `sequence` is given, the chunks are APNG ``fdAT`` chunks
+    instead, and `sequence` is an iterator that gives their sequence
+    numbers.
+    """
+
+    def __init__(self, outfile, size=None, sequence=None):
+        self.outfile = outfile
+        self.size = size
+        self.sequence = sequence
+        # The strings (or views) waiting to be written, and their
+        # total length.
+        self.pending = []
+        self.length = 0
+
+    def write(self, *data):
+        """Add the compressed strings `data`."""
+
+        data = [s for s in data if len(s)]
+        if not data:
+            return
+        if self.size is None:
+            self.write_chunk(data)
+            return
+        self.pending.extend(data)
+        self.length += sum(map(len, data))
+        while self.length >= self.size:
+            self.chunk(self.size)
+
+    def close(self):
+        if self.length:
+            self.chunk(self.length)
+
+    def chunk(self, n):
+        """Write a chunk of the first `n` bytes waiting."""
+
+        self.length -= n
+        parts = []
+        while n:
+            s = self.pending[0]
+            if len(s) <= n:
+                parts.append(s)
+                del self.pending[0]
+                n -= len(s)
+            else:
+                parts.append(_view(s, 0, n))
+                self.pending[0] = _view(s, n, len(s))
+                n = 0
+        self.write_chunk(parts)
+
+    def write_chunk(self, parts):
+        if self.sequence is None:
+            write_chunk(self.outfile, b'IDAT', parts)
+        else:
+            # https://wiki.mozilla.org/APNG_Specification#.60fdAT.60:_The_Frame_Data_Chunk
+            write_chunk(self.outfile, b'fdAT',
+                        [struct.pack('!I', next(self.sequence))] + parts)
+
+class StreamWriter:
+    """
+    Write a PNG image one row at a time, as the rows become available,
+    rather than from an iterable of all the rows (as
+    :meth:`Writer.write` does).  The ``IDAT`` chunks are written to
+    the output file as the compressed data is produced, so memory use
+    does not depend on the size of the image, and the start of the
+    file is written before the last row is known.
+
+    Call :meth:`open`, then :meth:`write_row` or :meth:`write_rows`
+    for the rows in order, then :meth:`close`.  The stream writer can
+    also be used in a ``with`` statement, which opens it and, unless
+    an exception is raised, closes it.
+    """
+
+    def __init__(self, writer, outfile, packed=False):
+        """
+        Create a stream writer that writes a PNG image to `outfile`
+        using the settings of the :class:`Writer` `writer` (its
+        `optimize` option is ignored).  When `packed` is ``False``
+        the rows should be in boxed row flat pixel format; when
+        `packed` is ``True`` each row should be a packed sequence of
+        bytes.  For an interlaced image the rows must already be
+        interlaced, and are given in the order that they appear in
+        the file (see :meth:`Writer.write_passes`).
+        """
+
+        self.writer = writer
+        self.outfile = outfile
+        self.packed = packed
+        self.stats = writer.stats
+        # Rows written so far, or None before :meth:`open`.
+        self.rows = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def open(self):
+        """Write the PNG signature and the chunks that come before the
+        image data."""
+
+        self._header()
+        self._begin(_IDATWriter(self.outfile, self.writer.idat_size))
+
+    def _header(self):
+        """Write the PNG signature and the chunks that come before the
+        image data."""
+
+        writer = self.writer
+        outfile = self.outfile
+
+        # http://www.w3.org/TR/PNG/#5PNG-file-signature
+        outfile.write(_signature)
+
+        # http://www.w3.org/TR/PNG/#11IHDR
+        write_chunk(outfile, b'IHDR',
+                    struct.pack("!2I5B", writer.width, writer.height,
+                                writer.bitdepth, writer.color_type,
+                                0, 0, writer.interlace))
+
+        # See :chunk:order
+        # http://www.w3.org/TR/PNG/#11gAMA
+        if writer.gamma is not None:
+            write_chunk(outfile, b'gAMA',
+                        struct.pack("!L", int(round(writer.gamma*1e5))))
+
+        # See :chunk:order
+        # http://www.w3.org/TR/PNG/#11sBIT
+        if writer.rescale:
+            write_chunk(outfile, b'sBIT',
+                struct.pack('%dB' % writer.planes,
+                            *[writer.rescale[0]]*writer.planes))
+        
+        # :chunk:order: Without a palette (PLTE chunk), ordering is
+        # relatively relaxed.  With one, gAMA chunk must precede PLTE
+        # chunk which must precede tRNS and bKGD.
+        # See http://www.w3.org/TR/PNG/#5ChunkOrdering
+        if writer.palette:
+            p,t = writer.make_palette()
+            write_chunk(outfile, b'PLTE', p)
+            if t:
+                # tRNS chunk is optional. Only needed if palette entries
+                # have alpha.
+                write_chunk(outfile, b'tRNS', t)
+
+        # http://www.w3.org/TR/PNG/#11tRNS
+        if writer.transparent is not None:
+            if writer.greyscale:
+                write_chunk(outfile, b'tRNS',
+                            struct.pack("!1H", *writer.transparent))
+            else:
+                write_chunk(outfile, b'tRNS',
+                            struct.pack("!3H", *writer.transparent))
+
+        # http://www.w3.org/TR/PNG/#11bKGD
+        if writer.background is not None:
+            if writer.greyscale:
+                write_chunk(outfile, b'bKGD',
+                            struct.pack("!1H", *writer.background))
+            else:
+                write_chunk(outfile, b'bKGD',
+                            struct.pack("!3H", *writer.background))
+
+        # http://www.w3.org/TR/PNG/#11pHYs
+        if writer.x_pixels_per_unit is not None and writer.y_pixels_per_unit is not None:
+            tup = (writer.x_pixels_per_unit, writer.y_pixels_per_unit, int(writer.unit_is_meter))
+            write_chunk(outfile, b'pHYs', struct.pack("!LLB",*tup))
+
+    def _begin(self, idat):
+        """Start the image data, which is written using the
+        :class:`_IDATWriter` `idat`."""
+
+        writer = self.writer
+        # http://www.w3.org/TR/PNG/#11IDAT
+        self.compressor = writer.compressobj()
+        self.idat = idat
+
+        # Choose an extend function based on the bitdepth.  The extend
+        # function packs/decomposes the pixel values into bytes and
+        # stuffs them onto the data array.
+        self.data = data = array('B')
+        if writer.bitdepth == 8 or self.packed:
+            extend = data.extend
+        elif writer.bitdepth == 16:
+            # Decompose into bytes
+            def extend(sl):
+                fmt = '!%dH' % len(sl)
+                data.extend(array('B', struct.pack(fmt, *sl)))
+        else:
+            # Pack into bytes
+            from functools import reduce
+            assert writer.bitdepth < 8
+            # samples per byte
+            spb = int(8/writer.bitdepth)
+            def extend(sl):
+                a = array('B', sl)
+                # Adding padding bytes so we can group into a whole
+                # number of spb-tuples.
+                l = float(len(a))
+                extra = math.ceil(l / float(spb))*spb - l
+                a.extend([0]*int(extra))
+                # Pack into bytes
+                l = group(a, spb)
+                l = [reduce(lambda x,y:
+                                           (x << writer.bitdepth) + y, e) for e in l]
+                data.extend(l)
+        if writer.rescale:
+            oldextend = extend
+            factor = \
+              float(2**writer.rescale[1]-1) / float(2**writer.rescale[0]-1)
+            def extend(sl):
+                oldextend([int(round(factor*x)) for x in sl])
+        self.extend = extend
+
+        # Filter offset: bytes per pixel, but at least 1.
+        self.fo = max(1, writer.bitdepth * writer.planes // 8)
+        # The rows that start a new reduced image (after which there
+        # is no previous row to filter against).
+        self.passes = set(writer.pass_starts())
+        # The number of rows in the file.
+        self.height = writer.height
+        if writer.interlace:
+            self.height = sum(
+              int(math.ceil((writer.height-ystart)/float(ystep)))
+              for xstart, ystart, xstep, ystep in _adam7
+              if xstart < writer.width and ystart < writer.height)
+        # The previous row, unfiltered, for filtering.
+        self.prev = None
+        self.rows = 0
+
+    def write_row(self, row):
+        """Write one row."""
+
+        if self.rows is None:
+            raise Error("stream writer is not open")
+        if self.rows >= self.height:
+            raise ValueError(
+              "rows supplied (%d) does not match height (%d)" %
+              (self.rows+1, self.height))
+        data = self.data
+        stats = self.stats
+        if stats:
+            t = _clock()
+        # Add "None" filter type; it is replaced when the row is
+        # filtered.  The first row of each reduced pass image is
+        # filtered as though it were the first row of the image
+        # (there is no previous row for "up", "average", or
+        # "paeth").
+        data.append(0)
+        start = len(data)
+        if self.rows:
+            self.extend(row)
+        else:
+            # Build the first row, testing mostly to see if we need
+            # to changed the extend function to cope with NumPy
+            # integer types (they cause our ordinary definition of
+            # extend to fail, so we wrap it).  See
+            # http://code.google.com/p/pypng/issues/detail?id=44
+            try:
+                # If this fails...
+                self.extend(row)
+            except:
+                # ... try a version that converts the values to int
+                # first.  Not only does this work for the (slightly
+                # broken) NumPy types, there are probably lots of
+                # other, unknown, "nearly" int types it works for.
+                del data[start:]
+                extend = self.extend
+                self.extend = lambda sl: extend([int(x) for x in sl])
+                self.extend(row)
+        filter_type = self.writer.filter_type
+        if stats:
+            t1 = _clock()
+            stats.add('pack', t1 - t, 0, len(data) - start, 1)
+        if filter_type:
+            if self.rows in self.passes:
+                self.prev = None
+            line = data[start:]
+            data[start-1:] = filter_scanline(filter_type, line, self.fo,
+                                             self.prev)
+            self.prev = line
+            if stats:
+                stats.add('filter', _clock() - t1, len(line),
+                          len(line) + 1, 1)
+        self.rows += 1
+        if len(data) > self.writer.chunk_limit:
+            self._deflate()
+
+    def write_rows(self, buf):
+        """Write one or more rows from `buf`, which holds them one
+        after another in flat row flat pixel format (or, when the
+        stream writer is `packed`, packed bytes).  For an image with
+        a bit depth of 8 or less (or `packed`), `buf` may be a
+        string of bytes, such as a frame from a camera.
+        """
+
+        writer = self.writer
+        if writer.bitdepth <= 8 or self.packed:
+            if isinstance(buf, (bytes, bytearray)):
+                buf = array('B', buf)
+        if self.packed:
+            n = (writer.width * writer.bitdepth * writer.planes + 7) // 8
+        else:
+            n = writer.width * writer.planes
+        if len(buf) % n:
+            raise ValueError(
+              "buffer length (%d) is not a whole number of rows (%d)" %
+              (len(buf), n))
+        write_row = self.write_row
+        for i in range(0, len(buf), n):
+            write_row(buf[i:i+n])
+
+    def flush(self):
+        """Write all the image data given so far, so that whoever
+        reads the file can decode the rows written so far, and flush
+        the output file (when it has a ``flush`` method).  This makes
+        the file a little larger, so should not be used for every
+        row.
+        """
+
+        self._deflate(zlib.Z_SYNC_FLUSH)
+        flush = getattr(self.outfile, 'flush', None)
+        if flush:
+            flush()
+
+    def close(self):
+        """Write the rest of the image data and the ``IEND`` chunk.
+        Returns the number of rows written.
+        """
+
+        rows = self._end()
+        # http://www.w3.org/TR/PNG/#11IEND
+        write_chunk(self.outfile, b'IEND')
+        return rows
+
+    def _end(self):
+        """Write the rest of the image data.  Returns the number of
+        rows written."""
+
+        if self.rows != self.height:
+            raise ValueError(
+              "rows supplied (%d) does not match height (%d)" %
+              (self.rows or 0, self.height))
+        self._deflate(zlib.Z_FINISH)
+        rows = self.rows
+        self.rows = None
+        return rows
+
+    def _deflate(self, mode=None):
+        """Compress the filtered data waiting, and write it.  When
+        `mode` is given, also flush the compressor with that mode
+        (``zlib.Z_SYNC_FLUSH`` or ``zlib.Z_FINISH``) and write all
+        the ``IDAT`` data.
+        """
+
+        data = self.data
+        stats = self.stats
+        if stats:
+            t = _clock()
+        compressed = []
+        if len(data):
+            # zlib reads the array in place.
+            compressed.append(self.compressor.compress(data))
+        if mode is not None:
+            compressed.append(self.compressor.flush(mode))
+        if stats:
+            t1 = _clock()
+            n = sum(map(len, compressed))
+            stats.add('deflate', t1 - t, len(data), n)
+        # Because of our very witty definition of ``extend``, above,
+        # we must re-use the same ``data`` object.  Hence we use
+        # ``del`` to empty this one, rather than create a fresh one
+        # (which would be my natural FP instinct).
+        del data[:]
+        self.idat.write(*compressed)
+        if mode is not None:
+            self.idat.close()
+        if stats:
+            stats.add('write', _clock() - t1, n)
+
 def filter_scanline(type, line, fo, prev=None):
     """Apply a scanline filter to a scanline.  `type` specifies the
     filter type (0 to 4); `line` specifies the current (unfiltered)
@@ -979,16 +1904,11 @@ def filter_scanline(type, line, fo, prev=None):
     out = array('B', [type])
 
     def sub():
-        ai = -fo
-        for x in line:
-            if ai >= 0:
-                x = (x - line[ai]) & 0xff
-            out.append(x)
-            ai += 1
+        x = _bytes_to_int(line)
+        out.extend(_bytewise_sub(x, x >> (8*fo), len(line)))
     def up():
-        for i,x in enumerate(line):
-            x = (x - prev[i]) & 0xff
-            out.append(x)
+        out.extend(_bytewise_sub(_bytes_to_int(line), _bytes_to_int(prev),
+                                 len(line)))
     def average():
         ai = -fo
         for i,x in enumerate(line):
@@ -1048,9 +1968,275 @@ def filter_scanline(type, line, fo, prev=None):
         paeth()
     return out
 
+# The Sub and Up filters subtract whole scanlines at once: the bytes of
+# each scanline are treated as one (big) integer, and the subtraction
+# is done so that no borrow crosses a byte boundary.
+
+def _bytes_to_int(s):
+    """Convert a sequence of bytes to a big-endian integer."""
+
+    if isarray(s):
+        s = tostring(s)
+    else:
+        s = bytes(bytearray(s))
+    return int(binascii.hexlify(s) or b'0', 16)
+
+def _bytewise_sub(x, y, n):
+    """Subtract (modulo 256) each byte of the `n`-byte integer `y`
+    from the corresponding byte of `x`, returning an array of the `n`
+    result bytes.
+    """
+
+    # Setting the top bit of each byte of x, and clearing it in y,
+    # stops any borrow; the top bits are then fixed up.
+    h = int('80'*n, 16)
+    z = ((x | h) - (y & ~h)) ^ ((x ^ ~y) & h)
+    return array('B', binascii.unhexlify('%0*x' % (2*n, z)))
 
-# Regex for decoding mode string
-RegexModeDecode = re.compile("(LA?|RGBA?);?([0-9]*)", flags=re.IGNORECASE)
+def _bytewise_add(x, y, n):
+    """Add (modulo 256) each byte of the `n`-byte integer `y` to the
+    corresponding byte of `x`, returning an array of the `n` result
+    bytes.
+    """
+
+    # Adding with the top bit of each byte clear cannot carry into the
+    # next byte; the top bits are then fixed up.
+    h = int('80'*n, 16)
+    z = ((x & ~h) + (y & ~h)) ^ ((x ^ y) & h)
+    return array('B', binascii.unhexlify('%0*x' % (2*n, z)))
+
+def _pipeline(iterable, depth):
+    """Iterator that yields the items of `iterable`, which are
+    produced by a separate thread.  At most `depth` items are waiting.
+    An exception raised by `iterable` is raised again by this
+    iterator; when this iterator is closed, the thread stops.
+    """
+
+    import threading
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    q = queue.Queue(depth)
+    stop = threading.Event()
+    # Marks the end of the items; and an exception from `iterable`.
+    end = object()
+    error = []
+
+    def put(item):
+        """Put `item` on the queue, unless stopped.  Returns false
+        when stopped."""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            error.append(e)
+        put(end)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is end:
+                break
+            yield item
+    finally:
+        stop.set()
+    thread.join()
+    if error:
+        raise error[0]
+
+# NumPy, when it can be imported (``False`` when it cannot, ``None``
+# until the first call to :func:`_numpy`).
+_numpy_module = None
+
+def _numpy():
+    """Import and return the ``numpy`` module, or ``False`` when it is
+    not installed.  It is only imported the first time it is needed.
+    """
+
+    global _numpy_module
+    if _numpy_module is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy_module = numpy
+    return _numpy_module
+
+def analyse(pixels, planes, bitdepth, maxcolours=256):
+    """Examine pixel data in a single pass and report the properties
+    that decide the smallest PNG colour type and bit depth that can
+    represent it exactly.  `pixels` should be an iterable that yields
+    each row in boxed row flat pixel format, each row having `planes`
+    channels with `bitdepth` bits per channel; greyscale, LA, RGB and
+    RGBA are told apart by `planes`, so palettes must already have
+    been expanded (for example, by :meth:`Reader.asDirect`).
+
+    Returns a dictionary with the following keys:
+
+    colours
+      The number of distinct colours (including alpha), or ``None``
+      if there are more than `maxcolours`.
+    palette
+      The distinct colours, as a sorted list of `planes`-tuples, or
+      ``None`` if there are more than `maxcolours`.
+    greyscale
+      ``True`` when every pixel is grey (R, G, and B equal), which is
+      always the case for greyscale images.
+    alpha
+      ``True`` when there is an alpha channel and some pixel is not
+      fully opaque.
+    bitdepth
+      The smallest bit depth (1, 2, 4, 8, or 16) that represents
+      every sample value exactly, when rescaled from `bitdepth`.
+      When `bitdepth` is not one of those (the pixels were reduced
+      by an ``sBIT`` chunk) and the values cannot be reduced
+      exactly, this is the next of them up from `bitdepth`.
+
+    `maxcolours` limits the number of distinct colours that are
+    collected; ``None`` means no limit.
+
+    Colours are collected as packed integer keys (several samples
+    packed into each array item), so that whole rows are added to the
+    set of colours at once.
+    """
+
+    maxval = 2**bitdepth - 1
+    typecode = 'BH'[bitdepth > 8]
+    pack,unpack = _colour_packer(planes, bitdepth)
+    colours = set()
+    if maxcolours == 0:
+        colours = None
+    greyscale = True
+    alpha = False
+    # The distinct sample values (or, for 16-bit samples, the distinct
+    # high bytes), while they are needed to decide the bit depth.
+    values = set()
+    # For 16-bit samples: True while every sample's high and low
+    # bytes are equal (the value could be stored as 8-bit).
+    replicated = bitdepth == 16
+    for row in pixels:
+        if not (isarray(row) and row.typecode == typecode):
+            row = array(typecode, map(int, row))
+        if colours is not None:
+            colours.update(pack(row))
+            if maxcolours is not None and len(colours) > maxcolours:
+                colours = None
+        if greyscale and planes >= 3:
+            greyscale = (row[0::planes] == row[1::planes] and
+                         row[0::planes] == row[2::planes])
+        if not alpha and planes in (2,4):
+            a = row[planes-1::planes]
+            alpha = a.count(maxval) != len(a)
+        if bitdepth == 16:
+            if replicated:
+                raw = tostring(row)
+                replicated = raw[0::2] == raw[1::2]
+                values.update(array('B', raw[0::2]))
+        else:
+            values.update(row)
+
+    if bitdepth == 16 and not replicated:
+        depth = 16
+    else:
+        # Check whether the values (at 8-bit, when 16-bit values are
+        # replicated) are all multiples of the value that a smaller
+        # bit depth scales to.
+        source = (bitdepth, 8)[bitdepth == 16]
+        sourcemax = 2**source - 1
+        depth = min(b for b in (1,2,4,8,16) if b >= source)
+        for b in (1,2,4,8):
+            if b >= source:
+                break
+            if sourcemax % (2**b-1):
+                # A smaller bit depth does not scale to whole values.
+                continue
+            step = sourcemax // (2**b-1)
+            if not [v for v in values if v % step]:
+                depth = b
+                break
+
+    if colours is None:
+        palette = ncolours = None
+    else:
+        palette = sorted(map(unpack, colours))
+        ncolours = len(palette)
+    return dict(colours=ncolours, palette=palette,
+                greyscale=greyscale, alpha=alpha, bitdepth=depth)
+
+def _colour_packer(planes, bitdepth):
+    """Return a pair of functions (*pack*, *unpack*) for
+    :func:`analyse`.  *pack* converts a row into an iterable of keys,
+    one per pixel; *unpack* converts a key back to a `planes`-tuple.
+    When possible, the keys are integers formed by packing the bytes
+    of each pixel into a single array item.
+    """
+
+    typecode = 'BH'[bitdepth > 8]
+    # Bytes per pixel, and bytes per key (padded to an array item
+    # size).
+    bpp = planes * (1,2)[bitdepth > 8]
+    keysize = (1,2,4,4,8,8,8,8)[bpp-1]
+    keycodes = [t for t in _typecodes if array(t).itemsize == keysize]
+    if not keycodes:
+        # No suitable array type (Python 2 has no 'Q'); use tuples.
+        def pack(row):
+            return group(row, planes)
+        return pack, tuple
+    keycode = keycodes[0]
+    def pack(row):
+        raw = tostring(row)
+        if keysize != bpp:
+            # Pad each pixel out to keysize bytes.
+            n = len(raw) // bpp
+            buf = bytearray(n * keysize)
+            for i in range(bpp):
+                buf[i::keysize] = raw[i::bpp]
+            raw = bytes(buf)
+        return array(keycode, raw)
+    def unpack(key):
+        raw = tostring(array(keycode, [key]))[:bpp]
+        return tuple(array(typecode, raw))
+    return pack, unpack
+
+
+# Regex for decoding mode string; compiled when first used, by
+# :func:`_mode_regex`.
+_regex_mode_decode = None
+
+def _mode_regex():
+    global _regex_mode_decode
+    if _regex_mode_decode is None:
+        import re
+        _regex_mode_decode = re.compile("(LA?|RGBA?);?([0-9]*)",
+                                        flags=re.IGNORECASE)
+    return _regex_mode_decode
+
+def __getattr__(name):
+    # Compile ``RegexModeDecode`` when it is first used (Python 3.7
+    # and later look here for module attributes that are missing).
+    if name == 'RegexModeDecode':
+        return _mode_regex()
+    raise AttributeError("module %r has no attribute %r" %
+                         (__name__, name))
+
+if sys.version_info < (3, 7):
+    # There is no module ``__getattr__``; compile it now.
+    RegexModeDecode = _mode_regex()
 
 def from_array(a, mode=None, info={}):
     """Create a PNG :class:`Image` object from a 2- or 3-dimensional
@@ -1098,6 +2284,15 @@ def from_array(a, mode=None, info={}):
     that because an iterator of rows can be used, and it all still
     works.  Using an iterator allows data to be streamed efficiently.
 
+    An array of unsigned 8- or 16-bit integers that supports the
+    buffer protocol (a ``numpy`` array with dtype ``uint8`` or
+    ``uint16``, or a ``memoryview`` with 2 or 3 dimensions) is copied
+    in one go, and :meth:`Image.save` writes it without converting
+    each value (on Python 3).  For such an array *mode* can be
+    ``None``: it is then ``'L'`` for a 2-dimensional array, and
+    ``'L'``, ``'LA'``, ``'RGB'``, or ``'RGBA'`` for a 3-dimensional
+    array whose third axis has 1, 2, 3, or 4 channels.
+
     The bit depth of the PNG is normally taken from the array element's
     datatype (but if *mode* specifies a bitdepth then that is used
     instead).  The array element's datatype is determined in a way which
@@ -1133,8 +2328,17 @@ def from_array(a, mode=None, info={}):
     # (Also typechecks *info* to some extent).
     info = dict(info)
 
+    view = _array_view(a)
+    if mode is None and view is not None:
+        # Derive the mode from the shape.
+        if view.ndim == 2:
+            mode = 'L'
+        else:
+            mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}.get(
+              view.shape[2])
+
     # Syntax check mode string.
-    match = RegexModeDecode.match(mode)
+    match = _mode_regex().match(mode or '')
     if not match:
         raise Error("mode string should be 'RGB' or 'L;16' or similar.")
 
@@ -1186,12 +2390,27 @@ def from_array(a, mode=None, info={}):
         if info['planes'] != planes:
             raise Error("info['planes'] should match mode.")
 
+    if view is not None:
+        image = _from_view(view, planes, info)
+        if image:
+            return image
+        if isinstance(a, memoryview):
+            # Iterating over a memoryview with several dimensions is
+            # not implemented.
+            a = a.tolist()
+
     # In order to work out whether we the array is 2D or 3D we need its
-    # first row, which requires that we take a copy of its iterator.
-    # We may also need the first row to derive width and bitdepth.
-    a,t = itertools.tee(a)
-    row = next(t)
-    del t
+    # first row, which requires that we take a copy of its iterator
+    # (unless it can be iterated over again).  We may also need the
+    # first row to derive width and bitdepth.
+    if iter(a) is a:
+        a,t = itertools.tee(a)
+        row = next(t)
+        del t
+        source = None
+    else:
+        row = next(iter(a))
+        source = a
     try:
         row[0][0]
         threed = True
@@ -1206,9 +2425,11 @@ def from_array(a, mode=None, info={}):
             width = len(row) // planes
         info['width'] = width
 
-    if threed:
-        # Flatten the threed rows
-        a = (itertools.chain.from_iterable(x) for x in a)
+    def flatten(rows):
+        if threed:
+            # Flatten the threed rows
+            rows = (itertools.chain.from_iterable(x) for x in rows)
+        return rows
 
     if 'bitdepth' not in info:
         try:
@@ -1234,36 +2455,176 @@ def from_array(a, mode=None, info={}):
     for thing in ["width", "height", "bitdepth", "greyscale", "alpha"]:
         assert thing in info
 
-    return Image(a, info)
+    if source is not None:
+        # The rows can be made again, each time they are used.
+        return Image(lambda: flatten(iter(source)), info)
+    return Image(flatten(a), info)
 
 # So that refugee's from PIL feel more at home.  Not documented.
 fromarray = from_array
 
-class Image:
+def _array_view(a):
+    """Return a ``memoryview`` of `a` when it is an array of unsigned
+    8- or 16-bit integers with 2 or 3 dimensions (such as a ``numpy``
+    array), or ``None``.  Always ``None`` on Python 2, whose
+    ``memoryview`` cannot be converted to an ``array``.
+    """
+
+    if sys.version_info < (3,):
+        return None
+    try:
+        view = memoryview(a)
+    except TypeError:
+        return None
+    if (view.ndim not in (2, 3) or
+      view.format.lstrip('@=<>!') not in ('B', 'H')):
+        return None
+    return view
+
+def _from_view(view, planes, info):
+    """Make an :class:`Image` for :func:`from_array` from the
+    ``memoryview`` `view` (from :func:`_array_view`) of an image with
+    `planes` channels, filling in `info`.  Returns ``None`` when the
+    shape and values of the array do not match `info`.
+    """
+
+    height = view.shape[0]
+    if view.ndim == 3:
+        if view.shape[2] != planes:
+            return None
+        width = view.shape[1]
+    else:
+        if view.shape[1] % planes:
+            return None
+        width = view.shape[1] // planes
+    bitdepth = 8 * view.itemsize
+    if (info.get('height', height) != height or
+      info.get('width', width) != width or
+      info.get('bitdepth', bitdepth) != bitdepth):
+        return None
+    info.update(height=height, width=width, bitdepth=bitdepth)
+
+    # The values, in C order (``tobytes`` copies a strided array).
+    data = view.tobytes()
+    if bitdepth > 8:
+        order = {'<': 'little', '>': 'big', '!': 'big'}.get(view.format[0],
+                                                           sys.byteorder)
+        # PNG is big-endian.
+        if order != 'big':
+            values = array('H')
+            values.frombytes(data)
+            values.byteswap()
+            data = values.tobytes()
+    n = width * planes
+    def rows():
+        values = array('BH'[bitdepth > 8])
+        values.frombytes(data)
+        if bitdepth > 8 and sys.byteorder == 'little':
+            values.byteswap()
+        return (values[i:i+n] for i in range(0, len(values), n))
+    return Image(rows, info, packed=data)
+
+class Image(object):
     """A PNG image.  You can create an :class:`Image` object from
-    an array of pixels by calling :meth:`png.from_array`.  It can be
-    saved to disk with the :meth:`save` method.
+    an array of pixels by calling :meth:`png.from_array`, or from a
+    PNG file by calling :meth:`Reader.image`.  It can be saved to disk
+    with the :meth:`save` method.
+
+    The metadata, :attr:`info` (a dictionary of the keyword arguments
+    of :class:`Writer`), is there from the start; the pixels,
+    :attr:`rows`, are made when they are first used.  The pixels of an
+    image read from a PNG file are decoded once, and kept (see
+    :attr:`cache_bytes`).
     """
 
-    def __init__(self, rows, info):
+    # When not None, the decoded pixels of the images read from PNG
+    # files are kept in one cache, shared by all images, of at most
+    # this many bytes; the pixels used least recently are dropped
+    # first, and are decoded again when they are next used.  When
+    # None, each image keeps its pixels for as long as it lives.
+    cache_bytes = None
+
+    def __init__(self, rows, info, packed=None, source=None):
         """
         .. note ::
         
           The constructor is not public.  Please do not call it.
+
+        `rows` is an iterable of rows, which may only be used once,
+        or a function that returns a new one each time it is called.
         """
         
-        self.rows = rows
         self.info = info
+        self._set_rows(rows, packed, source)
+
+    def _set_rows(self, rows, packed=None, source=None):
+        # The same pixels as packed bytes (from :func:`from_array`),
+        # or None.
+        self.packed = packed
+        # The PNG file the pixels are decoded from (from
+        # :meth:`Reader.image`), or None.
+        self.source = source
+        if callable(rows):
+            self.make_rows = rows
+            self.once = None
+        else:
+            self.make_rows = None
+            self.once = rows
+        # The pixels, as a list of rows, when this image keeps them.
+        self.pixels = None
+        # The key of the pixels in the shared cache.
+        self.key = next(_image_keys)
+
+    def _get_rows(self):
+        for row in self._rows():
+            if isarray(row):
+                yield row[:]
+            else:
+                yield list(row)
+
+    rows = property(_get_rows, _set_rows, doc=
+        """The pixels, as an iterator of rows in boxed row flat pixel
+        format.  Each use makes a new iterator (of new rows), so the
+        pixels can be used any number of times.  Setting :attr:`rows`
+        to an iterable of rows replaces the pixels; rows from an
+        iterator are kept when first used, or saved only once, as for
+        :func:`from_array`.
+        """)
+
+    def _rows(self):
+        """Return the pixels, as an iterable of rows (which must not
+        be changed), making them if need be."""
+
+        if self.pixels is not None:
+            return self.pixels
+        if self.once is not None:
+            # These rows cannot be made again, so they are kept.
+            self.pixels = [list(row) if iter(row) is row else row
+                           for row in self.once]
+            self.once = None
+            return self.pixels
+        if self.make_rows is None:
+            raise Error("the rows of this image have been used; "
+              "they can only be used once")
+        if self.source is None:
+            # Making the rows again is cheap.
+            return self.make_rows()
+        if Image.cache_bytes is None:
+            self.pixels = list(self.make_rows())
+            return self.pixels
+        return _pixel_cache.get(self.key, self.make_rows, Image.cache_bytes)
 
     def save(self, file):
         """Save the image to *file*.  If *file* looks like an open file
         descriptor then it is used, otherwise it is treated as a
         filename and a fresh file is opened.
 
-        In general, you can only call this method once; after it has
-        been called the first time and the PNG image has been saved, the
-        source data will have been streamed, and cannot be streamed
-        again.
+        This method can be called any number of times, except when
+        the image was made (by :func:`from_array`) from an iterator
+        of rows, which the first call streams without keeping (so
+        that a large image need not be held in memory).  Using
+        :attr:`rows` before saving keeps the rows, and then the image
+        can be saved again.
         """
 
         w = Writer(**self.info)
@@ -1276,10 +2637,61 @@ class Image:
             def close(): file.close()
 
         try:
-            w.write(file, self.rows)
+            if self.packed is not None and not (w.interlace or
+                                                w.optimize):
+                stream = StreamWriter(w, file, packed=True)
+                stream.open()
+                stream.write_rows(self.packed)
+                stream.close()
+            elif self.once is not None:
+                rows = self.once
+                self.once = None
+                w.write(file, rows)
+            else:
+                w.write(file, self._rows())
         finally:
             close()
 
+# The keys of images in the cache of pixels.
+_image_keys = itertools.count()
+
+class _PixelCache:
+    """The cache of pixels shared by :class:`Image` objects (see
+    :attr:`Image.cache_bytes`).  The least recently used are dropped
+    first.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def get(self, key, make_rows, budget):
+        """Return the pixels (a list of rows) kept under `key`, making
+        them by calling `make_rows` if they are not there, then drop
+        pixels until at most `budget` bytes are kept.
+        """
+
+        entry = self.entries.get(key)
+        if entry is None:
+            rows = list(make_rows())
+            entry = (rows, sum(len(row) * row.itemsize for row in rows))
+            self.entries[key] = entry
+            self.size += entry[1]
+        else:
+            self.order.remove(key)
+        self.order.append(key)
+        while self.size > budget and self.order:
+            self.size -= self.entries.pop(self.order.pop(0))[1]
+        return entry[0]
+
+    def clear(self):
+        # The (rows, bytes) pairs, by key; and their keys, most
+        # recently used last.
+        self.entries = {}
+        self.order = []
+        self.size = 0
+
+_pixel_cache = _PixelCache()
+
 class _readable:
     """
     A simple file-like interface for strings and arrays.
@@ -1292,10 +2704,16 @@ class _readable:
     def read(self, n):
         r = self.buf[self.offset:self.offset+n]
         if isarray(r):
-            r = r.tostring()
+            r = tobytes(r)
         self.offset += n
         return r
 
+    def seek(self, offset, whence=0):
+        self.offset = offset + (0, self.offset, len(self.buf))[whence]
+
+    def tell(self):
+        return self.offset
+
 try:
     str(b'dummy', 'ascii')
 except TypeError:
@@ -1304,6 +2722,9 @@ else:
     def as_str(x):
         return str(x, 'ascii')
 
+# Used by readers that are not given a context.
+_default_context = CodecContext()
+
 class Reader:
     """
     PNG decoder in pure Python.
@@ -1324,7 +2745,26 @@ class Reader:
         bytes
           ``array`` or ``string`` with PNG data.
 
+        The keyword argument `context` can also be given: a
+        :class:`CodecContext` that supplies the zlib decompression
+        objects.
+
+        The keyword argument `stats` can also be given: a
+        :class:`Stats` object that records where the time goes.
+
+        The keyword argument `pipeline` can also be given.  When it is
+        true, :meth:`read` (and the methods that use it) reads and
+        decompresses the image data in a separate thread, while the
+        calling thread undoes the filters, so that decoding a large
+        image can use two processors (``zlib`` does not hold the
+        global interpreter lock while it works).  The data is passed
+        between the threads in bands of :attr:`band_rows` rows; at
+        most `pipeline` bands are waiting at any time (4, when
+        `pipeline` is ``True``).
         """
+        self.context = kw.pop('context', None) or _default_context
+        self.pipeline = kw.pop('pipeline', False)
+        self.stats = kw.pop('stats', None) or _current_stats()
         if ((_guess is not None and len(kw) != 0) or
             (_guess is None and len(kw) != 1)):
             raise TypeError("Reader() takes exactly 1 argument")
@@ -1374,8 +2814,11 @@ class Reader:
         """
 
         self.validate_signature()
+        stats = self.stats
 
         while True:
+            if stats:
+                t = _clock()
             # http://www.w3.org/TR/PNG/#5Chunk-layout
             if not self.atchunk:
                 self.atchunk = self.chunklentype()
@@ -1388,6 +2831,9 @@ class Reader:
             checksum = self.file.read(4)
             if len(checksum) != 4:
                 raise ChunkError('Chunk %s too short for checksum.' % type)
+            if stats:
+                t1 = _clock()
+                stats.add('chunks', t1 - t, length + 12, length)
             if seek and type != seek:
                 continue
             verify = zlib.crc32(type)
@@ -1404,9 +2850,11 @@ class Reader:
                 (b, ) = struct.unpack('!I', verify)
                 message = "Checksum error in %s chunk: 0x%08X != 0x%08X." % (type, a, b)
                 if lenient:
-                    warnings.warn(message, RuntimeWarning)
+                    _warn(message, RuntimeWarning)
                 else:
                     raise ChunkError(message)
+            if stats:
+                stats.add('crc', _clock() - t1, length + 8)
             return type, data
 
     def chunks(self):
@@ -1608,6 +3056,8 @@ class Reader:
                 out.extend([mask&(o>>i) for i in shifts])
             return out[:width]
 
+        if self.stats:
+            asvalues = self.stats.timed('boxing', asvalues)
         return map(asvalues, rows)
 
     def serialtoflat(self, bytes, width=None):
@@ -1650,14 +3100,21 @@ class Reader:
         # The previous (reconstructed) scanline.  None indicates first
         # line of image.
         recon = None
+        stats = self.stats
         for some in raw:
+            if stats:
+                t = _clock()
             a.extend(some)
             while len(a) >= rb + 1:
                 filter_type = a[0]
                 scanline = a[1:rb+1]
                 del a[:rb+1]
                 recon = self.undo_filter(filter_type, scanline, recon)
+                if stats:
+                    stats.add('unfilter', _clock() - t, rb + 1, rb, 1)
                 yield recon
+                if stats:
+                    t = _clock()
         if len(a) != 0:
             # :file:format We get here with a file format error:
             # when the available bytes (after decompressing) do not
@@ -1721,7 +3178,8 @@ class Reader:
     def process_chunk(self, lenient=False):
         """Process the next chunk and its data.  This only processes the
         following chunk types, all others are ignored: ``IHDR``,
-        ``PLTE``, ``bKGD``, ``tRNS``, ``gAMA``, ``sBIT``, ``pHYs``.
+        ``PLTE``, ``bKGD``, ``tRNS``, ``gAMA``, ``sBIT``, ``pHYs``,
+        and the APNG chunks ``acTL`` and ``fcTL``.
 
         If the optional `lenient` argument evaluates to `True`,
         checksum failures will raise warnings rather than exceptions.
@@ -1783,7 +3241,7 @@ class Reader:
     def _process_PLTE(self, data):
         # http://www.w3.org/TR/PNG/#11PLTE
         if self.plte:
-            warnings.warn("Multiple PLTE chunks present.")
+            _warn("Multiple PLTE chunks present.")
         self.plte = data
         if len(data) % 3 != 0:
             raise FormatError(
@@ -1797,7 +3255,7 @@ class Reader:
         try:
             if self.colormap:
                 if not self.plte:
-                    warnings.warn(
+                    _warn(
                       "PLTE chunk is required before bKGD chunk.")
                 self.background = struct.unpack('B', data)
             else:
@@ -1811,7 +3269,7 @@ class Reader:
         self.trns = data
         if self.colormap:
             if not self.plte:
-                warnings.warn("PLTE chunk is required before tRNS chunk.")
+                _warn("PLTE chunk is required before tRNS chunk.")
             else:
                 if len(data) > len(self.plte)/3:
                     # Was warning, but promoted to Error as it
@@ -1849,6 +3307,27 @@ class Reader:
         self.x_pixels_per_unit, self.y_pixels_per_unit, unit = struct.unpack(fmt,data)
         self.unit_is_meter = bool(unit)
 
+    def _process_acTL(self, data):
+        # https://wiki.mozilla.org/APNG_Specification#.60acTL.60:_The_Animation_Control_Chunk
+        if len(data) != 8:
+            raise FormatError("acTL chunk has incorrect length.")
+        self.num_frames, self.num_plays = struct.unpack("!2I", data)
+
+    def _process_fcTL(self, data):
+        # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
+        if len(data) != 26:
+            raise FormatError("fcTL chunk has incorrect length.")
+        (sequence, width, height, x, y, delay_num, delay_den,
+         dispose, blend) = struct.unpack("!5I2H2B", data)
+        if not width or not height:
+            raise FormatError("fcTL chunk has an empty frame.")
+        if dispose > 2 or blend > 1:
+            raise FormatError("fcTL chunk has unknown operation.")
+        # A denominator of 0 means hundredths of a second.
+        self.fctl = dict(x=x, y=y, width=width, height=height,
+                         delay=(delay_num, delay_den or 100),
+                         dispose=dispose, blend=blend)
+
     def read(self, lenient=False):
         """
         Read the PNG file and decode it.  Returns (`width`, `height`,
@@ -1877,7 +3356,7 @@ class Reader:
                 # type == b'IDAT'
                 # http://www.w3.org/TR/PNG/#11IDAT
                 if self.colormap and not self.plte:
-                    warnings.warn("PLTE chunk is required before IDAT chunk")
+                    _warn("PLTE chunk is required before IDAT chunk")
                 yield data
 
         def iterdecomp(idat):
@@ -1885,30 +3364,51 @@ class Reader:
             be an iterator that yields the ``IDAT`` chunk data.
             """
 
-            # Currently, with no max_length parameter to decompress,
-            # this routine will do one yield per IDAT chunk: Not very
-            # incremental.
-            d = zlib.decompressobj()
+            # Each string is at most a band of rows.
+            band = (self.row_bytes + 1) * self.band_rows
+            d = self.context.decompressobj()
+            stats = self.stats
             # Each IDAT chunk is passed to the decompressor, then any
             # remaining state is decompressed out.
             for data in idat:
-                # :todo: add a max_length argument here to limit output
-                # size.
-                yield array('B', d.decompress(data))
+                while data:
+                    if stats:
+                        t = _clock()
+                    out = d.decompress(data, band)
+                    if stats:
+                        stats.add('inflate', _clock() - t,
+                                  len(data) - len(d.unconsumed_tail),
+                                  len(out))
+                    yield array('B', out)
+                    data = d.unconsumed_tail
             yield array('B', d.flush())
 
         self.preamble(lenient=lenient)
         raw = iterdecomp(iteridat())
+        if self.pipeline:
+            raw = _pipeline(raw, 4 if self.pipeline is True
+                                 else self.pipeline)
 
         if self.interlace:
             raw = array('B', itertools.chain(*raw))
             arraycode = 'BH'[self.bitdepth>8]
+            if self.stats:
+                t = _clock()
+            flat = self.deinterlace(raw)
+            if self.stats:
+                self.stats.add('deinterlace', _clock() - t, len(raw),
+                               len(flat) * flat.itemsize, self.height)
             # Like :meth:`group` but producing an array.array object for
             # each row.
             pixels = map(lambda *row: array(arraycode, row),
-                       *[iter(self.deinterlace(raw))]*self.width*self.planes)
+                       *[iter(flat)]*self.width*self.planes)
         else:
             pixels = self.iterboxed(self.iterstraight(raw))
+        return self.width, self.height, pixels, self._metadata()
+
+    def _metadata(self):
+        """The metadata dictionary returned by :meth:`read`."""
+
         meta = dict()
         for attr in 'greyscale alpha planes bitdepth interlace'.split():
             meta[attr] = getattr(self, attr)
@@ -1919,8 +3419,23 @@ class Reader:
                 meta[attr] = a
         if self.plte:
             meta['palette'] = self.palette()
-        return self.width, self.height, pixels, meta
+        return meta
+
+
+    def aread(self, executor=None, method='read'):
+        """Return a coroutine that decodes the PNG image in
+        `executor` (by default, the event loop's default executor),
+        without blocking the event loop.  `method` names the method
+        used to decode the image: ``'read'`` (the default),
+        ``'asDirect'``, ``'asRGBA8'``, and so on.  The coroutine
+        returns (*width*, *height*, *pixels*, *metadata*) like that
+        method, but with *pixels* a list of rows.  Cancelling the
+        coroutine stops the decoder.  See :mod:`pngasync`.  Requires
+        Python 3.5 or later.
+        """
 
+        import pngasync
+        return pngasync.aread(self, executor, method)
 
     def read_flat(self):
         """
@@ -1940,6 +3455,324 @@ class Reader:
         pixel = array(arraycode, itertools.chain(*pixel))
         return x, y, pixel, meta
 
+    def image(self, lenient=False):
+        """
+        Return an :class:`Image` of the PNG file.  The file is read,
+        but only its metadata is decoded now; the pixels (as returned
+        by :meth:`read`) are decoded when they are first used, and
+        kept (see :attr:`Image.cache_bytes`), so the image can be used
+        and saved many times.
+
+        When the file is not a ``bytes`` argument and this reader has
+        already read some of it, it must be seekable.
+        """
+
+        if isinstance(self.file, _readable):
+            data = self.file.buf
+        else:
+            if self.signature is not None:
+                self.file.seek(0)
+            data = self.file.read()
+        context = self.context
+        r = Reader(bytes=data, context=context)
+        r.preamble(lenient=lenient)
+        info = r._metadata()
+        info['width'],info['height'] = info['size']
+        if r.colormap:
+            # The background colour is a palette index, which
+            # :class:`Writer` does not take.
+            info.pop('background', None)
+        def rows():
+            return Reader(bytes=data, context=context).read(lenient)[2]
+        return Image(rows, info, source=data)
+
+    # The number of rows of decompressed data that :meth:`read`
+    # handles at once.
+    band_rows = 32
+
+    # The most frame canvases :meth:`read_frame` keeps, and how often
+    # (in frames) it keeps one as a starting point for later seeks.
+    frame_cache = 16
+    frame_checkpoint = 16
+
+    def frame_index(self, lenient=False):
+        """
+        Read the whole PNG file, which can be an animated PNG (APNG)
+        file, and return a list of its frames.  The file must be
+        seekable (a filename, a ``bytes`` argument, or a file that has
+        ``seek`` and ``tell`` methods).  The index is kept, so it is
+        only made once.
+
+        Each frame is a dictionary with the keys ``x``, ``y``,
+        ``width``, ``height`` (the rectangle of the canvas that the
+        frame covers), ``delay`` (a (*numerator*, *denominator*)
+        pair, in seconds), ``dispose`` and ``blend`` (the APNG
+        operations, 0 to 2 and 0 to 1), ``keyframe`` (true when the
+        frame does not depend on the frames before it), and
+        ``chunks`` (the offsets in the file of its ``IDAT`` or
+        ``fdAT`` chunks).  A PNG file that is not animated has one
+        frame.
+
+        See https://wiki.mozilla.org/APNG_Specification
+        """
+
+        if getattr(self, 'frames', None) is not None:
+            return self.frames
+        self.file.seek(0)
+        self.signature = None
+        self.atchunk = None
+        self.validate_signature()
+        self.num_plays = 0
+        self.fctl = None
+        animated = False
+        # The image that decoders without APNG support show.
+        idat = []
+        frames = []
+        while True:
+            offset = self.file.tell()
+            self.atchunk = self.chunklentype()
+            if self.atchunk is None:
+                raise FormatError('PNG file has no IEND chunk.')
+            length,type = self.atchunk
+            if type in (b'IDAT', b'fdAT'):
+                # Skip the data; it is read when the frame is decoded.
+                self.atchunk = None
+                self.file.seek(length + 4, 1)
+                if type == b'IDAT':
+                    idat.append(offset)
+                    if frames and frames[-1]['chunks'] is not idat:
+                        raise FormatError('IDAT chunk after fdAT chunk.')
+                elif not frames or frames[-1]['chunks'] is idat:
+                    raise FormatError('fdAT chunk without fcTL chunk.')
+                else:
+                    frames[-1]['chunks'].append(offset)
+                continue
+            self.process_chunk(lenient=lenient)
+            if type == b'acTL':
+                animated = True
+            elif type == b'fcTL':
+                frame = dict(self.fctl)
+                # When the fcTL chunk comes before the IDAT chunks, the
+                # image is also the first frame.
+                frame['chunks'] = idat if not idat else []
+                frames.append(frame)
+            elif type == b'IEND':
+                break
+        if not idat:
+            raise FormatError('This PNG file has no IDAT chunks.')
+        if animated and len(frames) != self.num_frames:
+            _warn("acTL chunk gives %d frames, but there are %d." %
+                  (self.num_frames, len(frames)))
+        if not animated:
+            frames = [dict(x=0, y=0, width=self.width, height=self.height,
+                           delay=(0, 0), dispose=0, blend=0, chunks=idat)]
+        for i,frame in enumerate(frames):
+            frame['keyframe'] = i == 0 or (
+              # The frame replaces the whole canvas...
+              frame['blend'] == 0 and self._covers(frame)) or (
+              # ... or the canvas is cleared before it.
+              frames[i-1]['dispose'] == 1 and self._covers(frames[i-1]))
+        # Leave the file ready for :meth:`read`.
+        self.file.seek(0)
+        self.signature = None
+        self.atchunk = None
+        self.frames = frames
+        # The canvases kept, by frame; and their frames, most recently
+        # used last.
+        self.canvases = {}
+        self.canvas_order = []
+        return frames
+
+    def _covers(self, frame):
+        return (frame['x'], frame['y'], frame['width'],
+                frame['height']) == (0, 0, self.width, self.height)
+
+    def read_frame(self, n, lenient=False):
+        """
+        Decode frame `n` (counting from 0) of an animated PNG file (see
+        :meth:`frame_index`), drawn onto the canvas as it is when that
+        frame is shown.  Returns (*width*, *height*, *pixels*,
+        *metadata*), like :meth:`read`, with *pixels* a list of rows
+        (each an ``array``) and two extra *metadata* keys: ``frame``
+        (`n`) and ``delay``.
+
+        The frames before `n` back to the last key frame have to be
+        decoded too, but the canvas is kept for some of the frames
+        decoded (each key frame, every :attr:`frame_checkpoint`
+        frames, and the last frame), so moving to a nearby frame,
+        forwards or backwards, is quick.  At most :attr:`frame_cache`
+        canvases are kept.
+
+        The canvas starts transparent black (all values 0) and has the
+        image's colour type, so images with a palette give palette
+        indexes.  When a frame's pixels are drawn over the canvas
+        (the APNG blend operation "over"), pixels with an alpha value
+        between 0 and the maximum are blended; in images with a
+        ``tRNS`` chunk, pixels that are fully transparent are not
+        drawn and others replace the canvas.
+        """
+
+        frames = self.frame_index(lenient=lenient)
+        if not 0 <= n < len(frames):
+            raise IndexError("frame %d out of range" % n)
+        key = max(i for i in range(n+1) if frames[i]['keyframe'])
+        cached = [i for i in self.canvases if key <= i <= n]
+        if cached:
+            start = max(cached)
+            canvas,saved = self.canvases[start]
+            self.canvas_order.remove(start)
+            self.canvas_order.append(start)
+            canvas = [row[:] for row in canvas]
+            start += 1
+        else:
+            start = key
+            canvas = None
+            saved = None
+        for i in range(start, n+1):
+            if canvas is None:
+                canvas = self._blank(self.width, self.height)
+            else:
+                self._dispose(canvas, frames[i-1], saved)
+            saved = self._draw(canvas, frames[i], lenient)
+            if (frames[i]['keyframe'] or i % self.frame_checkpoint == 0 or
+              i == n):
+                if i in self.canvases:
+                    self.canvas_order.remove(i)
+                self.canvases[i] = (
+                  [row[:] for row in canvas], saved)
+                self.canvas_order.append(i)
+                while len(self.canvas_order) > self.frame_cache:
+                    del self.canvases[self.canvas_order.pop(0)]
+        meta = self._metadata()
+        meta['frame'] = n
+        meta['delay'] = frames[n]['delay']
+        return self.width, self.height, canvas, meta
+
+    def read_frames(self, start=0, stop=None, lenient=False):
+        """Iterator that yields each frame, from `start` up to (but
+        not including) `stop` (by default, the end of the animation),
+        as :meth:`read_frame` returns it.
+        """
+
+        if stop is None:
+            stop = len(self.frame_index(lenient=lenient))
+        for n in range(start, stop):
+            yield self.read_frame(n, lenient=lenient)
+
+    def _blank(self, width, height):
+        """Return a transparent black canvas, as a list of rows."""
+
+        row = array('BH'[self.bitdepth > 8], [0]) * (width * self.planes)
+        return [row[:] for _ in range(height)]
+
+    def _dispose(self, canvas, frame, saved):
+        """Do the dispose operation of `frame` on the canvas.
+        `saved` is the part of the canvas under the frame from before
+        it was drawn."""
+
+        dispose = frame['dispose']
+        if dispose == 0:
+            return
+        if dispose == 2 and saved is None:
+            # The first frame: dispose to the background.
+            dispose = 1
+        planes = self.planes
+        x0 = frame['x'] * planes
+        x1 = x0 + frame['width'] * planes
+        if dispose == 1:
+            saved = self._blank(frame['width'], frame['height'])
+        for i,row in enumerate(saved):
+            canvas[frame['y']+i][x0:x1] = row
+
+    def _draw(self, canvas, frame, lenient):
+        """Decode `frame` and draw it on the canvas.  Returns the part
+        of the canvas that it covered, from before it was drawn, when
+        the frame's dispose operation needs it, and ``None``
+        otherwise."""
+
+        planes = self.planes
+        x0 = frame['x'] * planes
+        x1 = x0 + frame['width'] * planes
+        y = frame['y']
+        if x1 > len(canvas[0]) or y + frame['height'] > len(canvas):
+            raise FormatError("frame is outside the image.")
+        saved = None
+        if frame['dispose'] == 2:
+            saved = [row[x0:x1] for row in canvas[y:y+frame['height']]]
+        over = frame['blend'] == 1 and (self.alpha or self.trns)
+        for i,row in enumerate(self._frame_pixels(frame, lenient)):
+            if over:
+                row = self._over(canvas[y+i][x0:x1], row)
+            canvas[y+i][x0:x1] = row
+        return saved
+
+    def _over(self, dst, src):
+        """Return the row `src` drawn over the row `dst` (with the
+        APNG blend operation "over")."""
+
+        planes = self.planes
+        maxval = 2**self.bitdepth - 1
+        if self.colormap:
+            trns = array('B', self.trns)
+            opaque = [i >= len(trns) or trns[i] for i in range(256)]
+            for i,v in enumerate(src):
+                if opaque[v]:
+                    dst[i] = v
+            return dst
+        if not self.alpha:
+            t = list(self.transparent or ())
+            for i in range(0, len(src), planes):
+                if list(src[i:i+planes]) != t:
+                    dst[i:i+planes] = src[i:i+planes]
+            return dst
+        # http://www.w3.org/TR/PNG/#12Alpha-channel-processing
+        for i in range(0, len(src), planes):
+            sa = src[i+planes-1]
+            if sa == maxval:
+                dst[i:i+planes] = src[i:i+planes]
+            elif sa:
+                da = dst[i+planes-1]
+                a = sa * maxval + da * (maxval - sa)
+                for j in range(planes-1):
+                    dst[i+j] = (src[i+j] * sa * maxval +
+                      dst[i+j] * da * (maxval - sa)) // a
+                dst[i+planes-1] = a // maxval
+        return dst
+
+    def _frame_pixels(self, frame, lenient):
+        """Decode the pixels of `frame` (before they are drawn on the
+        canvas), and return them as a list of rows."""
+
+        d = self.context.decompressobj()
+        raw = array('B')
+        self.file.seek(0)
+        self.signature = None
+        self.validate_signature()
+        for offset in frame['chunks']:
+            self.file.seek(offset)
+            self.atchunk = None
+            type,data = self.chunk(lenient=lenient)
+            if type == b'fdAT':
+                data = data[4:]
+            raw.extend(array('B', d.decompress(data)))
+        raw.extend(array('B', d.flush()))
+        self.file.seek(0)
+        self.signature = None
+        # A reader for the frame's rectangle.
+        import copy
+        sub = copy.copy(self)
+        sub.width = frame['width']
+        sub.height = frame['height']
+        sub.row_bytes = int(math.ceil(sub.width * self.psize))
+        if self.interlace:
+            flat = sub.deinterlace(raw)
+            vpr = sub.width * self.planes
+            return [flat[i:i+vpr] for i in range(0, len(flat), vpr)]
+        rows = list(sub.iterboxed(sub.iterstraight([raw])))
+        if len(rows) != sub.height:
+            raise FormatError('Wrong size for decompressed frame data.')
+        return rows
+
     def palette(self, alpha='natural'):
         """Returns a palette that is a sequence of 3-tuples or 4-tuples,
         synthesizing it from the ``PLTE`` and ``tRNS`` chunks.  These
@@ -2068,21 +3901,65 @@ class Reader:
             pixels = itershift(pixels)
         return x,y,pixels,meta
 
-    def asFloat(self, maxval=1.0):
+    def asFloat(self, maxval=1.0, gamma=None, default_gamma=1.0):
         """Return image pixels as per :meth:`asDirect` method, but scale
         all pixel values to be floating point values between 0.0 and
         *maxval*.
+
+        When `gamma` is given the values are also recoded to that
+        gamma, as :meth:`asGamma` does; ``gamma=1.0`` gives linear
+        light intensities.
         """
 
         x,y,pixels,info = self.asDirect()
-        sourcemaxval = 2**info['bitdepth']-1
+        pixels = self._recode(pixels, info, gamma, default_gamma,
+                              maxval=maxval)
         del info['bitdepth']
         info['maxval'] = float(maxval)
-        factor = float(maxval)/float(sourcemaxval)
-        def iterfloat():
-            for row in pixels:
-                yield [factor * p for p in row]
-        return x,y,iterfloat(),info
+        return x,y,pixels,info
+
+    def asGamma(self, gamma=1.0, bitdepth=None, default_gamma=1.0):
+        """Return image pixels as per :meth:`asDirect` method, but
+        recoded to the gamma `gamma` (the exponent used to encode the
+        intensities, as in a ``gAMA`` chunk; the default, 1.0, is
+        linear light), and to the bit depth `bitdepth` when it is
+        given.  The gamma of the source image is that of its ``gAMA``
+        chunk, or `default_gamma` when it has none.  An alpha channel
+        is rescaled, but not recoded (it is linear).  The metadata's
+        ``gamma`` is `gamma`.
+
+        The samples are recoded by looking them up in a table (see
+        :mod:`pnggamma`), which is made once for each combination of
+        bit depths and gammas.
+        """
+
+        x,y,pixels,info = self.asDirect()
+        if bitdepth is None:
+            bitdepth = info['bitdepth']
+        pixels = self._recode(pixels, info, gamma, default_gamma, bitdepth)
+        info['bitdepth'] = bitdepth
+        return x,y,pixels,info
+
+    def _recode(self, pixels, info, gamma, default_gamma,
+                targetbitdepth=None, maxval=1.0):
+        """Helper used by :meth:`asFloat` and :meth:`asGamma`.  Returns
+        the recoded `pixels`, and sets the gamma in `info`."""
+
+        import pnggamma
+
+        bitdepth = info['bitdepth']
+        exponent = 1.0
+        if gamma is not None:
+            exponent = float(gamma) / (info.get('gamma') or default_gamma)
+            info['gamma'] = gamma
+            if exponent == 1 and targetbitdepth == bitdepth:
+                return pixels
+        table = pnggamma.table(bitdepth, exponent, targetbitdepth, maxval)
+        alphatable = None
+        if info['alpha'] and exponent != 1:
+            alphatable = pnggamma.table(bitdepth, 1.0, targetbitdepth,
+                                        maxval)
+        return pnggamma.recode(pixels, table, info['planes'], alphatable)
 
     def _as_rescale(self, get, targetbitdepth):
         """Helper used by :meth:`asRGB8` and :meth:`asRGBA8`."""
@@ -2208,6 +4085,211 @@ class Reader:
         meta['greyscale'] = False
         return width,height,convert(),meta
 
+class IncrementalDecoder:
+    """
+    PNG decoder that is given the PNG file a piece at a time (for
+    example, as it arrives from a non-blocking socket), and returns
+    the rows of the image as soon as they can be decoded.
+    """
+
+    # Largest amount of decompressed data produced at once.
+    max_length = 2**16
+
+    def __init__(self, lenient=False, context=None):
+        """
+        Create an incremental decoder.  If `lenient` is true, checksum
+        failures will raise warnings rather than exceptions.
+        `context` is a :class:`CodecContext` for the decompressor.
+
+        Give the decoder data with :meth:`feed`.  The decoded rows
+        are returned by :meth:`feed` in boxed row flat pixel format,
+        as :meth:`Reader.read` returns them.  The `info` attribute is
+        ``None`` until the first ``IDAT`` chunk has been reached, and
+        then it is the metadata dictionary that :meth:`Reader.read`
+        returns.  The `done` attribute is true when the ``IEND``
+        chunk has been read.
+
+        The decoder holds on to no more than the part of the input
+        that does not yet make up a whole chunk header, checksum, or
+        (for the small chunks that carry metadata) chunk, and the part
+        of the decompressed data that does not yet make up a whole
+        row.  Rows of an interlaced image cannot be decoded until the
+        whole image has arrived, so the image is then held in memory
+        and all the rows are returned together.
+        """
+
+        self.lenient = lenient
+        # Used to process the chunks and undo the filters.
+        self.reader = Reader(bytes=b'', context=context)
+        self.info = None
+        self.done = False
+        # Input not yet used; and the position of the unused part.
+        self.input = b''
+        self.pos = 0
+        self.signature = False
+        # The chunk being read: [length remaining, type, checksum],
+        # or None when a chunk header is wanted next.
+        self.chunk = None
+        self.decompressor = None
+        # Decompressed data that is not yet a whole row.
+        self.raw = array('B')
+        # The previous row, for undoing the filters.
+        self.recon = None
+        self.rows = 0
+
+    def feed(self, data):
+        """Add the bytes `data` to the input, and return a list of
+        any rows that can now be decoded.
+        """
+
+        if self.done:
+            if data:
+                raise FormatError('Data after IEND chunk.')
+            return []
+        if self.pos:
+            self.input = self.input[self.pos:]
+            self.pos = 0
+        self.input += data
+        rows = []
+        while not self.done and self._step(rows):
+            pass
+        return rows
+
+    def close(self):
+        """Check that the whole PNG file has been given to the
+        decoder; raises :class:`FormatError` if it has not."""
+
+        if not self.done:
+            raise FormatError('PNG file is incomplete.')
+        if len(self.input) > self.pos:
+            raise FormatError('Data after IEND chunk.')
+
+    def _available(self):
+        return len(self.input) - self.pos
+
+    def _take(self, n):
+        s = self.input[self.pos:self.pos+n]
+        self.pos += len(s)
+        return s
+
+    def _step(self, rows):
+        """Use some of the input.  Returns false when more input is
+        needed."""
+
+        if not self.signature:
+            if self._available() < 8:
+                return False
+            if self._take(8) != _signature:
+                raise FormatError('PNG file has invalid signature.')
+            self.signature = True
+            return True
+        if self.chunk is None:
+            if self._available() < 8:
+                return False
+            length,type = struct.unpack('!I4s', self._take(8))
+            if length > 2**31-1:
+                raise FormatError('Chunk %s is too large: %d.' %
+                  (type, length))
+            if type == b'IDAT' and self.info is None:
+                self._start()
+            process = type != b'IDAT' and hasattr(self.reader,
+              '_process_' + as_str(type))
+            if process and length > 2**16:
+                raise FormatError('Chunk %s is too large: %d.' %
+                  (type, length))
+            self.chunk = [length, type, zlib.crc32(type), process]
+            return True
+        length,type,checksum,process = self.chunk
+        if length:
+            if process:
+                # Wait for the whole chunk.
+                if self._available() < length + 4:
+                    return False
+                data = self._take(length)
+            else:
+                data = self._take(length)
+                if not data:
+                    return False
+            self.chunk[0] -= len(data)
+            self.chunk[2] = zlib.crc32(data, checksum)
+            if process:
+                self.chunk[3] = data
+            elif type == b'IDAT':
+                self._decompress(data, rows)
+            return True
+        if self._available() < 4:
+            return False
+        verify = struct.pack('!I', checksum & (2**32-1))
+        if self._take(4) != verify:
+            message = 'Checksum error in %s chunk.' % as_str(type)
+            if self.lenient:
+                _warn(message, RuntimeWarning)
+            else:
+                raise ChunkError(message)
+        self.chunk = None
+        if process:
+            getattr(self.reader, '_process_' + as_str(type))(
+              process if process is not True else b'')
+        if type == b'IEND':
+            self._finish(rows)
+        return True
+
+    def _start(self):
+        """Called when the first ``IDAT`` chunk is reached."""
+
+        reader = self.reader
+        if not hasattr(reader, 'width'):
+            raise FormatError('IDAT chunk before IHDR chunk.')
+        if reader.colormap and not reader.plte:
+            _warn("PLTE chunk is required before IDAT chunk")
+        self.info = reader._metadata()
+        self.decompressor = reader.context.decompressobj()
+
+    def _decompress(self, data, rows):
+        """Decompress the ``IDAT`` data `data`, adding any whole rows
+        to `rows`."""
+
+        d = self.decompressor
+        while data:
+            self.raw.extend(array('B', d.decompress(data, self.max_length)))
+            data = d.unconsumed_tail
+            if not self.reader.interlace:
+                self._rows(rows)
+
+    def _rows(self, rows):
+        """Undo the filters for each whole row in the decompressed
+        data, adding the rows to `rows`."""
+
+        reader = self.reader
+        rb = reader.row_bytes
+        raw = self.raw
+        while len(raw) >= rb + 1:
+            filter_type = raw[0]
+            scanline = raw[1:rb+1]
+            del raw[:rb+1]
+            self.recon = reader.undo_filter(filter_type, scanline, self.recon)
+            rows.extend(reader.iterboxed([self.recon]))
+            self.rows += 1
+
+    def _finish(self, rows):
+        """Called when the ``IEND`` chunk has been read."""
+
+        self.done = True
+        reader = self.reader
+        if self.decompressor is None:
+            raise FormatError('This PNG file has no IDAT chunks.')
+        self.raw.extend(array('B', self.decompressor.flush()))
+        if reader.interlace:
+            pixels = reader.deinterlace(self.raw)
+            vpr = reader.width * reader.planes
+            rows.extend(pixels[i:i+vpr] for i in range(0, len(pixels), vpr))
+            self.rows = reader.height
+            self.raw = array('B')
+        else:
+            self._rows(rows)
+        if self.raw or self.rows != reader.height:
+            raise FormatError('Wrong size for decompressed IDAT chunk.')
+
 def check_bitdepth_colortype(bitdepth, colortype):
     """Check that `bitdepth` and `colortype` are both valid,
     and specified in a valid combination. Returns if valid,
@@ -2242,97 +4324,128 @@ def isinteger(x):
 
 # === Support for users without Cython ===
 
-try:
-    pngfilters
-except NameError:
-    class pngfilters(object):
-        def undo_filter_sub(filter_unit, scanline, previous, result):
-            """Undo sub filter."""
-
-            ai = 0
-            # Loops starts at index fu.  Observe that the initial part
-            # of the result is already filled in correctly with
-            # scanline.
-            for i in range(filter_unit, len(result)):
-                x = scanline[i]
-                a = result[ai]
-                result[i] = (x + a) & 0xff
-                ai += 1
-        undo_filter_sub = staticmethod(undo_filter_sub)
-
-        def undo_filter_up(filter_unit, scanline, previous, result):
-            """Undo up filter."""
-
-            for i in range(len(result)):
-                x = scanline[i]
-                b = previous[i]
-                result[i] = (x + b) & 0xff
-        undo_filter_up = staticmethod(undo_filter_up)
-
-        def undo_filter_average(filter_unit, scanline, previous, result):
-            """Undo up filter."""
+# Without the Cython extension, the Sub and Up filters are undone with
+# NumPy when it can be imported (it is only imported when first
+# needed), and otherwise with Python code that is arranged to do as
+# little as possible for each byte.
+class _pngfilters(object):
+    def undo_filter_sub(filter_unit, scanline, previous, result):
+        """Undo sub filter."""
+
+        np = _numpy()
+        if (np and isarray(result) and len(result) and
+          len(result) % filter_unit == 0):
+            # Each byte is the sum of the bytes before it, in the
+            # same channel: a cumulative sum, down each column.
+            v = np.frombuffer(result, np.uint8).reshape(-1, filter_unit)
+            np.cumsum(v, axis=0, dtype=np.uint8, out=v)
+            return
+        # The first pixel is already correct.  The loops in this
+        # class build a list, which is quicker than indexing the
+        # arrays.
+        out = list(scanline[:filter_unit])
+        append = out.append
+        fu = -filter_unit
+        for x in scanline[filter_unit:]:
+            append((x + out[fu]) & 0xff)
+        result[:] = array('B', out)
+    undo_filter_sub = staticmethod(undo_filter_sub)
+
+    def undo_filter_up(filter_unit, scanline, previous, result):
+        """Undo up filter."""
+
+        np = _numpy()
+        if np and isarray(result) and isarray(previous):
+            v = np.frombuffer(result, np.uint8)
+            np.add(v, np.frombuffer(previous, np.uint8), out=v)
+            return
+        # All the bytes at once, as one big integer.
+        result[:] = _bytewise_add(_bytes_to_int(scanline),
+          _bytes_to_int(previous[:len(result)]), len(result))
+    undo_filter_up = staticmethod(undo_filter_up)
+
+    def undo_filter_average(filter_unit, scanline, previous, result):
+        """Undo average filter."""
+
+        previous = list(previous)
+        # The first pixel has no pixel to its left.
+        out = [(x + (b >> 1)) & 0xff
+               for x,b in zip(scanline[:filter_unit], previous)]
+        append = out.append
+        fu = -filter_unit
+        for x,b in zip(scanline[filter_unit:], previous[filter_unit:]):
+            append((x + ((out[fu] + b) >> 1)) & 0xff)
+        result[:] = array('B', out)
+    undo_filter_average = staticmethod(undo_filter_average)
+
+    def undo_filter_paeth(filter_unit, scanline, previous, result):
+        """Undo Paeth filter."""
+
+        previous = list(previous)
+        # The first pixel has no pixel to its left, so the
+        # predictor is the pixel above.
+        out = [(x + b) & 0xff
+               for x,b in zip(scanline[:filter_unit], previous)]
+        append = out.append
+        fu = -filter_unit
+        for x,b,c in zip(scanline[filter_unit:], previous[filter_unit:],
+                         previous):
+            a = out[fu]
+            # These are the distances of a+b-c from a, b, and c.
+            pa = abs(b - c)
+            pb = abs(a - c)
+            pc = abs(a + b - c - c)
+            if pa <= pb and pa <= pc:
+                pr = a
+            elif pb <= pc:
+                pr = b
+            else:
+                pr = c
+            append((x + pr) & 0xff)
+        result[:] = array('B', out)
+    undo_filter_paeth = staticmethod(undo_filter_paeth)
+
+    def convert_la_to_rgba(row, result):
+        for i in range(3):
+            result[i::4] = row[0::2]
+        result[3::4] = row[1::2]
+    convert_la_to_rgba = staticmethod(convert_la_to_rgba)
+
+    def convert_l_to_rgba(row, result):
+        """Convert a grayscale image to RGBA. This method assumes
+        the alpha channel in result is already correctly
+        initialized.
+        """
+        for i in range(3):
+            result[i::4] = row
+    convert_l_to_rgba = staticmethod(convert_l_to_rgba)
 
-            ai = -filter_unit
-            for i in range(len(result)):
-                x = scanline[i]
-                if ai < 0:
-                    a = 0
-                else:
-                    a = result[ai]
-                b = previous[i]
-                result[i] = (x + ((a + b) >> 1)) & 0xff
-                ai += 1
-        undo_filter_average = staticmethod(undo_filter_average)
+    def convert_rgb_to_rgba(row, result):
+        """Convert an RGB image to RGBA. This method assumes the
+        alpha channel in result is already correctly initialized.
+        """
+        for i in range(3):
+            result[i::4] = row[i::3]
+    convert_rgb_to_rgba = staticmethod(convert_rgb_to_rgba)
 
-        def undo_filter_paeth(filter_unit, scanline, previous, result):
-            """Undo Paeth filter."""
+class _FilterProbe(object):
+    """
+    Stands in for `pngfilters` until it is first used.  Then
+    `cpngfilters`, the Cython module, is imported (it must be compiled
+    by Cython for this import to work), or, when it cannot be, the
+    pure Python :class:`_pngfilters` is used; either replaces this
+    object as `pngfilters`, so the import is only tried once.
+    """
 
-            # Also used for ci.
-            ai = -filter_unit
-            for i in range(len(result)):
-                x = scanline[i]
-                if ai < 0:
-                    a = c = 0
-                else:
-                    a = result[ai]
-                    c = previous[ai]
-                b = previous[i]
-                p = a + b - c
-                pa = abs(p - a)
-                pb = abs(p - b)
-                pc = abs(p - c)
-                if pa <= pb and pa <= pc:
-                    pr = a
-                elif pb <= pc:
-                    pr = b
-                else:
-                    pr = c
-                result[i] = (x + pr) & 0xff
-                ai += 1
-        undo_filter_paeth = staticmethod(undo_filter_paeth)
-
-        def convert_la_to_rgba(row, result):
-            for i in range(3):
-                result[i::4] = row[0::2]
-            result[3::4] = row[1::2]
-        convert_la_to_rgba = staticmethod(convert_la_to_rgba)
-
-        def convert_l_to_rgba(row, result):
-            """Convert a grayscale image to RGBA. This method assumes
-            the alpha channel in result is already correctly
-            initialized.
-            """
-            for i in range(3):
-                result[i::4] = row
-        convert_l_to_rgba = staticmethod(convert_l_to_rgba)
+    def __getattr__(self, name):
+        global pngfilters
+        try:
+            import cpngfilters as pngfilters
+        except ImportError:
+            pngfilters = _pngfilters
+        return getattr(pngfilters, name)
 
-        def convert_rgb_to_rgba(row, result):
-            """Convert an RGB image to RGBA. This method assumes the
-            alpha channel in result is already correctly initialized.
-            """
-            for i in range(3):
-                result[i::4] = row[i::3]
-        convert_rgb_to_rgba = staticmethod(convert_rgb_to_rgba)
+pngfilters = _FilterProbe()
 
 
 # === Command Line Support ===
@@ -2556,6 +4669,29 @@ def _main(argv):
     parser.add_option("-a", "--alpha",
                       action="store", type="string", metavar="pgmfile",
                       help="alpha channel transparency (RGBA)")
+    parser.add_option("-O", "--optimize",
+                      default=False, action="store_true",
+                      help="use the smallest colour type and bit depth")
+    parser.add_option("-s", "--strategy",
+                      action="store", type="choice",
+                      choices=sorted(_strategies),
+                      help="zlib compression strategy")
+    parser.add_option("-w", "--window-bits",
+                      action="store", type="int", metavar="bits",
+                      help="zlib window size (9-15)")
+    parser.add_option("-m", "--mem-level",
+                      action="store", type="int", metavar="level",
+                      help="zlib memory level (1-9)")
+    parser.add_option("-f", "--filter",
+                      action="store", type="int", metavar="type",
+                      help="PNG filter type (0-4)")
+    parser.add_option("-p", "--preset",
+                      action="store", type="choice",
+                      choices=sorted(_presets),
+                      help="use a preset for the zlib and filter options")
+    parser.add_option("--profile",
+                      default=False, action="store_true",
+                      help="print where the time goes to standard error")
     _add_common_options(parser)
 
     (options, args) = parser.parse_args(args=argv[1:])
@@ -2580,9 +4716,14 @@ def _main(argv):
         import msvcrt, os
         msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
 
+    stats = None
+    if options.profile:
+        stats = Stats()
+        start = _clock()
+
     if options.read_png:
         # Encode PNG to PPM
-        png = Reader(file=infile)
+        png = Reader(file=infile, stats=stats)
         width,height,pixels,meta = png.asDirect()
         write_pnm(outfile, width, height, pixels, meta) 
     else:
@@ -2613,7 +4754,14 @@ def _main(argv):
                         background=options.background,
                         alpha=bool(pamalpha or options.alpha),
                         gamma=options.gamma,
-                        compression=options.compression)
+                        compression=options.compression,
+                        optimize=options.optimize,
+                        strategy=options.strategy,
+                        window_bits=options.window_bits,
+                        mem_level=options.mem_level,
+                        filter_type=options.filter,
+                        preset=options.preset,
+                        stats=stats)
         if options.alpha:
             pgmfile = open(options.alpha, 'rb')
             format, awidth, aheight, adepth, amaxval = \
@@ -2630,6 +4778,8 @@ def _main(argv):
         else:
             writer.convert_pnm(infile, outfile)
 
+    if stats:
+        sys.stderr.write(stats.report(_clock() - start))
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,127 @@
+# pngasync.py
+
+# asyncio support for PyPNG.
+
+"""
+Encode and decode PNG images from :mod:`asyncio` code, without
+stalling the event loop.
+
+Filtering, compression, and decompression are CPU-bound, so they are
+run in an executor (by default, the event loop's default thread pool
+executor).  :func:`aencode` writes the chunks of the PNG file to an
+:class:`asyncio.StreamWriter` as they are produced, waiting for the
+stream to drain, and the encoder waits when more than a few chunks
+are waiting to be written, so memory use is bounded.  Cancelling the
+coroutine stops the encoder (or decoder) at the next row or chunk.
+
+This module needs Python 3.5 or later.  Use it through
+:func:`png.aencode` and :meth:`png.Reader.aread`.
+"""
+
+import asyncio
+import threading
+
+import png
+
+class Cancelled(png.Error):
+    """Raised in the executor, to stop encoding or decoding when the
+    coroutine is cancelled."""
+
+async def aencode(writer, stream, rows, executor=None, buffers=8):
+    """Write a PNG image to `stream` using the :class:`png.Writer`
+    `writer`.  `rows` is as for :meth:`png.Writer.write`; it is
+    consumed in the executor.  `stream` is an
+    :class:`asyncio.StreamWriter` (or any object with a ``write``
+    method and, optionally, a ``drain`` coroutine method).  At most
+    `buffers` pieces of output are held waiting to be written.
+    Returns the number of bytes written.
+    """
+
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue()
+    room = threading.Semaphore(buffers)
+    cancelled = threading.Event()
+    drain = getattr(stream, 'drain', None)
+
+    class Sink:
+        """File-like object used by the writer in the executor.  Each
+        chunk arrives as a list of parts, from one call to
+        :meth:`writelines`."""
+        def write(self, data):
+            self.writelines([data])
+        def writelines(self, parts):
+            room.acquire()
+            if cancelled.is_set():
+                raise Cancelled("encoding cancelled")
+            loop.call_soon_threadsafe(queue.put_nowait, parts)
+
+    def checked(rows):
+        for row in rows:
+            if cancelled.is_set():
+                raise Cancelled("encoding cancelled")
+            yield row
+
+    def encode():
+        try:
+            writer.write(Sink(), checked(rows))
+        finally:
+            # End marker.
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    future = loop.run_in_executor(executor, encode)
+    written = 0
+    try:
+        while True:
+            parts = await queue.get()
+            if parts is None:
+                break
+            for data in parts:
+                stream.write(data)
+                written += len(data)
+            room.release()
+            if drain:
+                await drain()
+        await future
+    except BaseException:
+        # Cancelled, or the stream failed: stop the encoder, and let
+        # it past any wait for room.
+        _cancel(future, cancelled)
+        for _ in range(buffers):
+            room.release()
+        raise
+    return written
+
+async def aread(reader, executor=None, method='read'):
+    """Decode the PNG image of the :class:`png.Reader` `reader` in the
+    executor.  `method` names the reader method used (for example,
+    ``'asDirect'`` or ``'asRGBA8'``).  Returns (*width*, *height*,
+    *pixels*, *metadata*) like that method, except that *pixels* is a
+    list of rows.
+    """
+
+    loop = asyncio.get_event_loop()
+    cancelled = threading.Event()
+
+    def decode():
+        width,height,pixels,info = getattr(reader, method)()
+        rows = []
+        for row in pixels:
+            if cancelled.is_set():
+                raise Cancelled("decoding cancelled")
+            rows.append(row)
+        return width, height, rows, info
+
+    future = loop.run_in_executor(executor, decode)
+    try:
+        return await future
+    except asyncio.CancelledError:
+        _cancel(future, cancelled)
+        raise
+
+def _cancel(future, cancelled):
+    """Tell the work in the executor to stop, and make sure that the
+    :class:`Cancelled` exception it then raises is not reported.
+    """
+
+    cancelled.set()
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
@@ -0,0 +1,259 @@
+# pngbenchmark.py
+
+# Benchmarks for PyPNG.
+
+"""
+Time PyPNG decoding and encoding on a fixed set of images, and compare
+the results with an earlier run.
+
+The cases are:
+
+``decode/NAME``, ``encode/NAME``
+  Decode (with :meth:`png.Reader.read`) and re-encode each image of
+  the PNG suite (:mod:`pngsuite`), which between them cover every
+  colour type and bit depth, interlacing, palettes, and
+  transparency.
+``decode/nao_pic2/METHOD``
+  Decode the 640x480 camera frame ``nao_pic2.png`` with
+  :meth:`png.Reader.read`, :meth:`~png.Reader.asDirect`,
+  :meth:`~png.Reader.asRGBA8`, and with a pipelined reader.
+``encode/FRAME/SETTINGS``
+  Encode the raw 640x480 RGB camera frames ``pythonBytes.txt`` and
+  ``unityBytes.txt`` with the default settings, the 'fast' preset,
+  the Paeth filter, and colour type reduction.
+``tool/NAME``
+  Run a tool script on ``greytv.png``, in a new interpreter (so the
+  time includes starting Python and importing :mod:`png`).
+``import/python``, ``import/png``
+  Start Python and do nothing, and start Python and import
+  :mod:`png`; the difference is the time taken to import it.
+
+The camera frames are looked for in the top directory of the
+repository (two directories above this file) unless another directory
+is given.  Cases whose files are missing are left out.
+
+Each case is run in rounds of enough calls to take at least
+`min_time` seconds; the time of a call is that of the best round
+(the least disturbed by other work on the machine), and the median
+round is recorded too.  Nothing needs the network.
+
+The results are a dictionary, saved as JSON, with the keys
+``'python'``, ``'platform'``, ``'png'`` (the version of :mod:`png`),
+``'cpngfilters'`` (whether the compiled filters are used), and
+``'results'``, which maps each case name to a dictionary: ``'best'``
+and ``'median'`` (seconds per call), ``'calls'`` and ``'rounds'``,
+and ``'error'`` (a message, when the case failed; the times are then
+``None``).
+"""
+
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from array import array
+from io import BytesIO
+
+import png
+import pngsuite
+
+# The clock.
+clock = getattr(time, 'perf_counter', time.time)
+
+# The directory of this file, and of the camera frames.
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA = os.path.join(HERE, os.pardir, os.pardir)
+
+# The size of the camera frames.
+FRAME_SIZE = (640, 480)
+
+# How much slower (as a fraction) a case must be than the baseline to
+# count as a regression, by the start of its name.  Running a tool,
+# and importing, include starting Python, which varies more.
+THRESHOLDS = {'decode': 0.2, 'encode': 0.2, 'tool': 0.3, 'import': 0.3}
+
+class Error(png.Error):
+    pass
+
+def cases(data=None):
+    """Return the benchmark cases, as a list of (*name*, *function*)
+    pairs; each function does the work once.  `data` is the
+    directory of the camera frames (default: :data:`DATA`).
+    """
+
+    if data is None:
+        data = DATA
+    result = []
+    for name in sorted(pngsuite.png):
+        result.append(('decode/' + name, _decoder(pngsuite.png[name])))
+    for name in sorted(pngsuite.png):
+        result.append(('encode/' + name, _encoder(pngsuite.png[name])))
+
+    path = os.path.join(data, 'nao_pic2.png')
+    if os.path.exists(path):
+        pic = open(path, 'rb').read()
+        for method in ('read', 'asDirect', 'asRGBA8'):
+            result.append(('decode/nao_pic2/' + method,
+                           _decoder(pic, method)))
+        result.append(('decode/nao_pic2/pipeline',
+                       _decoder(pic, pipeline=True)))
+
+    settings = [('default', {}),
+                ('fast', dict(preset='fast')),
+                ('paeth', dict(filter_type=4)),
+                ('optimize', dict(optimize=True))]
+    for frame in ('pythonBytes', 'unityBytes'):
+        path = os.path.join(data, frame + '.txt')
+        if not os.path.exists(path):
+            continue
+        rows = _frame_rows(open(path, 'rb').read())
+        for name,options in settings:
+            result.append(('encode/%s/%s' % (frame, name),
+                           _frame_encoder(rows, options)))
+
+    greytv = os.path.join(HERE, 'greytv.png')
+    tools = [('piprgb', ['piprgb', greytv]),
+             ('pipasgrey', ['pipasgrey', greytv]),
+             ('pnglsch', ['pnglsch', greytv]),
+             ('pipwindow', ['pipwindow', '0', '0', '64', '64', greytv]),
+             ('pipdither', ['pipdither', '-b', '4', greytv]),
+             ('png-r', ['png.py', '-r', greytv])]
+    for name,argv in tools:
+        argv[0] = os.path.join(HERE, argv[0])
+        result.append(('tool/' + name, _command(name, argv)))
+    result.append(('import/python', _command('python', ['-c', 'pass'])))
+    result.append(('import/png', _command('python', ['-c', 'import png'])))
+    return result
+
+def _consume(rows):
+    for row in rows:
+        pass
+
+def _decoder(data, method='read', **options):
+    def decode():
+        _consume(getattr(png.Reader(bytes=data, **options), method)()[2])
+    return decode
+
+def _encoder(data):
+    r = png.Reader(bytes=data)
+    width,height,pixels,info = r.read()
+    rows = list(pixels)
+    del info['size']
+    if 'palette' in info:
+        # The background colour is a palette index, which
+        # :class:`png.Writer` does not take.
+        info.pop('background', None)
+    writer = png.Writer(width, height, **info)
+    def encode():
+        writer.write(BytesIO(), rows)
+    return encode
+
+def _frame_rows(data):
+    """Split a raw RGB camera frame into rows."""
+
+    width,height = FRAME_SIZE
+    if len(data) != width * height * 3:
+        raise Error("camera frame is %d bytes, not %d." %
+          (len(data), width * height * 3))
+    a = array('B', data)
+    n = width * 3
+    return [a[i:i+n] for i in range(0, len(a), n)]
+
+def _frame_encoder(rows, options):
+    width,height = FRAME_SIZE
+    def encode():
+        png.Writer(width, height, **options).write(BytesIO(), rows)
+    return encode
+
+def _command(name, argv):
+    """Return a function that runs Python with the arguments `argv`,
+    and raises :class:`Error` when it fails."""
+
+    argv = [sys.executable] + argv
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+      [HERE] + [p for p in [env.get('PYTHONPATH')] if p])
+    def command():
+        with open(os.devnull, 'wb') as null:
+            p = subprocess.Popen(argv, stdout=null, stderr=subprocess.PIPE,
+                                 env=env)
+            err = p.communicate()[1]
+        if p.returncode:
+            lines = err.decode('latin-1').strip().splitlines() or ['']
+            raise Error("%s exited with status %d: %s" %
+              (name, p.returncode, lines[-1]))
+    return command
+
+def run(cases, rounds=5, min_time=0.1, log=None):
+    """Run the benchmark `cases` (as returned by :func:`cases`) and
+    return the results dictionary.  Each case is run in `rounds`
+    rounds of at least `min_time` seconds.  When `log` is given, a
+    line for each case is written to it.
+    """
+
+    results = {}
+    for name,f in cases:
+        try:
+            result = _time(f, rounds, min_time)
+        except Exception as e:
+            result = dict(best=None, median=None, calls=0, rounds=0,
+                          error=str(e))
+        results[name] = result
+        if log:
+            if result['best'] is None:
+                log.write('%-32s %s\n' % (name, result['error']))
+            else:
+                log.write('%-32s %10.6f s  (median %.6f s, %d x %d)\n' %
+                  (name, result['best'], result['median'],
+                   result['rounds'], result['calls']))
+    return dict(python=platform.python_version(),
+                platform=platform.platform(),
+                png=png.__version__,
+                cpngfilters=png.pngfilters.__name__ == 'cpngfilters',
+                results=results)
+
+def _time(f, rounds, min_time):
+    """Time the function `f`.  Returns the result for one case."""
+
+    # Find the number of calls that takes at least `min_time`.
+    calls = 1
+    while True:
+        t = _round(f, calls)
+        if t >= min_time:
+            break
+        calls *= 2 if t * 10 > min_time else 10
+    times = [t] + [_round(f, calls) for _ in range(rounds - 1)]
+    times.sort()
+    return dict(best=times[0] / calls,
+                median=times[len(times) // 2] / calls,
+                calls=calls, rounds=len(times), error=None)
+
+def _round(f, calls):
+    start = clock()
+    for _ in range(calls):
+        f()
+    return clock() - start
+
+def compare(results, baseline, threshold=None):
+    """Compare the `results` with the `baseline` (earlier results).
+    Returns a list of (*name*, *before*, *after*, *ratio*,
+    *regressed*) tuples, for the cases that have times in both.  A
+    case has regressed when its best time is more than the threshold
+    (a fraction) slower than the baseline; `threshold` replaces the
+    thresholds of :data:`THRESHOLDS` when it is given.
+    """
+
+    comparison = []
+    old = baseline['results']
+    for name,result in sorted(results['results'].items()):
+        before = old.get(name, {}).get('best')
+        after = result['best']
+        if before is None or after is None:
+            continue
+        limit = threshold
+        if limit is None:
+            limit = THRESHOLDS.get(name.split('/')[0], 0.2)
+        ratio = after / before
+        comparison.append((name, before, after, ratio, ratio > 1 + limit))
+    return comparison
@@ -0,0 +1,168 @@
+# pngcomposite.py
+
+# Alpha compositing of PNG images.
+
+"""
+Composite pixels that have an alpha channel *over* a background.
+
+The source rows are in boxed row flat pixel format, LA or RGBA (`planes`
+is 2 or 4).  The background is either a single colour
+(:func:`over_colour`) or another image (:func:`over_rows`), without an
+alpha channel, with the same number of colour channels and the same bit
+depth as the source.  The result rows have no alpha channel.
+
+Each result value is computed with integer arithmetic::
+
+    (a*v + (maxval-a)*b + maxval//2) // maxval
+
+where *v* is the source value, *a* its alpha, *b* the background value,
+and *maxval* is ``2**bitdepth - 1``.
+
+Whole rows are processed at once.  When NumPy is available it is used;
+otherwise, for bit depths up to 8, the products and quotient come from
+lookup tables indexed by pairs of bytes interleaved into 16-bit keys, so
+that each row is handled by a few C-level ``map`` calls.  For 16-bit
+images without NumPy, the arithmetic is done per value.
+"""
+
+from array import array
+import itertools
+import operator
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import png
+
+izip = getattr(itertools, 'izip', zip)
+
+def over_colour(pixels, colour, planes, bitdepth):
+    """Composite the rows of `pixels` (with `planes` channels,
+    including alpha) over the background `colour`, a sequence of
+    ``planes-1`` values.  Yields rows without alpha.
+    """
+
+    blend = blender(planes, bitdepth)
+    typecode = 'BH'[bitdepth > 8]
+    colour = array(typecode, colour)
+    background = None
+    for row in pixels:
+        if background is None:
+            background = colour * (len(row) // planes)
+        yield blend(row, background)
+
+def over_rows(pixels, background, planes, bitdepth):
+    """Composite the rows of `pixels` (with `planes` channels,
+    including alpha) over the corresponding rows of `background`
+    (with ``planes-1`` channels).  Both are consumed in lockstep.
+    Yields rows without alpha.
+    """
+
+    blend = blender(planes, bitdepth)
+    for row,bg in izip(pixels, background):
+        yield blend(row, bg)
+
+def blender(planes, bitdepth):
+    """Return a function that composites a single row (`planes`
+    channels, including alpha) over a background row (``planes-1``
+    channels), returning an array.
+    """
+
+    if numpy:
+        return _blender_numpy(planes, bitdepth)
+    if bitdepth <= 8:
+        return _blender_table(planes, bitdepth)
+    return _blender_int(planes, bitdepth)
+
+def _blender_numpy(planes, bitdepth):
+    maxval = 2**bitdepth - 1
+    cp = planes - 1
+    typecode = 'BH'[bitdepth > 8]
+    def blend(row, bg):
+        a = numpy.asarray(row, dtype=numpy.uint32).reshape(-1, planes)
+        b = numpy.asarray(bg, dtype=numpy.uint32).reshape(-1, cp)
+        alpha = a[:,cp:]
+        out = (a[:,:cp]*alpha + b*(maxval-alpha) + maxval//2) // maxval
+        return array(typecode, out.astype(typecode).tobytes())
+    return blend
+
+def _blender_int(planes, bitdepth):
+    maxval = 2**bitdepth - 1
+    half = maxval // 2
+    cp = planes - 1
+    typecode = 'BH'[bitdepth > 8]
+    def over(v, a, b):
+        return (a*v + (maxval-a)*b + half) // maxval
+    def blend(row, bg):
+        row = array(typecode, row)
+        n = len(row) // planes
+        values = array(typecode, [0]) * (n*cp)
+        alpha = array(typecode, [0]) * (n*cp)
+        for c in range(cp):
+            values[c::cp] = row[c::planes]
+            alpha[c::cp] = row[cp::planes]
+        return array(typecode, map(over, values, alpha, bg))
+    return blend
+
+# Lookup tables for :func:`_blender_table`, built on first use.
+_product = None
+_quotient = {}
+
+def _blender_table(planes, bitdepth):
+    global _product
+
+    maxval = 2**bitdepth - 1
+    cp = planes - 1
+    if _product is None:
+        # a*v, indexed by (a << 8) + v.
+        _product = [(k >> 8) * (k & 0xff) for k in range(2**16)]
+    if maxval not in _quotient:
+        # Rounded division by maxval, indexed by the sum of two
+        # products.
+        _quotient[maxval] = [(s + maxval//2) // maxval
+                             for s in range(maxval*maxval + 1)]
+    quotient = _quotient[maxval].__getitem__
+    # Maps alpha to maxval-alpha.
+    invert = _bytes([(maxval-x) & 0xff for x in range(256)])
+
+    def products(a, b):
+        """An iterator over the products of each pair of bytes in the
+        equal length byte strings `a` and `b`.
+        """
+
+        keys = bytearray(2*len(a))
+        keys[0::2] = a
+        keys[1::2] = b
+        keys = array('H', bytes(keys))
+        if sys.byteorder == 'little':
+            keys.byteswap()
+        return map(_product.__getitem__, keys)
+
+    def blend(row, bg):
+        row = _tobytes(row)
+        n = len(row) // planes
+        values = bytearray(n*cp)
+        alpha = bytearray(n*cp)
+        for c in range(cp):
+            values[c::cp] = row[c::planes]
+            alpha[c::cp] = row[cp::planes]
+        s = map(operator.add,
+                products(alpha, values),
+                products(alpha.translate(invert), _tobytes(bg)))
+        return array('B', map(quotient, s))
+    return blend
+
+def _bytes(l):
+    """Convert a list of integers to a byte string."""
+
+    return bytes(bytearray(l))
+
+def _tobytes(row):
+    """Convert a row of 8-bit values to a byte string."""
+
+    if not isinstance(row, array) or row.itemsize != 1:
+        row = array('B', row)
+    return png.tobytes(row)
@@ -0,0 +1,133 @@
+# pnggamma.py
+
+# Gamma and other transfer functions, by lookup table.
+
+"""
+Recode whole rows of samples with lookup tables.
+
+Recoding a sample (to another gamma, bit depth, or to a float) costs
+a table lookup rather than arithmetic done in Python.  A table maps
+every value of a given bit depth, so it has at most 65536 entries, and
+each table is made once and kept (the most recently used
+:data:`KEEP` are kept).  Rows of bytes that are recoded to bytes
+go through ``bytes.translate``, which does the whole row in C.
+
+A sample *v* of bit depth *b* stands for the intensity *v* /
+(``2**b`` - 1), encoded with a gamma: the exponent that was applied
+to the linear light intensity (as in a ``gAMA`` chunk; 1.0 is linear
+light).  Recoding a sample encoded with the gamma *g* to the gamma *t*
+raises its intensity to the power *t* / *g*; that ratio is the
+`exponent` of :func:`table`.
+
+Use this module through :meth:`png.Reader.asGamma` and
+:meth:`png.Reader.asFloat`.
+"""
+
+from array import array
+
+import png
+
+# The most tables that are kept.
+KEEP = 16
+
+# The tables, by their arguments; most recently used last.
+_tables = {}
+_order = []
+
+def table(bitdepth, exponent=1.0, targetbitdepth=None, maxval=1.0):
+    """Return the table that recodes samples of `bitdepth` bits,
+    raising their intensities to the power `exponent`.  When
+    `targetbitdepth` is given the table is an ``array`` of samples of
+    that bit depth; otherwise it is a list of floats from 0.0 to
+    `maxval`.
+    """
+
+    key = (bitdepth, float(exponent), targetbitdepth, float(maxval))
+    if key in _tables:
+        _order.remove(key)
+        _order.append(key)
+        return _tables[key]
+
+    sourcemaxval = 2**bitdepth - 1
+    values = range(sourcemaxval + 1)
+    if targetbitdepth is None:
+        factor = float(maxval) / float(sourcemaxval)
+        if exponent == 1:
+            result = [factor * v for v in values]
+        else:
+            result = [maxval * (v / float(sourcemaxval)) ** exponent
+                      for v in values]
+    else:
+        targetmaxval = 2**targetbitdepth - 1
+        factor = float(targetmaxval) / float(sourcemaxval)
+        if exponent == 1:
+            codes = [int(round(v * factor)) for v in values]
+        else:
+            codes = [int(round(targetmaxval *
+                               (v / float(sourcemaxval)) ** exponent))
+                     for v in values]
+        result = array('BH'[targetbitdepth > 8], codes)
+
+    _tables[key] = result
+    _order.append(key)
+    while len(_order) > KEEP:
+        del _tables[_order.pop(0)]
+    return result
+
+def recode(rows, table, planes=1, alphatable=None):
+    """Recode each row of `rows` (an iterable of rows of samples) with
+    `table` (from :func:`table`), and yield the new rows: lists of
+    floats for a list of floats, and arrays otherwise.  When
+    `alphatable` is given the last of each pixel's `planes` samples,
+    the alpha channel, is recoded with it instead.
+    """
+
+    translate = _bytewise(table)
+    if alphatable is not None:
+        translate = translate and _bytewise(alphatable)
+    if translate:
+        # Samples of 8 bits or fewer, to 8 bits or fewer.
+        chars = png.tobytes(_padded(table))
+        if alphatable is not None:
+            alphachars = png.tobytes(_padded(alphatable))
+        for row in rows:
+            if not (isinstance(row, array) and row.itemsize == 1):
+                row = array('B', row)
+            b = png.tobytes(row)
+            out = array('B', b.translate(chars))
+            if alphatable is not None:
+                out[planes-1::planes] = array('B',
+                  b[planes-1::planes].translate(alphachars))
+            yield out
+        return
+
+    make = _maker(table)
+    get = table.__getitem__
+    if alphatable is not None:
+        alphamake = _maker(alphatable)
+        alphaget = alphatable.__getitem__
+    for row in rows:
+        out = make(map(get, row))
+        if alphatable is not None:
+            out[planes-1::planes] = alphamake(map(alphaget,
+                                                  row[planes-1::planes]))
+        yield out
+
+def _maker(table):
+    """The function that makes a row of the type of `table` from an
+    iterable."""
+
+    if isinstance(table, list):
+        return list
+    return lambda values: array(table.typecode, values)
+
+def _bytewise(table):
+    """Whether `table` recodes bytes to bytes."""
+
+    return (isinstance(table, array) and table.itemsize == 1 and
+            len(table) <= 256)
+
+def _padded(table):
+    """`table` made up to 256 entries, for ``bytes.translate``."""
+
+    return table + array('B', [0] * (256 - len(table)))
@@ -0,0 +1,136 @@
+# pnghistogram.py
+
+# Histograms of PNG images.
+
+"""
+Count the sample values of PNG images, one histogram per channel.
+
+:func:`histogram` counts the values in some pixel data (in boxed row
+flat pixel format); :func:`histogram_file` does the same for a PNG
+file; :func:`histogram_files` aggregates the histograms of many PNG
+files, using a pool of worker processes.
+
+A histogram is returned as a list with one entry per channel (so 3
+entries for an RGB image); each entry is a list of ``2**bitdepth``
+counts, with the count for value *v* at index *v*.
+
+Rows are gathered into blocks and each channel of a block is counted
+in one go, either by ``numpy.bincount`` (when NumPy is available) or
+by a :class:`collections.Counter`.
+"""
+
+from array import array
+import collections
+import operator
+
+import png
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The number of sample values gathered into a block before counting.
+BLOCK = 2**18
+
+class Error(png.Error):
+    pass
+
+def histogram(pixels, planes, bitdepth):
+    """Return the histogram of `pixels`, which should be an iterable
+    of rows in boxed row flat pixel format, with `planes` channels,
+    each channel having `bitdepth` bits.
+    """
+
+    levels = 2**bitdepth
+    typecode = 'BH'[bitdepth > 8]
+    counts = [[0]*levels for _ in range(planes)]
+    block = array(typecode)
+    for row in pixels:
+        if not (isinstance(row, array) and row.typecode == typecode):
+            # Convert the whole row first: extend can add part of a
+            # row before it fails.
+            try:
+                row = array(typecode, row)
+            except TypeError:
+                # Rows of lists (for example, from an sBIT rescale) or
+                # of NumPy integers.
+                row = array(typecode, map(int, row))
+        block.extend(row)
+        if len(block) >= BLOCK:
+            _count(counts, block, planes, levels)
+            del block[:]
+    if block:
+        _count(counts, block, planes, levels)
+    return counts
+
+def _count(counts, block, planes, levels):
+    """Add the counts for each channel of `block` into `counts`."""
+
+    if numpy:
+        a = numpy.frombuffer(block, dtype=block.typecode)
+        for c in range(planes):
+            n = numpy.bincount(a[c::planes], minlength=levels)
+            counts[c] = list(map(operator.add, counts[c], n.tolist()))
+        return
+    for c in range(planes):
+        channel = counts[c]
+        for v,n in collections.Counter(block[c::planes]).items():
+            channel[v] += n
+
+def histogram_file(filename):
+    """Return the histogram of the PNG file `filename`, as a
+    (*histogram*, *info*) pair.  *info* is the metadata dictionary
+    returned by :meth:`png.Reader.asDirect` (so palettes are expanded
+    and the histogram is of the direct colour values).
+    """
+
+    r = png.Reader(filename=filename)
+    _,_,pixels,info = r.asDirect()
+    return histogram(pixels, info['planes'], info['bitdepth']), info
+
+def _histogram_file(filename):
+    """Worker for :func:`histogram_files`.  Returns a picklable
+    (*planes*, *bitdepth*, *histogram*) triple.
+    """
+
+    counts,info = histogram_file(filename)
+    return info['planes'], info['bitdepth'], counts
+
+def histogram_files(filenames, processes=None, chunksize=16):
+    """Return the sum of the histograms of all the PNG files named in
+    `filenames` (an iterable), as a (*histogram*, *planes*,
+    *bitdepth*) triple.  All the files must have the same number of
+    channels and the same bit depth (after :meth:`png.Reader.asDirect`).
+
+    The files are decoded by a pool of `processes` worker processes
+    (default: one per CPU); `chunksize` file names are handed to a
+    worker at a time.  When `processes` is 1 no pool is used.
+    """
+
+    if processes == 1:
+        results = map(_histogram_file, filenames)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_histogram_file, filenames, chunksize)
+    total = None
+    try:
+        for planes,bitdepth,counts in results:
+            if total is None:
+                total,tplanes,tbitdepth = counts,planes,bitdepth
+                continue
+            if (planes,bitdepth) != (tplanes,tbitdepth):
+                raise Error("cannot add histograms of %d channel, %d bit"
+                  " and %d channel, %d bit images." %
+                  (tplanes, tbitdepth, planes, bitdepth))
+            total = [list(map(operator.add, t, c))
+                     for t,c in zip(total, counts)]
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    if total is None:
+        raise Error("no files to histogram.")
+    return total, tplanes, tbitdepth
@@ -0,0 +1,196 @@
+# pngoptimize.py
+
+# Brute force PNG size optimization.
+
+"""
+Re-encode a PNG image as small as possible, by trying many
+combinations of settings and keeping the smallest result (in the
+manner of ``optipng``).
+
+The settings tried are the PNG filter type, the zlib compression level
+and strategy, and the colour type: each combination is tried both with
+the image's own colour type and bit depth, and with the smallest
+colour type and bit depth that represents it exactly (see
+:meth:`png.Writer.optimized`).  The trials are shared among a pool of
+worker processes.  The result is checked by decoding it with
+:class:`png.Reader` and comparing the pixels with the original.
+
+Only the chunks that :class:`png.Writer` writes are kept (``gAMA``,
+``PLTE``, ``tRNS``, ``bKGD``, and ``pHYs``); others, including
+``sBIT``, are dropped.  The result is never interlaced.
+"""
+
+from io import BytesIO
+import itertools
+
+import png
+
+izip = getattr(itertools, 'izip', zip)
+
+# The settings tried, by default.
+FILTERS = (0, 1, 2, 3, 4)
+STRATEGIES = ('default', 'filtered', 'huffman', 'rle')
+LEVELS = (9,)
+
+class Error(png.Error):
+    pass
+
+def trials(filters=FILTERS, strategies=STRATEGIES, levels=LEVELS):
+    """Return a list of the combinations of settings to try.  Each is
+    a dictionary of keyword arguments for :class:`png.Writer`.
+    """
+
+    return [dict(optimize=reduced, filter_type=f,
+                 strategy=s, compression=level)
+            for reduced in (False, True)
+            for f in filters
+            for s in strategies
+            for level in levels]
+
+def optimize(data, processes=None, filters=FILTERS, strategies=STRATEGIES,
+             levels=LEVELS):
+    """Re-encode the PNG image `data` (a byte string) in the smallest
+    size found.  Returns a pair (*data*, *settings*): the smallest PNG
+    found, and the settings that produced it (a dictionary, as
+    returned by :func:`trials`).  When no setting produces an image
+    smaller than the original, the original is returned and
+    *settings* is ``None``.
+
+    Each combination of `filters`, `strategies`, and `levels` is
+    tried, with and without colour type reduction.  The trials are
+    run by `processes` worker processes (default: one per CPU); when
+    `processes` is 1 no pool is used.
+    """
+
+    writers = _writers(data)
+    settings = trials(filters, strategies, levels)
+    if writers[True][0].color_type == writers[False][0].color_type and (
+      writers[True][0].bitdepth == writers[False][0].bitdepth):
+        # Colour type reduction makes no difference.
+        settings = [s for s in settings if not s['optimize']]
+
+    if processes == 1:
+        _init(data)
+        results = map(_trial, enumerate(settings))
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, _init, (data,))
+        results = pool.imap_unordered(_trial, enumerate(settings))
+    best = None
+    try:
+        for i,result in results:
+            # Ties go to the earliest trial, so the result does not
+            # depend on the order the workers finish.
+            if best is None or (len(result), i) < (len(best[1]), best[0]):
+                best = i,result
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    i,result = best
+    if len(result) >= len(data):
+        return data, None
+    verify(data, result)
+    return result, settings[i]
+
+def verify(original, data):
+    """Check that the PNG images `original` and `data` (byte strings)
+    have the same pixels, raising :class:`Error` if they do not.  The
+    images may have different colour types and bit depths.
+    """
+
+    w1,h1,pixels1 = _rgba16(original)
+    w2,h2,pixels2 = _rgba16(data)
+    if (w1,h1) != (w2,h2):
+        raise Error("optimized image is %dx%d, not %dx%d." %
+          (w2, h2, w1, h1))
+    for i,(a,b) in enumerate(izip(pixels1, pixels2)):
+        if a != b:
+            raise Error("optimized image differs in row %d." % i)
+
+def _rgba16(data):
+    """Decode the PNG image `data` as 16-bit RGBA.  Returns (*width*,
+    *height*, *pixels*), with each row a list.  Any ``sBIT`` chunk is
+    ignored, so that the stored values are compared.
+    """
+
+    r = png.Reader(bytes=data)
+    r.preamble()
+    r.sbit = None
+    width,height,pixels,info = r.asRGBA()
+    maxval = 2**info['bitdepth'] - 1
+    table = [v*65535 // maxval for v in range(maxval+1)]
+    return width, height, (list(map(table.__getitem__, row))
+                           for row in pixels)
+
+def _writers(data):
+    """Decode the PNG image `data` and return a dictionary that maps
+    ``False`` to a (*writer*, *rows*) pair for the image as it is, and
+    ``True`` to the same for the image reduced by
+    :meth:`png.Writer.optimized`.
+    """
+
+    r = png.Reader(bytes=data)
+    r.preamble()
+    r.sbit = None
+    if r.colormap:
+        # The palette is rebuilt by the reduction.
+        width,height,pixels,info = r.asDirect()
+    else:
+        # The stored values, keeping any tRNS chunk as a transparent
+        # colour rather than converting it to an alpha channel.
+        width,height,pixels,info = r.read()
+    rows = list(pixels)
+    writer = png.Writer(width, height,
+                        greyscale=info['greyscale'],
+                        alpha=info['alpha'],
+                        bitdepth=info['bitdepth'],
+                        gamma=info.get('gamma'),
+                        transparent=(None if r.colormap
+                                     else info.get('transparent')),
+                        background=(None if r.colormap
+                                    else info.get('background')),
+                        x_pixels_per_unit=getattr(r, 'x_pixels_per_unit',
+                                                  None),
+                        y_pixels_per_unit=getattr(r, 'y_pixels_per_unit',
+                                                  None),
+                        unit_is_meter=getattr(r, 'unit_is_meter', False))
+    return {False: (writer, rows), True: writer.optimized(rows)}
+
+# The (writer, rows) pairs for the image being optimized, in each
+# worker process.
+_source = None
+
+def _init(data):
+    """Initialiser for the worker processes."""
+
+    global _source
+    _source = _writers(data)
+
+def _trial(arg):
+    """Encode the image with one set of settings.  `arg` is an
+    (*index*, *settings*) pair; returns (*index*, *data*).
+    """
+
+    i,settings = arg
+    writer,rows = _source[settings['optimize']]
+    writer = png.Writer(size=(writer.width, writer.height),
+                        greyscale=writer.greyscale,
+                        alpha=writer.alpha,
+                        bitdepth=writer.bitdepth,
+                        palette=writer.palette,
+                        transparent=writer.transparent,
+                        background=writer.background,
+                        gamma=writer.gamma,
+                        x_pixels_per_unit=writer.x_pixels_per_unit,
+                        y_pixels_per_unit=writer.y_pixels_per_unit,
+                        unit_is_meter=writer.unit_is_meter,
+                        mem_level=9,
+                        filter_type=settings['filter_type'],
+                        strategy=settings['strategy'],
+                        compression=settings['compression'])
+    f = BytesIO()
+    writer.write(f, rows)
+    return i, f.getvalue()
@@ -0,0 +1,197 @@
+# pngpool.py
+
+# Decode many PNG files at once.
+
+"""
+Decode many PNG files with a pool of worker processes.
+
+Each file is decoded by a worker process.  Where
+:mod:`multiprocessing.shared_memory` is available (Python 3.8 and
+later), the parent process makes a few shared memory blocks (two for
+each worker), and each file is given one of them: the worker writes
+the pixels into the block, and the parent copies them out and gives
+the block to another file.  The pixels are not pickled and sent
+through a pipe, and since the blocks are made once and each worker
+opens each block once, a file costs only the two copies.  A block is
+made (or made bigger) when a file does not fit in it; the pixels of
+that file are sent back in the usual way.  The parent process removes
+the blocks when it is done, even when a worker fails or the results
+are not all used.
+
+On older versions of Python, or with one worker, the pixels are sent
+back in the usual way.
+
+Use this module through :func:`png.decode_many`.
+"""
+
+from array import array
+
+import png
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+def decode_many(paths, workers=None, as_ndarray=True, ordered=True,
+                method='asDirect'):
+    """Decode the PNG files named in `paths`, using `workers` worker
+    processes (default: one per CPU; when `workers` is 1 no pool is
+    used).  Returns an iterator that yields (*path*, *width*,
+    *height*, *pixels*, *metadata*) for each file: in the order of
+    `paths` when `ordered` is true, and otherwise in the order they
+    are decoded.
+
+    `method` names the :class:`png.Reader` method used to decode each
+    file (``'asDirect'``, ``'read'``, ``'asRGBA8'``, and so on).  When
+    `as_ndarray` is true, *pixels* is a NumPy array with the shape
+    (*height*, *width*, *planes*); otherwise it is a list of rows,
+    each an ``array``.
+    """
+
+    paths = list(paths)
+    if as_ndarray:
+        import numpy
+    else:
+        numpy = None
+    tasks = [(i, path, method, None, 0) for i,path in enumerate(paths)]
+    if workers == 1:
+        results = map(_decode, tasks)
+    elif shared_memory is None:
+        results = _imap(tasks, workers, ordered)
+    else:
+        results = _shared(tasks, workers, ordered)
+    for i,width,height,info,typecode,data in results:
+        if numpy:
+            pixels = numpy.frombuffer(data, dtype=numpy.dtype(typecode))
+            pixels = pixels.reshape(height, width, info['planes'])
+        else:
+            vpr = width * info['planes']
+            pixels = [data[j:j+vpr] for j in range(0, len(data), vpr)]
+        yield paths[i], width, height, pixels, info
+
+def _imap(tasks, workers, ordered):
+    """Decode the files with a pool of processes, and pickle the
+    pixels."""
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        if ordered:
+            results = pool.imap(_decode, tasks)
+        else:
+            results = pool.imap_unordered(_decode, tasks)
+        for result in results:
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _shared(tasks, workers, ordered):
+    """Decode the files with a pool of processes, passing the pixels
+    back in shared memory blocks."""
+
+    import multiprocessing
+    from multiprocessing import resource_tracker
+
+    # The workers share this process's resource tracker (which
+    # removes the blocks if this process is killed); it must be
+    # running before they start.
+    resource_tracker.ensure_running()
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers)
+    # Each slot is a shared memory block (or None, until a file needs
+    # it), and the free slots.
+    slots = [None] * (2 * workers)
+    free = list(range(len(slots)))
+    # Finished tasks, as (slot, result, exception), from the pool's
+    # thread.
+    finished = queue.Queue()
+    # Results not yet yielded, by task index.
+    ready = {}
+    submitted = 0
+    yielded = 0
+
+    def submit(i, slot):
+        shm = slots[slot]
+        task = tasks[i][:3] + ((shm.name, shm.size) if shm else (None, 0))
+        pool.apply_async(_decode, (task,),
+          callback=lambda result: finished.put((slot, result, None)),
+          error_callback=lambda e: finished.put((slot, None, e)))
+
+    try:
+        while yielded < len(tasks):
+            # When the results are yielded in order, only start the
+            # tasks that can be finished without holding on to more
+            # than one result for each slot.
+            while free and submitted < len(tasks) and (not ordered or
+              submitted < yielded + len(slots)):
+                submit(submitted, free.pop())
+                submitted += 1
+            slot,result,e = finished.get()
+            if e is not None:
+                raise e
+            i,width,height,info,typecode,data = result
+            shm = slots[slot]
+            if data is None:
+                data = array(typecode)
+                n = width * height * info['planes'] * data.itemsize
+                data.frombytes(shm.buf[:n])
+            else:
+                # It did not fit: make a bigger block.
+                size = len(data) * data.itemsize
+                if shm:
+                    shm.close()
+                    shm.unlink()
+                slots[slot] = shared_memory.SharedMemory(create=True,
+                                                         size=size)
+            free.append(slot)
+            ready[i] = (i, width, height, info, typecode, data)
+            if ordered:
+                while yielded in ready:
+                    yield ready.pop(yielded)
+                    yielded += 1
+            else:
+                yield ready.pop(i)
+                yielded += 1
+    finally:
+        pool.terminate()
+        pool.join()
+        for shm in slots:
+            if shm:
+                shm.close()
+                shm.unlink()
+
+# In a worker process, the shared memory blocks it has opened, by
+# name.
+_blocks = {}
+
+def _decode(task):
+    """Decode one file.  `task` is (*index*, *path*, *method*,
+    *name*, *size*).  Returns (*index*, *width*, *height*,
+    *metadata*, *typecode*, *data*).  When *name* is not ``None`` and
+    the pixels fit in the `size` bytes of the shared memory block
+    called `name`, they are written there and *data* is ``None``;
+    otherwise *data* is an ``array`` of the pixels.
+    """
+
+    i,path,method,name,size = task
+    r = png.Reader(filename=path)
+    width,height,pixels,info = getattr(r, method)()
+    typecode = 'BH'[info['bitdepth'] > 8]
+    data = array(typecode)
+    for row in pixels:
+        data.extend(row)
+    n = len(data) * data.itemsize
+    if name is None or n > size:
+        return i, width, height, info, typecode, data
+    if name not in _blocks:
+        _blocks[name] = shared_memory.SharedMemory(name=name)
+    _blocks[name].buf[:n] = memoryview(data).cast('B')
+    return i, width, height, info, typecode, None
@@ -0,0 +1,101 @@
+# pngstack.py
+
+# Combine the channels of several PNG images.
+
+"""
+Stack the channels of several PNG images into one image.
+
+The number of channels in the result is the sum of the numbers of
+channels of the inputs, which must be at most 4; 1 channel gives a
+greyscale image, 2 greyscale with alpha, 3 RGB, and 4 RGBA.  So three
+greyscale images can be combined into an RGB image, or an RGB image
+and a greyscale image into an RGBA image.
+
+All the inputs must be the same size.  When the inputs have different
+bit depths the result has the largest of them, and the other inputs
+are rescaled through lookup tables.  The inputs are decoded in
+lockstep, one row from each at a time, so the memory used does not
+depend on the height of the images.
+"""
+
+from array import array
+import itertools
+
+import png
+
+izip = getattr(itertools, 'izip', zip)
+
+class Error(png.Error):
+    pass
+
+def stack(inputs):
+    """Stack the channels of the PNG images `inputs`.  Each input is
+    anything that :class:`png.Reader` accepts as its argument (a file
+    name, a file, or an array of bytes), or a :class:`png.Reader`
+    instance.  Returns (*width*, *height*, *pixels*, *info*) like
+    :meth:`png.Reader.asDirect`, where *pixels* is an iterator over
+    the stacked rows.
+    """
+
+    if len(inputs) < 1:
+        raise Error("Required input is missing.")
+
+    readers = [r if isinstance(r, png.Reader) else png.Reader(r)
+               for r in inputs]
+    # Let data be a list of (pixel,info) pairs.
+    data = [r.asDirect()[2:] for r in readers]
+    planes = [info['planes'] for _,info in data]
+    totalchannels = sum(planes)
+    if not (0 < totalchannels <= 4):
+        raise Error("Too many channels in input.")
+    size = set(info['size'] for _,info in data)
+    if len(size) > 1:
+        raise Error("Input sizes differ: %s." %
+          ', '.join('%dx%d' % s for s in sorted(size)))
+    width,height = size.pop()
+    bitdepth = max(info['bitdepth'] for _,info in data)
+    pixels = [rescale(p, info['bitdepth'], bitdepth) for p,info in data]
+    info = dict(size=(width, height), bitdepth=bitdepth,
+                greyscale=totalchannels in (1,2),
+                alpha=totalchannels in (2,4),
+                planes=totalchannels)
+    return (width, height,
+            stack_rows(pixels, planes, width, 'BH'[bitdepth > 8]), info)
+
+def stack_rows(pixels, planes, width, typecode='B'):
+    """Combine rows, one from each iterator in the list `pixels`,
+    into rows with all the channels.  `planes` gives the number of
+    channels in each input.  Each result row is an array of
+    `typecode`.
+    """
+
+    totalchannels = sum(planes)
+    # Values per row
+    vpr = totalchannels * width
+    for irow in izip(*pixels):
+        row = array(typecode, [0]) * vpr
+        # output channel
+        och = 0
+        for arow,n in zip(irow, planes):
+            if n == totalchannels:
+                row[:] = array(typecode, arow)
+                break
+            for j in range(n):
+                row[och::totalchannels] = array(typecode, arow[j::n])
+                och += 1
+        yield row
+
+def rescale(pixels, bitdepth, targetbitdepth):
+    """Rescale the values in the rows of `pixels` from `bitdepth` to
+    `targetbitdepth`, using a lookup table.  The rows are returned
+    unchanged when the bit depths are the same.
+    """
+
+    if bitdepth == targetbitdepth:
+        return pixels
+    maxval = 2**bitdepth - 1
+    targetmaxval = 2**targetbitdepth - 1
+    table = [(v*targetmaxval + maxval//2) // maxval
+             for v in range(maxval+1)]
+    typecode = 'BH'[targetbitdepth > 8]
+    return (array(typecode, map(table.__getitem__, row)) for row in pixels)
@@ -4,19 +4,33 @@
 
 """After you import this module with "import pngsuite" use
 ``pngsuite.bai0g01`` to get the bytes for a particular PNG image, or
-use ``pngsuite.png`` to get a dict() of them all.
+use ``pngsuite.png`` to get a dict-like mapping of them all.
+
+The images are stored here in hex, and each is only converted to
+bytes when it is first used (then kept), so importing this module is
+quick.  Optionally, the bytes are also kept in files in a directory
+(see :func:`use_cache`), for later processes to read.
 """
 
+import os
+import sys
+import types
+import zlib
+
 def _dehex(s):
     """Liberally convert from hex string to binary string."""
-    import re
     import binascii
 
-    # Remove all non-hexadecimal digits
-    s = re.sub(br'[^a-fA-F\d]', b'', s)
-    # binscii.unhexlify works in Python 2 and Python 3 (unlike
-    # thing.decode('hex')).
-    return binascii.unhexlify(s)
+    try:
+        # Usually only whitespace separates the digits.
+        # binscii.unhexlify works in Python 2 and Python 3 (unlike
+        # thing.decode('hex')).
+        return binascii.unhexlify(b''.join(s.split()))
+    except (TypeError, ValueError):
+        import re
+        # Remove all non-hexadecimal digits
+        s = re.sub(br'[^a-fA-F\d]', b'', s)
+        return binascii.unhexlify(s)
 
 # Copies of PngSuite test files taken
 # from http://www.schaik.com/pngsuite/pngsuite_bas_png.html
@@ -24,8 +38,8 @@ def _dehex(s):
 # Some of these are not actually in PngSuite (but maybe they should
 # be?), they use the same naming scheme, but start with a capital
 # letter.
-png = {
-  'basi0g01': _dehex(b"""
+_hex = {
+  'basi0g01': b"""
 89504e470d0a1a0a0000000d49484452000000200000002001000000012c0677
 cf0000000467414d41000186a031e8965f0000009049444154789c2d8d310ec2
 300c45dfc682c415187a00a42e197ab81e83b127e00c5639001363a580d8582c
@@ -33,15 +47,15 @@ cf0000000467414d41000186a031e8965f0000009049444154789c2d8d310ec2
 d92aaf4c9fd927ea449e6487df5b9c36e799b91bdf082b4d4bd4014fe4014b01
 ab7a17aee694d28d328a2d63837a70451e1648702d9a9ff4a11d2f7a51aa21e5
 a18c7ffd0094e3511d661822f20000000049454e44ae426082
-"""),
-  'basi0g02': _dehex(b"""
+""",
+  'basi0g02': b"""
 89504e470d0a1a0a0000000d49484452000000200000002002000000016ba60d
 1f0000000467414d41000186a031e8965f0000005149444154789c635062e860
 00e17286bb609c93c370ec189494960631366e4467b3ae675dcf10f521ea0303
 90c1ca006444e11643482064114a4852c710baea3f18c31918020c30410403a6
 0ac1a09239009c52804d85b6d97d0000000049454e44ae426082
-"""),
-  'basi0g04': _dehex(b"""
+""",
+  'basi0g04': b"""
 89504e470d0a1a0a0000000d4948445200000020000000200400000001e4e6f8
 bf0000000467414d41000186a031e8965f000000ae49444154789c658e5111c2
 301044171c141c141c041c843a287510ea20d441c041c141c141c04191102454
@@ -50,8 +64,8 @@ bf0000000467414d41000186a031e8965f000000ae49444154789c658e5111c2
 43d61e590764f5c83a226b40d669bec307f93247701687723abf31ff83a2284b
 a5b4ae6b63ac6520ad730ca4ed7b06d20e030369bd6720ed383290360406d24e
 13811f2781eba9d34d07160000000049454e44ae426082
-"""),
-  'basi0g08': _dehex(b"""
+""",
+  'basi0g08': b"""
 89504e470d0a1a0a0000000d4948445200000020000000200800000001211615
 be0000000467414d41000186a031e8965f000000b549444154789cb5905d0ac2
 3010849dbac81c42c47bf843cf253e8878b0aa17110f214bdca6be240f5d21a5
@@ -60,8 +74,8 @@ be0000000467414d41000186a031e8965f000000b549444154789cb5905d0ac2
 70ecbfa388dff1f03b82fb82bd07f05f7cb13f80bb07ad2fd60c011c3c588eef
 f1f4e03bbec7ce832dca927aea005e431b625796345307b019c845e6bfc3bb98
 769d84f9efb02ea6c00f9bb9ff45e81f9f280000000049454e44ae426082
-"""),
-  'basi0g16': _dehex(b"""
+""",
+  'basi0g16': b"""
 89504e470d0a1a0a0000000d49484452000000200000002010000000017186c9
 fd0000000467414d41000186a031e8965f000000e249444154789cb5913b0ec2
 301044c7490aa8f85d81c3e4301c8f53a4ca0da8902c8144b3920b4043111282
@@ -72,8 +86,8 @@ c60d5c81edcf6c58c535e252839e93801b15c0a70d810ae0d306b205dc32b187
 5c79c639fddba9dcb5456b51d7980eb52d8e7d7fa620a75120d6064641a05120
 b606771a05626b401a05f1f589827cf0fe44c1f0bae0055698ee8914fffffe00
 00000049454e44ae426082
-"""),
-  'basi2c08': _dehex(b"""
+""",
+  'basi2c08': b"""
 89504e470d0a1a0a0000000d49484452000000200000002008020000018b1fdd
 350000000467414d41000186a031e8965f000000f249444154789cd59341aa04
 210c44abc07b78133d59d37333bd89d76868b566d10cf4675af8596431a11662
@@ -84,8 +98,8 @@ a07f8bdaf5b40feed2d33e025e2ff4fe2d4a63e1a16d91180b736d8bc45854c5
 63457680c93aada6c99b73865aab2fc094920d901a203f5ddfe1970d28456783
 26cffbafeffcd30654f46d119be4793f827387fc0d189d5bc4d69a3c23d45a7f
 db803146578337df4d0a3121fc3d330000000049454e44ae426082
-"""),
-  'basi2c16': _dehex(b"""
+""",
+  'basi2c16': b"""
 89504e470d0a1a0a0000000d4948445200000020000000201002000001db8f01
 760000000467414d41000186a031e8965f0000020a49444154789cd5962173e3
 3010853fcf1838cc61a1818185a53e56787fa13fa130852e3b5878b4b0b03081
@@ -105,8 +119,8 @@ df8c7802eda201b2d2e0239b409868171fc104ba8b76f10b4da09f6817ffc609
 c413ede267fd1fbab46880c90f80eccf0013185eb48b47ba03df2bdaadef3181
 cb8976f18e13188768170f98c0f844bb78cb04c62ddac59d09fc3fa25dfc1da4
 14deb3df1344f70000000049454e44ae426082
-"""),
-  'basi3p08': _dehex(b"""
+""",
+  'basi3p08': b"""
 89504e470d0a1a0a0000000d494844520000002000000020080300000133a3ba
 500000000467414d41000186a031e8965f00000300504c5445224400f5ffed77
 ff77cbffff110a003a77002222ffff11ff110000222200ffac5566ff66ff6666
@@ -155,8 +169,8 @@ e5301baec06a580677600ddc05ba0f13e120bc81a770133ec355a017300d4ec2
 6f61113c877eb01d4ec317a085700f26c130f80efbe132bc039a0733e106fc81
 f7f017f6c10aa0d1300a0ec374780943e1382c06fa0a9b60238c83473016cec0
 02f80f73fefe1072afc1e50000000049454e44ae426082
-"""),
-  'basi6a08': _dehex(b"""
+""",
+  'basi6a08': b"""
 89504e470d0a1a0a0000000d4948445200000020000000200806000001047d4a
 620000000467414d41000186a031e8965f0000012049444154789cc595414ec3
 3010459fa541b8bbb26641b8069b861e8b4d12c1c112c1452a710a2a65d840d5
@@ -169,23 +183,23 @@ b7337b9f988cc67f5f0e186d20e808042f1c97054e1309da40d02d7e27f92e03
 0db91bac0050747fec5015ce80da0e5700281be533f0ce6d5900b59bcb00ea6d
 200314cf801faab200ea752803a8d7a90c503a039f824a53f4694e7342000000
 0049454e44ae426082
-"""),
-  'basn0g01': _dehex(b"""
+""",
+  'basn0g01': b"""
 89504e470d0a1a0a0000000d49484452000000200000002001000000005b0147
 590000000467414d41000186a031e8965f0000005b49444154789c2dccb10903
 300c05d1ebd204b24a200b7a346f90153c82c18d0a61450751f1e08a2faaead2
 a4846ccea9255306e753345712e211b221bf4b263d1b427325255e8bdab29e6f
 6aca30692e9d29616ee96f3065f0bf1f1087492fd02f14c90000000049454e44
 ae426082
-"""),
-  'basn0g02': _dehex(b"""
+""",
+  'basn0g02': b"""
 89504e470d0a1a0a0000000d49484452000000200000002002000000001ca13d
 890000000467414d41000186a031e8965f0000001f49444154789c6360085df5
 1f8cf1308850c20053868f0133091f6390b90700bd497f818b0989a900000000
 49454e44ae426082
-"""),
+""",
   # A version of basn0g04 dithered down to 3 bits.
-  'Basn0g03': _dehex(b"""
+  'Basn0g03': b"""
 89504e470d0a1a0a0000000d494844520000002000000020040000000093e1c8
 2900000001734249540371d88211000000fd49444154789c6d90d18906210c84
 c356f22356b2889588604301b112112b11d94a96bb495cf7fe87f32d996f2689
@@ -197,37 +211,37 @@ a3e1774285614c5affb40dbd931a526619d9fa18e4c2be420858de1df0e69893
 a0e3e5523461be448561001042b7d4a15309ce2c57aef2ba89d1c13794a109d7
 b5880aa27744fc5c4aecb5e7bcef5fe528ec6293a930690000000049454e44ae
 426082
-"""),
-  'basn0g04': _dehex(b"""
+""",
+  'basn0g04': b"""
 89504e470d0a1a0a0000000d494844520000002000000020040000000093e1c8
 290000000467414d41000186a031e8965f0000004849444154789c6360601014
 545232367671090d4d4b2b2f6720430095dbd1418e002a77e64c720450b9ab56
 912380caddbd9b1c0154ee9933e408a072efde25470095fbee1d1902001f14ee
 01eaff41fa0000000049454e44ae426082
-"""),
-  'basn0g08': _dehex(b"""
+""",
+  'basn0g08': b"""
 89504e470d0a1a0a0000000d4948445200000020000000200800000000561125
 280000000467414d41000186a031e8965f0000004149444154789c6364602400
 1408c8b30c05058c0f0829f8f71f3f6079301c1430ca11906764a2795c0c0605
 8c8ff0cafeffcff887e67131181430cae0956564040050e5fe7135e2d8590000
 000049454e44ae426082
-"""),
-  'basn0g16': _dehex(b"""
+""",
+  'basn0g16': b"""
 89504e470d0a1a0a0000000d49484452000000200000002010000000000681f9
 6b0000000467414d41000186a031e8965f0000005e49444154789cd5d2310ac0
 300c4351395bef7fc6dca093c0287b32d52a04a3d98f3f3880a7b857131363a0
 3a82601d089900dd82f640ca04e816dc06422640b7a03d903201ba05b7819009
 d02d680fa44c603f6f07ec4ff41938cf7f0016d84bd85fae2b9fd70000000049
 454e44ae426082
-"""),
-  'basn2c08': _dehex(b"""
+""",
+  'basn2c08': b"""
 89504e470d0a1a0a0000000d4948445200000020000000200802000000fc18ed
 a30000000467414d41000186a031e8965f0000004849444154789cedd5c10900
 300c024085ec91fdb772133b442bf4a1f8cee12bb40d043b800a14f81ca0ede4
 7d4c784081020f4a871fc284071428f0a0743823a94081bb7077a3c00182b1f9
 5e0f40cf4b0000000049454e44ae426082
-"""),
-  'basn2c16': _dehex(b"""
+""",
+  'basn2c16': b"""
 89504e470d0a1a0a0000000d4948445200000020000000201002000000ac8831
 e00000000467414d41000186a031e8965f000000e549444154789cd596c10a83
 301044a7e0417fcb7eb7fdadf6961e06039286266693cc7a188645e43dd6a08f
@@ -238,8 +252,8 @@ f3edf2705dd10160f3b2815fe8ecf2027974a6b0c03f74a6e4192843e75c6c03
 fb8d3630039dbd59601e7ab3c06cf428507f0634d039afdc80123a7bb1801e7a
 b1802a7a14c89f016d74ce331bf080ce9e08f8414f04bca133bfe642fe5e07bb
 c4ec0000000049454e44ae426082
-"""),
-  'basn3p04': _dehex(b"""
+""",
+  'basn3p04': b"""
 89504e470d0a1a0a0000000d4948445200000020000000200403000000815467
 c70000000467414d41000186a031e8965f000000037342495404040477f8b5a3
 0000002d504c54452200ff00ffff8800ff22ff000099ffff6600dd00ff77ff00
@@ -247,16 +261,16 @@ ff000000ff99ddff00ff00bbffbb000044ff00ff44d2b049bd00000047494441
 54789c63e8e8080d3d7366d5aaf27263e377ef66ce64204300952b28488e002a
 d7c5851c0154eeddbbe408a07119c81140e52a29912380ca4d4b23470095bb7b
 37190200e0c4ead10f82057d0000000049454e44ae426082
-"""),
-  'basn6a08': _dehex(b"""
+""",
+  'basn6a08': b"""
 89504e470d0a1a0a0000000d4948445200000020000000200806000000737a7a
 f40000000467414d41000186a031e8965f0000006f49444154789cedd6310a80
 300c46e12764684fa1f73f55048f21c4ddc545781d52e85028fc1f4d28d98a01
 305e7b7e9cffba33831d75054703ca06a8f90d58a0074e351e227d805c8254e3
 1bb0420f5cdc2e0079208892ffe2a00136a07b4007943c1004d900195036407f
 011bf00052201a9c160fb84c0000000049454e44ae426082
-"""),
-  'cs3n3p08': _dehex(b"""
+""",
+  'cs3n3p08': b"""
 89504e470d0a1a0a0000000d494844520000002000000020080300000044a48a
 c60000000467414d41000186a031e8965f0000000373424954030303a392a042
 00000054504c544592ff0000ff9200ffff00ff0000dbff00ff6dffb600006dff
@@ -266,8 +280,8 @@ b6ffff0000ff2400b6ffffdb000092ffff6d000024ffff49006dff00df702b17
 184ed0177a437b680bcdd0031c0ed00ea21f74852ed00a1c9ed0086da0057487
 6ed0121cd6d004bda0013a421ff803224033e177f4ae260000000049454e44ae
 426082
-"""),
-  'f02n0g08': _dehex(b"""
+""",
+  'f02n0g08': b"""
 89504e470d0a1a0a0000000d4948445200000020000000200800000000561125
 280000012a49444154789c85d12f4b83511805f0c3f938168b2088200882410c
 03834dd807182c588749300c5604c30b0b03c360e14d826012c162b1182c8241
@@ -280,15 +294,15 @@ e762040cb2d5e93331067af95de8b4980147adcb3128710d74dab7a54fe20ec0
 ec727c313a53822109fc3ff50743122bab6b1b5b3b7b9d439d834189e5d54518
 0b82b120180b82b1208882200ae217e9e497bfbfccebfd0000000049454e44ae
 426082
-"""),
-  's09n3p02': _dehex(b"""
+""",
+  's09n3p02': b"""
 89504e470d0a1a0a0000000d49484452000000090000000902030000009dffee
 830000000467414d41000186a031e8965f000000037342495404040477f8b5a3
 0000000c504c544500ff000077ffff00ffff7700ff5600640000001f49444154
 789c63600002fbff0c0c56ab19182ca381581a4283f82071200000696505c36a
 437f230000000049454e44ae426082
-"""),
-  'tbgn3p08': _dehex(b"""
+""",
+  'tbgn3p08': b"""
 89504e470d0a1a0a0000000d494844520000002000000020080300000044a48a
 c60000000467414d41000186a031e8965f00000207504c54457f7f7fafafafab
 abab110000222200737300999999510d00444400959500959595e6e600919191
@@ -325,8 +339,8 @@ e898260c07fca80a24c076cc864b777131a00190cdfa3069035eccbc038c30e1
 3e88b46d16b6acc5380d6ac202511c392f4b789aa7b0b08718765990111606c2
 9e854c38e5191878fbe471e749b0112bb18902008dc473b2b2e8e72700000000
 49454e44ae426082
-"""),
-  'Tp2n3p08': _dehex(b"""
+""",
+  'Tp2n3p08': b"""
 89504e470d0a1a0a0000000d494844520000002000000020080300000044a48a
 c60000000467414d41000186a031e8965f00000300504c544502ffff80ff05ff
 7f0703ff7f0180ff04ff00ffff06ff000880ff05ff7f07ffff06ff000804ff00
@@ -372,8 +386,8 @@ e76fbefda38702063e0149751d537b67ff80e8d4dcc29a86bea97316add9b0e3
 c0e96bf79ebdfafc971e0a587885e515f58cad5d7d43a2d2720aeadaba26cf5a
 bc62fbcea3272fde7efafac37f3a28000087c0fe101bc2f85f0000000049454e
 44ae426082
-"""),
-  'tbbn1g04': _dehex(b"""
+""",
+  'tbbn1g04': b"""
 89504e470d0a1a0a0000000d494844520000002000000020040000000093e1c8
 290000000467414d41000186a031e8965f0000000274524e530007e8f7589b00
 000002624b47440000aa8d23320000013e49444154789c55d1cd4b024118c7f1
@@ -388,8 +402,8 @@ b692d190b718d159f4c0a45c4435915a243c58a7a4312a7a57913f05747594c6
 1d9873b3da0fbf50137dc5c9bde84fdb2ec8bde1189e0448b63584735993c209
 7a601bd2710caceba6158797285b7f2084a2f82c57c01a0000000049454e44ae
 426082
-"""),
-  'tbrn2c08': _dehex(b"""
+""",
+  'tbrn2c08': b"""
 89504e470d0a1a0a0000000d4948445200000020000000200802000000fc18ed
 a30000000467414d41000186a031e8965f0000000674524e53007f007f007f8a
 33334f00000006624b474400ff0000000033277cf3000004d649444154789cad
@@ -433,8 +447,8 @@ c0f8f878ad69341a33994ced2969c0d0d0502412f9f8f163f3a7fd654b474787
 1b1b1b87cf4eeb0a8063c78e45a3d19e9e1ebfdfdf5a831e844655d18093274f
 9e3d7bf6d3a74f3b3b3b47c80efc05ff7af28fefb70d9b0000000049454e44ae
 426082
-"""),
-  'basn6a16': _dehex(b"""
+""",
+  'basn6a16': b"""
 89504e470d0a1a0a0000000d494844520000002000000020100600000023eaa6
 b70000000467414d41000186a031e8965f00000d2249444154789cdd995f6c1c
 d775c67ff38fb34b724d2ee55a8e4b04a0ac87049100cab4dbd8c6528902cb4d
@@ -543,8 +557,109 @@ acf0c6211c036f14a239703741740adc7da227edd7e56b833d0ae92549b4d357
 09f3713473413e2666e7fe6f6c6efefdfafda1f56f6e06f93496d9d67cb7366a
 9964b6f92e64b689196ec6c604646fd3fe4771ff1bf03f65d8ecc3addbb5f300
 00000049454e44ae426082
-"""),
+""",
 }
 
-import sys
-sys.modules[__name__].__dict__.update(png)
+class _Images(object):
+    """The images, by name: a read-only dict-like object.  Each image
+    is converted from hex (or read from the cache) when it is first
+    used, then kept.
+    """
+
+    def __init__(self):
+        self.images = {}
+
+    def __getitem__(self, name):
+        image = self.images.get(name)
+        if image is None:
+            image = self.images[name] = _load(name, _hex[name])
+        return image
+
+    def __contains__(self, name):
+        return name in _hex
+
+    def __iter__(self):
+        return iter(_hex)
+
+    def __len__(self):
+        return len(_hex)
+
+    def keys(self):
+        return list(_hex)
+
+    def values(self):
+        return [self[name] for name in _hex]
+
+    def items(self):
+        return [(name, self[name]) for name in _hex]
+
+    def get(self, name, default=None):
+        if name in _hex:
+            return self[name]
+        return default
+
+png = _Images()
+
+# The directory of the cache, or None.
+_cache = os.environ.get('PNGSUITE_CACHE') or None
+
+def use_cache(directory):
+    """Keep the bytes of each image in a file in `directory` (which is
+    created when needed), and read them from there in later
+    processes, rather than converting them from hex each time.  With
+    ``None``, no cache is used.  The files are named after the image
+    and a checksum of its hex, so they are never out of date.  When
+    this module is imported, the environment variable
+    ``PNGSUITE_CACHE`` (when it is set) gives the directory.
+    """
+
+    global _cache
+    _cache = directory
+
+def _load(name, hexed):
+    """Return the bytes of the image `name`, whose hex is `hexed`."""
+
+    if _cache is None:
+        return _dehex(hexed)
+    path = os.path.join(_cache, '%s-%08x.png' %
+                        (name, zlib.crc32(hexed) & 0xffffffff))
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        pass
+    data = _dehex(hexed)
+    # The file is written under another name and renamed, so that no
+    # process reads it half written.  The cache is only an
+    # optimisation: when it cannot be written, it is not.
+    try:
+        if not os.path.isdir(_cache):
+            os.makedirs(_cache)
+        temp = '%s.%d' % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        pass
+    return data
+
+class _Module(types.ModuleType):
+    """This module, with each image as an attribute too."""
+
+    def __getattr__(self, name):
+        if name in _hex:
+            return png[name]
+        raise AttributeError("module %r has no attribute %r" %
+                             (self.__name__, name))
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_hex))
+
+# Python 2 modules cannot compute attributes, so this module is
+# replaced by a :class:`_Module` with the same contents.  (The
+# original is kept, as Python 2 clears the globals of a module when it
+# is deleted.)
+_module = _Module(__name__, __doc__)
+_module.__dict__.update(globals())
+_module._original = sys.modules[__name__]
+sys.modules[__name__] = _module
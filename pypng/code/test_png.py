@@ -84,6 +84,25 @@ def _redirect_io(inp, out, f):
             w.close()
     return x
 
+def loadtool(name):
+    """Load the tool script `name` (which has no ``.py`` suffix) from
+    the directory of this file, as a module, and return the module.
+    """
+
+    import os
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    try:
+        from importlib.machinery import SourceFileLoader
+        from importlib.util import module_from_spec, spec_from_loader
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = spec_from_loader(name, SourceFileLoader(name, path))
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
 def mycallersname():
     """Returns the name of the caller of the caller of this function
     (hence the name of the caller of the function in which
@@ -675,6 +694,36 @@ class Test(unittest.TestCase):
         out = reader.undo_filter(4, scanline, scanprev)
         self.assertEqual(list(out), [8, 10, 9, 108, 111, 113])  # paeth
 
+    def testUnfilterFallbacks(self):
+        """Test undoing each filter for various pixel sizes, with and
+        without NumPy (when the Cython extension is not used)."""
+
+        import random
+        rand = random.Random(7)
+        reader = png.Reader(bytes='')
+        module = png._numpy()
+        try:
+            for numpy in set([module, False]):
+                png._numpy_module = numpy
+                for fo in range(1, 9):
+                    n = fo * 5
+                    line = array('B', [rand.randrange(256)
+                                       for _ in range(n)])
+                    prev = array('B', [rand.randrange(256)
+                                       for _ in range(n)])
+                    reader.psize = fo
+                    for t in range(5):
+                        filtered = png.filter_scanline(t, line, fo, prev)
+                        self.assertEqual(filtered[0], t)
+                        out = reader.undo_filter(t, filtered[1:],
+                                                 array('B', prev))
+                        self.assertEqual(list(out), list(line))
+                        first = png.filter_scanline(t, line, fo)
+                        out = reader.undo_filter(t, first[1:], None)
+                        self.assertEqual(list(out), list(line))
+        finally:
+            png._numpy_module = module
+
     def testModifyRows(self):
         # Tests that the rows yielded by the pixels generator
         # can be safely modified.
@@ -698,6 +747,1066 @@ class Test(unittest.TestCase):
         meta = dict(alpha=False, greyscale=True, bitdepth=2, planes=1)
         png.write_pnm(o, w, h, pixels, meta)
 
+    def testPipscalez(self):
+        """Test pipscalez's enlarge and shrink modes, with and without
+        NumPy."""
+
+        pipscalez = loadtool('pipscalez')
+
+        def scaled(f, rows, *args):
+            return [list(row) for row in f(rows, *args)]
+
+        # Grey and alpha, 4 by 2.
+        la = [[0,10, 1,11, 2,12, 3,13], [4,14, 5,15, 6,16, 7,17]]
+        # Grey, 5 by 2: the right-hand column is a partial block.
+        l = [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9]]
+        for numpy in set([pipscalez.numpy, None]):
+            pipscalez.numpy = numpy
+            self.assertEqual(
+              scaled(pipscalez.enlarge, la[:1], 2, 2, 2, 'B'),
+              [[0,10, 0,10, 1,11, 1,11, 2,12, 2,12, 3,13, 3,13]] * 2)
+            self.assertEqual(scaled(pipscalez.enlarge, l, 1, 3, 1, 'B'),
+              [[0,0,0, 1,1,1, 2,2,2, 3,3,3, 4,4,4],
+               [5,5,5, 6,6,6, 7,7,7, 8,8,8, 9,9,9]])
+            self.assertEqual(
+              scaled(pipscalez.shrink_nearest, la, 2, 4, 2, 2, 'B'),
+              [[0,10, 2,12]])
+            self.assertEqual(
+              scaled(pipscalez.shrink_nearest, l, 1, 5, 2, 1, 'B'),
+              [[0, 2], [5, 7]])
+            # Each block is averaged, rounding halves up.
+            self.assertEqual(
+              scaled(pipscalez.shrink_box, la, 2, 4, 2, 2, 'B'),
+              [[3,13, 5,15]])
+            self.assertEqual(
+              scaled(pipscalez.shrink_box, l, 1, 5, 2, 1, 'B'),
+              [[1, 3], [6, 8]])
+            self.assertEqual(
+              scaled(pipscalez.shrink_box, [[0, 65535]], 1, 2, 2, 1, 'H'),
+              [[32768]])
+
+        # A whole file: 3 by 3, shrunk to 1 by 1 (the partial blocks
+        # are discarded).
+        data = topngbytes('scalez.png', [[0, 1, 2], [3, 4, 5], [6, 7, 8]],
+                          3, 3, greyscale=True)
+        o = BytesIO()
+        pipscalez.rescale(BytesIO(data), o, 2, 2, 'box')
+        x,y,pixels,meta = png.Reader(bytes=o.getvalue()).read()
+        self.assertEqual((x, y, [list(row) for row in pixels]), (1, 1, [[2]]))
+        o = BytesIO()
+        pipscalez.rescale(BytesIO(data), o, 2, 1)
+        x,y,pixels,meta = png.Reader(bytes=o.getvalue()).read()
+        self.assertEqual((x, y), (6, 3))
+        self.assertEqual(list(list(pixels)[2]), [6, 6, 7, 7, 8, 8])
+
+    def testHistogram(self):
+        """Test that histogram counts match a simple count."""
+        import pnghistogram
+
+        for name in ['basn0g04', 'basn2c08', 'basn6a16']:
+            r = png.Reader(bytes=pngsuite.png[name])
+            _,_,pixels,info = r.asDirect()
+            pixels = [list(row) for row in pixels]
+            planes = info['planes']
+            counts = pnghistogram.histogram(pixels, planes, info['bitdepth'])
+            self.assertEqual(len(counts), planes)
+            for c in range(planes):
+                expect = [0]*2**info['bitdepth']
+                for row in pixels:
+                    for v in row[c::planes]:
+                        expect[v] += 1
+                self.assertEqual(counts[c], expect)
+
+    def testHistogramFiles(self):
+        """Test aggregating the histograms of several files."""
+        import os
+        import shutil
+        import tempfile
+        import pnghistogram
+
+        d = tempfile.mkdtemp()
+        try:
+            names = []
+            for i in range(3):
+                name = os.path.join(d, '%d.png' % i)
+                f = open(name, 'wb')
+                f.write(pngsuite.basn2c08)
+                f.close()
+                names.append(name)
+            one = pnghistogram.histogram_file(names[0])[0]
+            total,planes,bitdepth = pnghistogram.histogram_files(names, 2)
+        finally:
+            shutil.rmtree(d)
+        self.assertEqual((planes, bitdepth), (3, 8))
+        self.assertEqual(total, [[3*n for n in c] for c in one])
+
+    def testComposite(self):
+        """Test compositing over a colour and over another image."""
+        import pngcomposite
+
+        for name in ['tbbn1g04', 'basn6a08', 'basn6a16']:
+            r = png.Reader(bytes=pngsuite.png[name])
+            _,_,pixels,info = r.asDirect()
+            pixels = [list(row) for row in pixels]
+            planes = info['planes']
+            maxval = 2**info['bitdepth'] - 1
+            colour = [maxval//3, 7, maxval][:planes-1]
+            def over(v, a, b):
+                return (a*v + (maxval-a)*b + maxval//2) // maxval
+            got = list(pngcomposite.over_colour(pixels, colour, planes,
+              info['bitdepth']))
+            bgrows = [[colour[i % (planes-1)]
+                       for i in range(len(row)*(planes-1)//planes)]
+                      for row in pixels]
+            expect = [[over(row[i+c], row[i+planes-1], colour[c])
+                       for i in range(0, len(row), planes)
+                       for c in range(planes-1)] for row in pixels]
+            self.assertEqual([list(row) for row in got], expect)
+            got = pngcomposite.over_rows(pixels, bgrows, planes,
+              info['bitdepth'])
+            self.assertEqual([list(row) for row in got], expect)
+
+    def testStack(self):
+        """Test stacking a colour image with greyscale images."""
+        import pngstack
+
+        rgb = png.Reader(bytes=pngsuite.basn2c08).asDirect()[2]
+        grey = png.Reader(bytes=pngsuite.basn0g08).asDirect()[2]
+        rgb = [list(row) for row in rgb]
+        grey = [list(row) for row in grey]
+        x,y,pixels,info = pngstack.stack([
+          png.Reader(bytes=pngsuite.basn2c08),
+          png.Reader(bytes=pngsuite.basn0g08)])
+        self.assertEqual((x, y), (32, 32))
+        self.assertEqual((info['planes'], info['alpha']), (4, True))
+        for row,r,g in zip(pixels, rgb, grey):
+            self.assertEqual(list(row[3::4]), g)
+            del row[3::4]
+            self.assertEqual(list(row), r)
+        # Mixed bit depths are rescaled to the larger.
+        x,y,pixels,info = pngstack.stack([
+          png.Reader(bytes=pngsuite.basn0g16),
+          png.Reader(bytes=pngsuite.basn0g08)])
+        self.assertEqual(info['bitdepth'], 16)
+        for row,g in zip(pixels, grey):
+            self.assertEqual(list(row[1::2]), [v*257 for v in g])
+
+    def testAnalyse(self):
+        """Test the image analysis on some test images."""
+        def analyse(name, **k):
+            r = png.Reader(bytes=pngsuite.png[name])
+            _,_,pixels,info = r.asDirect()
+            return png.analyse(pixels, info['planes'], info['bitdepth'], **k)
+
+        a = analyse('basn2c08', maxcolours=None)
+        self.assertEqual(a['greyscale'], False)
+        self.assertEqual(a['alpha'], False)
+        self.assertEqual(a['bitdepth'], 8)
+        self.assertEqual(a['colours'], len(a['palette']))
+        a = analyse('basn2c08')
+        self.assertEqual((a['colours'], a['palette']), (None, None))
+        a = analyse('basn0g04')
+        self.assertEqual(a['greyscale'], True)
+        self.assertEqual(a['bitdepth'], 4)
+        self.assertEqual(a['palette'], [(v,) for v in range(15)])
+        # 2-bit values rescaled to 8-bit are found to be 2-bit.
+        pixels = [[0, 85, 170, 255]]
+        self.assertEqual(png.analyse(pixels, 1, 8)['bitdepth'], 2)
+        a = analyse('basn6a16', maxcolours=0)
+        self.assertEqual(a['alpha'], True)
+        self.assertEqual(a['bitdepth'], 16)
+        self.assertEqual(a['colours'], None)
+        # Grey RGB pixels.
+        pixels = [[7,7,7, 9,9,9], [7,7,7, 7,7,7]]
+        a = png.analyse(pixels, 3, 8)
+        self.assertEqual(a['greyscale'], True)
+        self.assertEqual(a['palette'], [(7,7,7), (9,9,9)])
+        # Bit depths from an sBIT chunk are not PNG bit depths.
+        a = analyse('Basn0g03')
+        self.assertEqual(a['bitdepth'], 4)
+        self.assertEqual(analyse('cs3n3p08')['bitdepth'], 4)
+        self.assertEqual(png.analyse([[0, 7, 7, 0]], 1, 3)['bitdepth'], 1)
+        self.assertEqual(png.analyse([[0, 21, 42, 63]], 1, 6)['bitdepth'], 2)
+        self.assertEqual(png.analyse([[0, 1, 63]], 1, 6)['bitdepth'], 8)
+        self.assertEqual(png.analyse([[0, 4095]], 1, 12)['bitdepth'], 1)
+        self.assertEqual(png.analyse([[0, 4094]], 1, 12)['bitdepth'], 16)
+
+    def testOptimize(self):
+        """Test that optimize picks a smaller colour type and bit
+        depth, without changing the pixels."""
+        def check(name, colortype, bitdepth, method='asDirect'):
+            r = png.Reader(bytes=pngsuite.png[name])
+            x,y,pixels,info = getattr(r, method)()
+            pixels = [list(row) for row in pixels]
+            w = png.Writer(x, y, greyscale=info['greyscale'],
+                           alpha=info['alpha'], bitdepth=info['bitdepth'],
+                           optimize=True)
+            f = BytesIO()
+            w.write(f, pixels)
+            r = png.Reader(bytes=f.getvalue())
+            r.preamble()
+            self.assertEqual((r.color_type, r.bitdepth),
+                             (colortype, bitdepth))
+            _,_,opixels,oinfo = r.asDirect()
+            self.assertEqual((oinfo['greyscale'], oinfo['alpha']),
+                             (info['greyscale'], info['alpha']))
+            self.assertEqual([list(row) for row in opixels], pixels)
+        # A greyscale image with 1-bit values.
+        check('basn0g01', 0, 1)
+        # asRGB8 expands the palette; it goes back to a palette.
+        check('basn3p04', 3, 4, 'asRGB8')
+        check('basn2c08', 2, 8)
+        check('basn6a16', 6, 16)
+        # Grey RGB pixels with an opaque alpha channel and 2-bit
+        # values, and a colour image with a few colours.
+        w = png.Writer(3, 1, alpha=True, optimize=True)
+        f = BytesIO()
+        w.write(f, [[0,0,0,255, 85,85,85,255, 255,255,255,255]])
+        r = png.Reader(bytes=f.getvalue())
+        x,y,pixels,info = r.read()
+        self.assertEqual((info['greyscale'], info['alpha']), (True, False))
+        self.assertEqual(info['bitdepth'], 2)
+        self.assertEqual(list(map(list, pixels)), [[0, 1, 3]])
+        w = png.Writer(2, 2, alpha=True, optimize=True)
+        f = BytesIO()
+        w.write_array(f, array('B', [9,8,7,255, 1,2,3,0]*2))
+        x,y,pixels,info = png.Reader(bytes=f.getvalue()).read()
+        self.assertEqual(info['palette'], [(1,2,3,0), (9,8,7,255)])
+        self.assertEqual(info['bitdepth'], 1)
+
+    def testOptimizer(self):
+        """Test the brute force optimizer."""
+        import pngoptimize
+
+        for name in ['basn2c08', 'basn3p04', 'tbrn2c08', 'tbbn1g04']:
+            data = pngsuite.png[name]
+            result,settings = pngoptimize.optimize(data, 1,
+                                                   filters=(0,1,4),
+                                                   strategies=('default',))
+            self.assertTrue(len(result) <= len(data))
+            pngoptimize.verify(data, result)
+        # A colour image with grey pixels is reduced.
+        data = topngbytes('optimizer.png', [[v,v,v] * 4 for v in range(4)],
+                          4, 4)
+        result,settings = pngoptimize.optimize(data, 2)
+        self.assertTrue(settings['optimize'])
+        r = png.Reader(bytes=result)
+        r.preamble()
+        self.assertEqual(r.color_type, 0)
+        self.assertRaises(pngoptimize.Error, pngoptimize.verify,
+                          data, pngsuite.basn2c08)
+        self.assertRaises(pngoptimize.Error, pngoptimize.verify,
+                          pngsuite.basn2c08, pngsuite.basn2c16)
+
+    def testFilterType(self):
+        """Test writing with each filter type, straightlaced and
+        interlaced, reading back the same pixels."""
+        r = png.Reader(bytes=pngsuite.basn2c16)
+        x,y,pixels,info = r.read()
+        pixels = [list(row) for row in pixels]
+        for interlace in (False, True):
+            for filter_type in range(5):
+                w = png.Writer(x, y, bitdepth=16, interlace=interlace,
+                               filter_type=filter_type)
+                f = BytesIO()
+                w.write(f, pixels)
+                _,_,opixels,_ = png.Reader(bytes=f.getvalue()).read()
+                self.assertEqual([list(row) for row in opixels], pixels)
+
+    def testCompressOptions(self):
+        """Test the zlib options and the 'fast' preset."""
+        r = png.Reader(bytes=pngsuite.basn0g04)
+        x,y,pixels,info = r.read()
+        pixels = [list(row) for row in pixels]
+        for k in [dict(strategy='rle'), dict(strategy='huffman'),
+                  dict(window_bits=9, mem_level=1), dict(preset='fast'),
+                  dict(preset='fast', filter_type=4)]:
+            f = BytesIO()
+            png.Writer(x, y, greyscale=True, bitdepth=4, **k).write(f, pixels)
+            _,_,opixels,_ = png.Reader(bytes=f.getvalue()).read()
+            self.assertEqual([list(row) for row in opixels], pixels)
+        w = png.Writer(x, y, greyscale=True, preset='fast', filter_type=4)
+        self.assertEqual(w.filter_type, 4)
+        self.assertEqual(w.strategy, png._strategies['rle'])
+        self.assertRaises(ValueError, png.Writer, 1, 1, strategy='lzw')
+        self.assertRaises(ValueError, png.Writer, 1, 1, window_bits=16)
+        self.assertRaises(ValueError, png.Writer, 1, 1, filter_type=5)
+        self.assertRaises(ValueError, png.Writer, 1, 1, preset='slow')
+
+    def testCodecContext(self):
+        """Test sharing a codec context between writers and readers."""
+        context = png.CodecContext(compression=9, strategy='filtered')
+        r = png.Reader(bytes=pngsuite.basn2c08)
+        x,y,pixels,info = r.read()
+        pixels = [list(row) for row in pixels]
+        for filter_type in (0, 1):
+            w = png.Writer(x, y, context=context, filter_type=filter_type)
+            self.assertEqual(w.compression, 9)
+            f = BytesIO()
+            w.write(f, pixels)
+            r = png.Reader(bytes=f.getvalue(), context=context)
+            self.assertEqual([list(row) for row in r.read()[2]], pixels)
+        self.assertRaises(ValueError, png.Writer, 1, 1,
+                          context=context, compression=1)
+        self.assertRaises(ValueError, png.CodecContext, compression=10)
+
+    def testIDATSize(self):
+        """Test the IDAT chunk size control."""
+        r = png.Reader(bytes=pngsuite.basn2c16)
+        x,y,pixels,info = r.read()
+        pixels = [list(row) for row in pixels]
+        for idat_size in (1, 100, 2**20):
+            w = png.Writer(x, y, bitdepth=16, chunk_limit=500,
+                           idat_size=idat_size)
+            f = BytesIO()
+            w.write(f, pixels)
+            r = png.Reader(bytes=f.getvalue())
+            sizes = [len(data) for tag,data in r.chunks() if tag == b'IDAT']
+            self.assertTrue(sizes)
+            self.assertEqual(set(sizes[:-1]) - set([idat_size]), set())
+            self.assertTrue(0 < sizes[-1] <= idat_size)
+            _,_,opixels,_ = png.Reader(bytes=f.getvalue()).read()
+            self.assertEqual([list(row) for row in opixels], pixels)
+        self.assertRaises(ValueError, png.Writer, 1, 1, idat_size=0)
+
+    def testWriteChunkParts(self):
+        """Test writing a chunk from a list of parts, to a file that
+        only has a write method."""
+        class Sink:
+            def __init__(self):
+                self.parts = []
+            def write(self, s):
+                self.parts.append(bytes(s))
+        sink = Sink()
+        png.write_chunk(sink, b'tEXt', [b'Comment\0', b'hello ', b'world'])
+        f = BytesIO()
+        png.write_chunk(f, b'tEXt', b'Comment\0hello world')
+        self.assertEqual(b''.join(sink.parts), f.getvalue())
+
+    def testAsync(self):
+        """Test encoding to an asyncio stream, and decoding, in an
+        executor."""
+        try:
+            import asyncio
+            asyncio.run
+        except (ImportError, AttributeError):
+            self.skipTest("asyncio.run is not available")
+        class Stream:
+            def __init__(self, delay=0):
+                self.parts = []
+                self.delay = delay
+            def write(self, data):
+                self.parts.append(bytes(data))
+            def drain(self):
+                return asyncio.sleep(self.delay)
+        r = png.Reader(bytes=pngsuite.basn2c08)
+        x,y,pixels,info = r.read()
+        pixels = [list(row) for row in pixels]
+        stream = Stream()
+        w = png.Writer(x, y, chunk_limit=100)
+        n = asyncio.run(png.aencode(w, stream, pixels, buffers=2))
+        data = b''.join(stream.parts)
+        self.assertEqual(n, len(data))
+        r = png.Reader(bytes=data)
+        x,y,opixels,info = asyncio.run(r.aread(method='asDirect'))
+        self.assertEqual([list(row) for row in opixels], pixels)
+
+        # Cancelling while the encoder is waiting for the stream.
+        stream = Stream(10)
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(png.aencode(w, stream, pixels))
+        loop.call_later(0.1, task.cancel)
+        self.assertRaises(asyncio.CancelledError,
+                          loop.run_until_complete, task)
+        loop.close()
+        self.assertTrue(len(stream.parts) < 32)
+
+    def testIncrementalDecoder(self):
+        """Test decoding a PNG file given a few bytes at a time."""
+
+        for name in ['basn0g01', 'basn0g16', 'basn2c08', 'basn3p04',
+                     'basi0g08', 'basi2c16', 'tbrn2c08', 'tbgn3p08']:
+            data = pngsuite.png[name]
+            w,h,pixels,meta = png.Reader(bytes=data).read()
+            expect = [list(row) for row in pixels]
+            for n in (1, 7, 100, len(data)):
+                d = png.IncrementalDecoder()
+                rows = []
+                for i in range(0, len(data), n):
+                    rows.extend(d.feed(data[i:i+n]))
+                    if d.info is None:
+                        self.assertEqual(rows, [])
+                d.close()
+                self.assertTrue(d.done)
+                self.assertEqual(d.info, meta)
+                self.assertEqual([list(row) for row in rows], expect)
+        # Rows are returned before the whole file has arrived.
+        data = pngsuite.basn0g08
+        d = png.IncrementalDecoder()
+        self.assertTrue(d.feed(data[:-40]))
+        d.feed(data[-40:])
+        d.close()
+        # Errors.
+        d = png.IncrementalDecoder()
+        d.feed(data[:-1])
+        self.assertRaises(png.FormatError, d.close)
+        self.assertRaises(png.FormatError,
+                          png.IncrementalDecoder().feed, b'GIF89a..')
+        bad = bytearray(data)
+        bad[30] ^= 1
+        self.assertRaises(png.ChunkError,
+                          png.IncrementalDecoder().feed, bytes(bad))
+
+    def testStreamWriter(self):
+        """Test writing a PNG image one row at a time."""
+
+        rows = [[(x*y+z) % 256 for x in range(7) for z in range(3)]
+                for y in range(5)]
+        for kw in [{}, dict(filter_type=4, idat_size=10),
+                   dict(bitdepth=16)]:
+            writer = png.Writer(7, 5, **kw)
+            expect = BytesIO()
+            writer.write(expect, rows)
+            o = BytesIO()
+            stream = png.StreamWriter(writer, o)
+            stream.open()
+            for row in rows:
+                stream.write_row(row)
+            self.assertEqual(stream.close(), 5)
+            self.assertEqual(o.getvalue(), expect.getvalue())
+            # The same, from a flat buffer, in a with statement.
+            o = BytesIO()
+            with png.StreamWriter(writer, o) as stream:
+                stream.write_rows(sum(rows[:2], []))
+                stream.write_rows(sum(rows[2:], []))
+            self.assertEqual(o.getvalue(), expect.getvalue())
+        # A string of bytes, as from a camera; flush makes the rows
+        # so far available to a decoder.
+        o = BytesIO()
+        stream = png.StreamWriter(png.Writer(7, 5), o)
+        stream.open()
+        stream.write_rows(bytes(bytearray(sum(rows[:3], []))))
+        stream.flush()
+        d = png.IncrementalDecoder()
+        self.assertEqual([list(row) for row in d.feed(o.getvalue())],
+                         rows[:3])
+        stream.write_rows(bytearray(sum(rows[3:], [])))
+        stream.close()
+        self.assertEqual([list(row) for row in
+                          png.Reader(bytes=o.getvalue()).read()[2]], rows)
+        # Wrong numbers of rows.
+        stream = png.StreamWriter(png.Writer(7, 5), BytesIO())
+        self.assertRaises(png.Error, stream.write_row, rows[0])
+        stream.open()
+        self.assertRaises(ValueError, stream.write_rows, rows[0][:-1])
+        stream.write_row(rows[0])
+        self.assertRaises(ValueError, stream.close)
+        stream.write_rows(sum(rows[1:], []))
+        self.assertRaises(ValueError, stream.write_row, rows[0])
+        stream.close()
+
+    def testWriteAnimation(self):
+        """Test writing an APNG file."""
+
+        def decode(data):
+            """Decode each frame of an APNG file, by making a PNG file
+            from its fcTL and fdAT chunks, and drawing it onto the
+            frame before.  Returns a list of frames."""
+            chunks = list(png.Reader(bytes=data).chunks())
+            ihdr = chunks[0][1]
+            frames = []
+            sequence = []
+            canvas = None
+            parts = []
+            for type,content in chunks[1:]:
+                if type in (b'fcTL', b'IEND') and parts:
+                    o = BytesIO()
+                    png.write_chunks(o, [(b'IHDR', parts[0]),
+                                         (b'IDAT', b''.join(parts[1:])),
+                                         (b'IEND', b'')])
+                    w,h,pixels,info = png.Reader(bytes=o.getvalue()).read()
+                    planes = info['planes']
+                    canvas = [list(row) for row in canvas or pixels]
+                    for i,row in enumerate(pixels):
+                        canvas[y+i][x*planes:(x+w)*planes] = list(row)
+                    frames.append(canvas)
+                if type == b'fcTL':
+                    fctl = struct.unpack('!5I2H2B', content)
+                    sequence.append(fctl[0])
+                    x,y = fctl[3:5]
+                    parts = [struct.pack('!2I', *fctl[1:3]) + ihdr[8:]]
+                elif type == b'IDAT':
+                    parts.append(content)
+                elif type == b'fdAT':
+                    sequence.append(struct.unpack('!I', content[:4])[0])
+                    parts.append(content[4:])
+                elif type == b'acTL':
+                    num_frames = struct.unpack('!2I', content)[0]
+            self.assertEqual(len(frames), num_frames)
+            self.assertEqual(sequence, list(range(len(sequence))))
+            return frames
+
+        # Frames of a mostly still scene.
+        base = [[(x+y*3) % 256 for x in range(3*8)] for y in range(6)]
+        frames = [base, [list(row) for row in base],
+                  [list(row) for row in base], base]
+        frames[1][2][6:9] = [1, 2, 3]
+        frames[2][4][0:3] = [9, 9, 9]
+        frames[2][5][21:24] = [7, 7, 7]
+        for kw in [{}, dict(interlace=True), dict(filter_type=2, idat_size=7)]:
+            writer = png.Writer(8, 6, **kw)
+            o = BytesIO()
+            self.assertEqual(writer.write_animation(o, frames), 4)
+            data = o.getvalue()
+            self.assertEqual(decode(data), frames)
+            # The first frame is the ordinary image.
+            self.assertEqual([list(row) for row in
+                              png.Reader(bytes=data).read()[2]], base)
+            # Only the changed rectangles are written.
+            fctl = [struct.unpack('!5I2H2B', c)[1:5] for t,c in
+                    png.Reader(bytes=data).chunks() if t == b'fcTL']
+            self.assertEqual(fctl, [(8, 6, 0, 0), (1, 1, 2, 2),
+                                    (8, 4, 0, 2), (8, 2, 0, 4)])
+        o = BytesIO()
+        png.Writer(8, 6).write_animation(o, frames, delta=False)
+        self.assertEqual(decode(o.getvalue()), frames)
+        # Frames from strings of bytes; an unchanged frame.
+        grey = [bytes(bytearray(range(i, i+12))) for i in (0, 0, 5)]
+        o = BytesIO()
+        png.Writer(4, 3, greyscale=True).write_animation(
+          o, iter(grey), num_frames=3)
+        self.assertEqual(decode(o.getvalue()),
+          [[list(bytearray(g[i:i+4])) for i in (0, 4, 8)] for g in grey])
+        self.assertRaises(ValueError, png.Writer(4, 3).write_animation,
+                          BytesIO(), grey)
+        self.assertRaises(ValueError,
+                          png.Writer(4, 3, greyscale=True).write_animation,
+                          BytesIO(), grey, num_frames=2)
+
+    def testReadAnimation(self):
+        """Test reading the frames of an APNG file."""
+
+        base = [[(x+y*3) % 256 for x in range(3*8)] for y in range(6)]
+        frames = [base]
+        for i in range(20):
+            frame = [list(row) for row in frames[-1]]
+            frame[i % 6][i:i+3] = [i, 1, 2]
+            frames.append(frame)
+        for kw in [{}, dict(interlace=True), dict(bitdepth=16)]:
+            o = BytesIO()
+            png.Writer(8, 6, **kw).write_animation(o, frames,
+                                                   delay=(1, 25))
+            r = png.Reader(bytes=o.getvalue())
+            r.frame_cache = 3
+            r.frame_checkpoint = 4
+            index = r.frame_index()
+            self.assertEqual(len(index), 21)
+            self.assertEqual([f['keyframe'] for f in index],
+                             [True] + [False]*20)
+            for n in [20, 3, 4, 19, 0, 7, 20, 6]:
+                w,h,pixels,info = r.read_frame(n)
+                self.assertEqual(info['frame'], n)
+                self.assertEqual(info['delay'], (1, 25))
+                self.assertEqual([list(row) for row in pixels], frames[n])
+            self.assertTrue(len(r.canvases) <= 3)
+            self.assertEqual([[list(row) for row in f[2]]
+                              for f in r.read_frames(8, 12)], frames[8:12])
+            # The file can still be read as an ordinary PNG file.
+            self.assertEqual([list(row) for row in r.read()[2]], base)
+        o = BytesIO()
+        png.Writer(8, 6).write_animation(o, frames[:3], delta=False)
+        r = png.Reader(bytes=o.getvalue())
+        self.assertEqual([f['keyframe'] for f in r.frame_index()],
+                         [True]*3)
+        self.assertRaises(IndexError, r.read_frame, 3)
+        # An image that is not animated has one frame.
+        r = png.Reader(bytes=pngsuite.basn2c08)
+        self.assertEqual(len(r.frame_index()), 1)
+        self.assertEqual(list(map(list, r.read_frame(0)[2])),
+          list(map(list, png.Reader(bytes=pngsuite.basn2c08).read()[2])))
+
+        # Blend and dispose operations, in a 2 by 1 RGBA image.
+        def idat(width, pixels):
+            o = BytesIO()
+            png.Writer(width, 1, alpha=True).write(o, [pixels])
+            chunks = png.Reader(bytes=o.getvalue()).chunks()
+            return b''.join(c for t,c in chunks if t == b'IDAT')
+        sequence = itertools.count()
+        def fctl(x, width, dispose, blend):
+            return (b'fcTL', struct.pack('!5I2H2B', next(sequence), width,
+                                         1, x, 0, 1, 10, dispose, blend))
+        chunks = [(b'IHDR', struct.pack('!2I5B', 2, 1, 8, 6, 0, 0, 0)),
+                  (b'acTL', struct.pack('!2I', 4, 0)),
+                  fctl(0, 2, 2, 0),
+                  (b'IDAT', idat(2, [255,0,0,255, 0,0,255,128]))]
+        for x,width,dispose,blend,pixels in [
+          (1, 1, 2, 1, [0,255,0,128]),
+          (0, 2, 0, 1, [0,0,0,0, 255,255,255,255]),
+          (0, 2, 0, 1, [10,20,30,255, 0,0,0,128])]:
+            chunks.append(fctl(x, width, dispose, blend))
+            chunks.append((b'fdAT', struct.pack('!I', next(sequence)) +
+                           idat(width, pixels)))
+        chunks.append((b'IEND', b''))
+        o = BytesIO()
+        png.write_chunks(o, chunks)
+        r = png.Reader(bytes=o.getvalue())
+        self.assertEqual([list(r.read_frame(n)[2][0]) for n in range(4)],
+          [[255,0,0,255, 0,0,255,128],
+           [0,0,0,0, 0,255,0,128],
+           [0,0,0,0, 255,255,255,255],
+           [10,20,30,255, 127,127,127,255]])
+
+    def testPipeline(self):
+        """Test decoding with decompression in a separate thread."""
+
+        import threading
+        import time
+
+        for name in ['basn0g01', 'basn2c16', 'basi3p08', 'tbrn2c08']:
+            data = pngsuite.png[name]
+            r = png.Reader(bytes=data, pipeline=True)
+            r.band_rows = 3
+            expect = list(map(list, png.Reader(bytes=data).asDirect()[2]))
+            self.assertEqual(list(map(list, r.asDirect()[2])), expect)
+        # Errors in the thread are raised in the caller.
+        data = pngsuite.basn0g08
+        chunks = [(b'IHDR', png.Reader(bytes=data).chunk()[1]),
+                  (b'IDAT', b'\x78\x9c' + b'\xff' * 20),
+                  (b'IEND', b'')]
+        o = BytesIO()
+        png.write_chunks(o, chunks)
+        r = png.Reader(bytes=o.getvalue(), pipeline=2)
+        self.assertRaises(zlib.error, lambda: list(r.read()[2]))
+        # Closing the iterator stops the thread.
+        count = threading.active_count()
+        it = png._pipeline(iter(range(1000)), 2)
+        self.assertEqual(next(it), 0)
+        it.close()
+        for _ in range(20):
+            if threading.active_count() == count:
+                break
+            time.sleep(0.05)
+        self.assertEqual(threading.active_count(), count)
+
+    def testDecodeMany(self):
+        """Test decoding many files with a pool of processes."""
+
+        import os
+        import shutil
+        import tempfile
+
+        names = ['basn0g01', 'basn2c16', 'basi3p08', 'tbrn2c08', 'basn6a08']
+        d = tempfile.mkdtemp()
+        try:
+            paths = []
+            # Enough files that the shared memory blocks are reused.
+            for i,name in enumerate(names * 3):
+                path = os.path.join(d, '%d%s.png' % (i, name))
+                with open(path, 'wb') as f:
+                    f.write(pngsuite.png[name])
+                paths.append(path)
+            expect = [list(map(list, png.Reader(filename=path).asDirect()[2]))
+                      for path in paths]
+            shm = os.path.isdir('/dev/shm') and set(os.listdir('/dev/shm'))
+            results = list(png.decode_many(paths, 2, as_ndarray=False))
+            self.assertEqual([r[0] for r in results], paths)
+            self.assertEqual([list(map(list, r[3])) for r in results],
+                             expect)
+            for workers in [1, 2]:
+                results = png.decode_many(reversed(paths), workers,
+                  as_ndarray=False, ordered=False, method='read')
+                self.assertEqual(sorted(r[0] for r in results),
+                                 sorted(paths))
+            # Results that are not used.
+            results = png.decode_many(paths, 2, as_ndarray=False)
+            next(results)
+            results.close()
+            if numpy:
+                for path,w,h,pixels,info in png.decode_many(paths, 2):
+                    self.assertEqual(pixels.shape, (h, w, info['planes']))
+                    self.assertEqual(pixels.reshape(h, -1).tolist(),
+                                     expect[paths.index(path)])
+            if shm is not False:
+                self.assertEqual(set(os.listdir('/dev/shm')), shm)
+            self.assertRaises(png.FormatError, list,
+                              png.decode_many([__file__], 1, False))
+        finally:
+            shutil.rmtree(d)
+
+    def testStats(self):
+        """Test recording where the time goes."""
+
+        stats = png.Stats()
+        r = png.Reader(bytes=pngsuite.basn2c16, stats=stats)
+        x,y,pixels,meta = r.read()
+        self.assertEqual(len(list(pixels)), y)
+        s = stats.summary()
+        for stage in ['chunks', 'crc', 'inflate', 'unfilter', 'boxing']:
+            self.assertTrue(s[stage]['calls'] > 0)
+        self.assertEqual(s['unfilter']['rows'], y)
+        self.assertEqual(s['boxing']['rows'], y)
+        self.assertEqual(s['inflate']['bytes_out'], y * (x * 6 + 1))
+        self.assertTrue('inflate' in stats.report())
+        self.assertTrue('other' in stats.report(1.0))
+        stats = png.Stats()
+        with stats:
+            r = png.Reader(bytes=pngsuite.basi0g08)
+            list(r.read()[2])
+            o = BytesIO()
+            png.Writer(4, 3, greyscale=True, filter_type=1).write(o,
+              [[0, 1, 2, 3]] * 3)
+        self.assertTrue(r.stats is stats)
+        s = stats.summary()
+        self.assertEqual(s['deinterlace']['rows'], 32)
+        self.assertEqual(s['pack']['rows'], 3)
+        self.assertEqual(s['filter']['rows'], 3)
+        self.assertEqual(s['deflate']['bytes_in'], 15)
+        self.assertEqual(s['write']['bytes_in'], len(o.getvalue()) - 57)
+        # Outside the block nothing is recorded.
+        self.assertTrue(png.Reader(bytes=pngsuite.basn0g08).stats is None)
+        # The command line tool.
+        class Output(list):
+            write = list.append
+        s = BytesIO(b'P5 2 2 255\n\x00\x01\x02\x03')
+        o = BytesIO()
+        err = Output()
+        olderr, sys.stderr = sys.stderr, err
+        try:
+            _redirect_io(s, o, lambda: png._main(['png', '--profile']))
+        finally:
+            sys.stderr = olderr
+        self.assertTrue('deflate' in ''.join(err))
+        self.assertEqual(png.Reader(bytes=o.getvalue()).read()[:2], (2, 2))
+
+    def testBench(self):
+        """Test the benchmark runner and the comparison with a
+        baseline."""
+
+        import os
+
+        import pngbenchmark
+
+        cases = pngbenchmark.cases(data=os.devnull)
+        names = [name for name,_ in cases]
+        self.assertTrue('decode/basi0g01' in names)
+        self.assertTrue('encode/basn6a16' in names)
+        self.assertFalse([n for n in names if 'nao_pic2' in n])
+        cases = [c for c in cases if c[0] == 'encode/tbgn3p08']
+        cases.append(('fail', lambda: 1/0))
+        results = pngbenchmark.run(cases, rounds=2, min_time=0)
+        self.assertEqual(results['results']['encode/tbgn3p08']['rounds'], 2)
+        self.assertTrue(results['results']['fail']['error'])
+        baseline = dict(results=dict(
+          ('decode/%d' % i, dict(best=1.0)) for i in range(4)))
+        results = dict(results={'decode/0': dict(best=1.1),
+                                'decode/1': dict(best=1.3),
+                                'decode/2': dict(best=None),
+                                'decode/4': dict(best=1.0)})
+        comparison = pngbenchmark.compare(results, baseline)
+        self.assertEqual([(c[0], c[4]) for c in comparison],
+                         [('decode/0', False), ('decode/1', True)])
+        comparison = pngbenchmark.compare(results, baseline, threshold=0.05)
+        self.assertEqual([c[4] for c in comparison], [True, True])
+
+    def testLazyImport(self):
+        """Test that importing png does not import the modules that
+        it only needs for some things."""
+
+        import os
+        import subprocess
+
+        # The modules that png imports itself (and whatever they
+        # import) are imported first, so that only those imported by
+        # png's own code are counted.
+        code = ("import sys; import array, binascii, itertools, math, "
+                "operator, struct, time, zlib; "
+                "before = set(sys.modules); import png; "
+                "print(' '.join(sorted(set(sys.modules) - before)))")
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.abspath(png.__file__))
+        p = subprocess.Popen([sys.executable, '-c', code], env=env,
+                             stdout=subprocess.PIPE)
+        imported = p.communicate()[0].decode('ascii').split()
+        self.assertEqual(p.returncode, 0)
+        self.assertTrue('png' in imported)
+        names = ['copy', 'warnings', 'threading', 'cpngfilters', 'numpy']
+        if sys.version_info >= (3, 7):
+            # Before 3.7, RegexModeDecode is compiled on import, which
+            # imports re (and functools).
+            names += ['re', 'functools']
+        for name in names:
+            self.assertFalse(name in imported, name)
+        # The things that were imported at first are there when used.
+        self.assertTrue(png.pngfilters.undo_filter_sub)
+        self.assertEqual(png._mode_regex().match('RGBA;16').groups(),
+                         ('RGBA', '16'))
+        self.assertTrue(png.RegexModeDecode is png._mode_regex())
+
+    def testPngsuiteLazy(self):
+        """Test that the PngSuite images are converted when first
+        used, and the cache of them."""
+
+        import os
+        import shutil
+        import subprocess
+        import tempfile
+
+        code = ("import sys; import pngsuite; "
+                "print(len(pngsuite.png.images)); "
+                "pngsuite.basn0g01; pngsuite.png['basn0g02']; "
+                "print(len(pngsuite.png.images)); "
+                "print('re' in sys.modules)")
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.abspath(png.__file__))
+        env.pop('PNGSUITE_CACHE', None)
+        p = subprocess.Popen([sys.executable, '-S', '-c', code], env=env,
+                             stdout=subprocess.PIPE)
+        out = p.communicate()[0].decode('ascii').split()
+        self.assertEqual(out, ['0', '2', 'False'])
+        self.assertEqual(pngsuite.basn0g01, pngsuite.png['basn0g01'])
+        self.assertEqual(pngsuite.png.get('basn0g01')[:8],
+                         png._signature)
+        self.assertTrue('basn0g01' in pngsuite.png)
+        self.assertEqual(len(pngsuite.png), len(list(pngsuite.png)))
+        self.assertRaises(AttributeError, lambda: pngsuite.basn9z99)
+        directory = tempfile.mkdtemp()
+        images = pngsuite.png.images
+        try:
+            pngsuite.png.images = {}
+            pngsuite.use_cache(os.path.join(directory, 'suite'))
+            data = pngsuite.basi0g08
+            self.assertEqual(data, images['basi0g08'])
+            names = os.listdir(os.path.join(directory, 'suite'))
+            self.assertEqual(len(names), 1)
+            self.assertTrue(names[0].startswith('basi0g08-'))
+            # Once cached, the file is read rather than the hex.
+            path = os.path.join(directory, 'suite', names[0])
+            with open(path, 'wb') as f:
+                f.write(b'cached')
+            pngsuite.png.images = {}
+            self.assertEqual(pngsuite.basi0g08, b'cached')
+        finally:
+            pngsuite.use_cache(None)
+            pngsuite.png.images = images
+            shutil.rmtree(directory)
+
+    def testFromArrayBuffer(self):
+        """Test from_array with arrays that support the buffer
+        protocol."""
+
+        if sys.version_info < (3,):
+            self.skipTest("needs Python 3")
+
+        def decoded(image):
+            o = BytesIO()
+            image.save(o)
+            r = png.Reader(bytes=o.getvalue())
+            x,y,pixels,meta = r.read()
+            return x, y, [list(row) for row in pixels], meta
+
+        values = list(range(24))
+        rows = [values[:12], values[12:]]
+        view = memoryview(bytes(values)).cast('B', (2, 12))
+        image = png.from_array(view, 'RGB')
+        self.assertTrue(image.packed is not None)
+        x,y,pixels,meta = decoded(image)
+        self.assertEqual((x, y, pixels), (4, 2, rows))
+        self.assertFalse(meta['greyscale'])
+        # The mode is derived from the shape.
+        for planes,mode in [(1, 'L'), (2, 'LA'), (3, 'RGB'), (4, 'RGBA')]:
+            view = memoryview(bytes(values)).cast('B', (2, 12 // planes,
+                                                         planes))
+            image = png.from_array(view, None)
+            self.assertEqual(image.info['width'], 12 // planes)
+            x,y,pixels,meta = decoded(image)
+            self.assertEqual(pixels, rows)
+            self.assertEqual(meta['planes'], planes)
+        self.assertEqual(decoded(png.from_array(
+          memoryview(bytes(values)).cast('B', (4, 6)), None))[:2], (6, 4))
+        # 16-bit values.
+        big = [v * 2741 for v in values]
+        view = memoryview(array('H', big)).cast('B').cast('H', (4, 6))
+        x,y,pixels,meta = decoded(png.from_array(view, None))
+        self.assertEqual(meta['bitdepth'], 16)
+        self.assertEqual(pixels, [big[i:i+6] for i in range(0, 24, 6)])
+        # Arrays that do not match the other arguments are done the
+        # usual way.
+        small = [v % 16 for v in values]
+        view = memoryview(bytes(small)).cast('B', (2, 12))
+        image = png.from_array(view, 'L;4', dict(bitdepth=4))
+        self.assertTrue(image.packed is None)
+        self.assertEqual(decoded(image)[2], [small[:12], small[12:]])
+        self.assertRaises(png.Error, png.from_array, [[1, 2]], None)
+        # The packed bytes are big-endian, whatever the order of the
+        # array and of this machine.
+        class View:
+            ndim = 2
+            shape = (2, 2)
+            itemsize = 2
+            def __init__(self, order):
+                self.format = order + 'H'
+            def tobytes(self):
+                return struct.pack(self.format[0] + '4H', 1, 258, 65535, 4)
+        class Machine:
+            def __init__(self, byteorder):
+                self.byteorder = byteorder
+            def __getattr__(self, name):
+                return getattr(sys, name)
+        try:
+            for byteorder in ['little', 'big']:
+                png.sys = Machine(byteorder)
+                for order in '<>!':
+                    image = png._from_view(View(order), 1, dict(
+                      greyscale=True, alpha=False))
+                    self.assertEqual(image.packed,
+                                     struct.pack('>4H', 1, 258, 65535, 4))
+        finally:
+            png.sys = sys
+        if numpy:
+            a = numpy.arange(48, dtype=numpy.uint8).reshape(4, 4, 3)
+            x,y,pixels,meta = decoded(png.from_array(a[:, ::2], None))
+            self.assertEqual(pixels, a[:, ::2].reshape(4, 6).tolist())
+            a = numpy.array([[1, 258], [65535, 4]], dtype='>u2')
+            x,y,pixels,meta = decoded(png.from_array(a, 'L'))
+            self.assertEqual(pixels, a.tolist())
+            a = numpy.array([[1, 258], [65535, 4]], dtype='<u2')
+            self.assertEqual(decoded(png.from_array(a, 'L'))[2],
+                             a.tolist())
+
+    def testImageLazy(self):
+        """Test that an Image decodes its pixels when they are first
+        used, and keeps them."""
+
+        def saved(image):
+            o = BytesIO()
+            image.save(o)
+            return o.getvalue()
+
+        data = pngsuite.png['basn2c16']
+        expected = [list(row) for row in png.Reader(bytes=data).read()[2]]
+        decodes = []
+        image = png.Reader(bytes=data).image()
+        make_rows = image.make_rows
+        def counted():
+            decodes.append(1)
+            return make_rows()
+        image.make_rows = counted
+        self.assertEqual(image.info['width'], 32)
+        self.assertEqual(image.info['bitdepth'], 16)
+        self.assertEqual(decodes, [])
+        self.assertEqual([list(row) for row in image.rows], expected)
+        # Changing the rows does not change the image.
+        for row in image.rows:
+            row[0] = 0
+        self.assertEqual([list(row) for row in image.rows], expected)
+        first = saved(image)
+        self.assertEqual(saved(image), first)
+        self.assertEqual(decodes, [1])
+        x,y,pixels,meta = png.Reader(bytes=first).read()
+        self.assertEqual([list(row) for row in pixels], expected)
+        # A palette image, read from a file.
+        image = png.Reader(file=BytesIO(pngsuite.png['basn3p04'])).image()
+        self.assertTrue(image.info['palette'])
+        r = png.Reader(bytes=saved(image))
+        r.preamble()
+        s = png.Reader(bytes=pngsuite.png['basn3p04'])
+        s.preamble()
+        self.assertEqual(r.palette(), s.palette())
+
+        # Arrays can be saved many times; an iterator only once,
+        # unless its rows have been used.
+        image = png.from_array([[[0, 0, 0], [255, 0, 0]],
+                                [[255, 0, 0], [0, 0, 0]]], 'RGB')
+        self.assertEqual(saved(image), saved(image))
+        image = png.from_array(iter([[1, 2], [3, 4]]), 'L',
+                               dict(height=2))
+        saved(image)
+        self.assertRaises(png.Error, saved, image)
+        image = png.from_array(iter([[1, 2], [3, 4]]), 'L',
+                               dict(height=2))
+        self.assertEqual([list(row) for row in image.rows], [[1, 2], [3, 4]])
+        self.assertEqual(saved(image), saved(image))
+        # Setting rows replaces the pixels.
+        image.rows = [[5, 6], [7, 8]]
+        self.assertEqual([list(row) for row in image.rows], [[5, 6], [7, 8]])
+        image = png.Reader(bytes=data).image()
+        image.rows = iter(expected)
+        self.assertTrue(image.source is None)
+        self.assertEqual([list(row) for row in image.rows], expected)
+
+        # The shared cache keeps at most cache_bytes of pixels.
+        png.Image.cache_bytes = 32 * 32 * 6
+        try:
+            png._pixel_cache.clear()
+            a = png.Reader(bytes=data).image()
+            b = png.Reader(bytes=data).image()
+            self.assertEqual([list(row) for row in a.rows], expected)
+            self.assertEqual(png._pixel_cache.size, 32 * 32 * 6)
+            self.assertEqual([list(row) for row in b.rows], expected)
+            self.assertEqual(list(png._pixel_cache.entries), [b.key])
+            self.assertTrue(a.pixels is None)
+            self.assertEqual(saved(a), first)
+            self.assertEqual(list(png._pixel_cache.entries), [a.key])
+        finally:
+            png.Image.cache_bytes = None
+            png._pixel_cache.clear()
+
+    def testGamma(self):
+        """Test asGamma, and asFloat with a gamma."""
+
+        import pnggamma
+
+        def approx(a, b, places=9):
+            self.assertEqual(len(a), len(b))
+            for x,y in zip(a, b):
+                self.assertAlmostEqual(x, y, places)
+
+        def recoded(data, **k):
+            x,y,pixels,meta = png.Reader(bytes=data).asGamma(**k)
+            return [list(row) for row in pixels], meta
+
+        data = topngbytes('gamma.png', [[0, 64, 128, 255]], 4, 1,
+                          greyscale=True, gamma=0.5)
+        # To linear light, 16-bit.
+        pixels,meta = recoded(data, bitdepth=16)
+        self.assertEqual(meta['bitdepth'], 16)
+        self.assertEqual(meta['gamma'], 1.0)
+        self.assertEqual(pixels,
+          [[int(round(65535 * (v / 255.0) ** 2)) for v in [0, 64, 128, 255]]])
+        # Back again.
+        pixels,meta = recoded(topngbytes('gamma16.png', pixels, 4, 1,
+          greyscale=True, bitdepth=16, gamma=1.0), gamma=0.5, bitdepth=8)
+        self.assertEqual(pixels, [[0, 64, 128, 255]])
+        # No gAMA chunk: default_gamma is used.
+        data8 = topngbytes('nogamma.png', [[0, 64, 128, 255]], 4, 1,
+                           greyscale=True)
+        self.assertEqual(recoded(data8, default_gamma=0.5)[0],
+          [[int(round(255 * (v / 255.0) ** 2)) for v in [0, 64, 128, 255]]])
+        self.assertEqual(recoded(data8)[0], [[0, 64, 128, 255]])
+        # Alpha is rescaled but not recoded.
+        data = topngbytes('gammaLA.png', [[0, 0, 64, 64, 255, 255]], 3, 1,
+                          greyscale=True, alpha=True, gamma=0.5)
+        pixels,meta = recoded(data, bitdepth=4)
+        self.assertEqual(pixels, [[0, 0, 1, 4, 15, 15]])
+
+        x,y,pixels,meta = png.Reader(bytes=data).asFloat(2.0, gamma=1.0)
+        self.assertEqual(meta['gamma'], 1.0)
+        self.assertEqual(meta['maxval'], 2.0)
+        approx(list(pixels)[0],
+          [0.0, 0.0, 2 * (64 / 255.0) ** 2, 2 * 64 / 255.0, 2.0, 2.0])
+        x,y,pixels,meta = png.Reader(bytes=data).asFloat()
+        self.assertEqual(meta['gamma'], 0.5)
+        approx(list(pixels)[0], [v / 255.0 for v in [0, 0, 64, 64, 255, 255]])
+
+        # Bytes that are recoded to bytes are translated; the result
+        # is the same as looking each one up.
+        table = pnggamma.table(4, 1.7, 8)
+        rows = [array('B', range(16)), list(range(15, -1, -1))]
+        expected = [[table[v] for v in row] for row in rows]
+        self.assertEqual([list(row) for row in pnggamma.recode(rows, table)],
+                         expected)
+        self.assertTrue(pnggamma.table(4, 1.7, 8) is table)
+
 def group(s, n):
     # See http://www.python.org/doc/2.6/library/functions.html#zip
     return list(zip(*[iter(s)]*n))
@@ -39,7 +39,9 @@ http://pythonhosted.org/pypng/
     author_email='drj@pobox.com',
     url='https://github.com/drj11/pypng',
     package_dir={'':'code'},
-    py_modules=['png', 'test_png', 'pngsuite'],
+    py_modules=['png', 'test_png', 'pngsuite', 'pnghistogram',
+                'pngcomposite', 'pngstack', 'pngoptimize', 'pngpool',
+                'pngbenchmark', 'pnggamma'],
     classifiers=[
       'Topic :: Multimedia :: Graphics',
       'Topic :: Software Development :: Libraries :: Python Modules',
@@ -55,6 +57,9 @@ http://pythonhosted.org/pypng/
       'Operating System :: OS Independent',
       ],
     )
+if sys.version_info >= (3, 5):
+    # asyncio support; the module uses async syntax.
+    conf['py_modules'].append('pngasync')
 conf['download_url'] = \
   'https://github.com/drj11/pypng/archive/%(name)s-%(version)s.tar.gz' % conf
 